@@ -0,0 +1,66 @@
+import sys
+import os
+import time
+import random
+
+# compares lisp.parser against the old grammar-driven parser on a
+# generated data dump. run from the top of the tree, with pypy on the
+# path:
+#   PYTHONPATH=/path/to/pypy python benchmarks/parser.py [megabytes]
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lisp import parser, ebnfparser
+
+words = ['alpha', 'beta', 'gamma', 'delta', 'point', 'name', 'value', 'x', 'y', '+']
+
+def random_atom(rand):
+    kind = rand.randint(0, 4)
+    if kind == 0:
+        return str(rand.randint(-100000, 100000))
+    elif kind == 1:
+        return '%.4f' % rand.uniform(-1000, 1000)
+    elif kind == 2:
+        return '"' + rand.choice(words) + '\\n\\x41"'
+    return rand.choice(words)
+
+def random_sexp(rand, depth):
+    if depth == 0 or rand.randint(0, 3) == 0:
+        return random_atom(rand)
+    items = [random_sexp(rand, depth - 1) for i in range(rand.randint(1, 6))]
+    if rand.randint(0, 5) == 0:
+        return "'(" + ' '.join(items) + ")"
+    return '(' + ' '.join(items) + ')'
+
+def generate(size):
+    rand = random.Random(42)
+    lines = []
+    total = 0
+    while total < size:
+        line = random_sexp(rand, 5)
+        lines.append(line)
+        total += len(line) + 1
+    return '\n'.join(lines) + '\n'
+
+def bench(name, parse, data):
+    start = time.time()
+    ret = parse(data)
+    elapsed = time.time() - start
+    print '%-10s %8.3fs  %8.2f MB/s' % (name, elapsed, len(data) / elapsed / 1e6)
+    return ret
+
+def main(argv):
+    megabytes = 2.0
+    if len(argv) > 1:
+        megabytes = float(argv[1])
+    data = generate(int(megabytes * 1e6))
+    print 'parsing %d bytes' % len(data)
+    new = bench('reader', parser.parse, data)
+    old = bench('ebnf', ebnfparser.parse, data)
+    if new.unparse() != old.unparse():
+        print 'results differ!'
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
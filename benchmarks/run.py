@@ -0,0 +1,171 @@
+import sys
+import os
+import time
+import json
+import math
+import subprocess
+import tempfile
+import optparse
+import shutil
+
+# times the lisp workloads in this directory, under the untranslated
+# interpreter and (if it has been built) the translated one. each
+# benchmark is run once to warm up, then --repeat times; the median and
+# standard deviation go to stdout as JSON, and can be compared against
+# an earlier run with --baseline. run from anywhere, with PYPY set as
+# for the Makefile:
+#   PYPY=/path/to/pypy python benchmarks/run.py --output base.json
+#   PYPY=/path/to/pypy python benchmarks/run.py --baseline base.json
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+benchmarks = [
+    ('fib', os.path.join(here, 'fib.l')),
+    ('tak', os.path.join(here, 'tak.l')),
+    ('lists', os.path.join(here, 'lists.l')),
+    ('hash', os.path.join(here, 'hash.l')),
+    ('macros', os.path.join(here, 'macros.l')),
+    ('let', os.path.join(here, 'let.l')),
+    ('strings', os.path.join(here, 'strings.l')),
+    ('parse', os.path.join(here, 'parse.l')),
+    ('pi', os.path.join(root, 'tests', 'pi.l')),
+    ('mandelbrot', os.path.join(root, 'tests', 'mandelbrot.l')),
+]
+
+stdlib = [
+    os.path.join(root, 'stdlisp', '00-core.l'),
+    os.path.join(root, 'stdlisp', '01-io.l'),
+]
+
+def interpreters(which, cache):
+    # every run gets an empty cache directory of its own, as well as
+    # --no-cache, so nothing from ~/.cache is ever read or written
+    ret = []
+    base = dict(os.environ)
+    base['LISPLISP_CACHE'] = cache
+    if which in ('untranslated', 'both'):
+        env = dict(base)
+        pypy = os.environ.get('PYPY')
+        if pypy:
+            env['PYTHONPATH'] = pypy + os.pathsep + env.get('PYTHONPATH', '')
+        ret.append(('untranslated', [sys.executable, os.path.join(root, 'target-lisp.py')], env))
+    binary = os.path.join(root, 'target-lisp-c')
+    if which in ('translated', 'both') and os.path.exists(binary):
+        ret.append(('translated', [binary], dict(base)))
+    return ret
+
+def time_run(command, env):
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    code = subprocess.call(command, env=env, stdout=devnull, stderr=devnull)
+    elapsed = time.time() - start
+    devnull.close()
+    if code != 0:
+        raise RuntimeError('%s exited with %d' % (' '.join(command), code))
+    return elapsed
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+def stddev(values):
+    if len(values) < 2:
+        return 0.0
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+
+def compare(results, baseline, threshold):
+    # prints a line for each benchmark in both; returns the regressions
+    old = {}
+    for result in baseline['results']:
+        old[(result['name'], result['interpreter'], result['engine'])] = result
+    regressions = []
+    for result in results:
+        key = (result['name'], result['interpreter'], result['engine'])
+        if key not in old:
+            continue
+        before = old[key]['median']
+        change = (result['median'] - before) / before
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(result['name'])
+        elif change < -threshold:
+            flag = '  improved'
+        sys.stderr.write('%-12s %-13s %-8s %8.3fs -> %8.3fs  %+6.1f%%%s\n' % (
+            result['name'], result['interpreter'], result['engine'],
+            before, result['median'], change * 100, flag))
+    return regressions
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('--engine', action='append', default=[],
+                      help='engine to run (eval, closure, vm); may be repeated')
+    parser.add_option('--interpreter', default='both',
+                      choices=['untranslated', 'translated', 'both'])
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--warmup', type='int', default=1)
+    parser.add_option('--scale', type='int', default=1,
+                      help='multiplies the work each benchmark does')
+    parser.add_option('--output', help='also write the results to this file')
+    parser.add_option('--baseline', help='results from an earlier run to compare with')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='slowdown (as a fraction) counted as a regression')
+    options, names = parser.parse_args(argv[1:])
+    engines = options.engine or ['eval']
+
+    chosen = [b for b in benchmarks if not names or b[0] in names]
+    unknown = set(names) - set(b[0] for b in benchmarks)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    prelude = tempfile.NamedTemporaryFile(suffix='.l', delete=False)
+    prelude.write('(setq bench-scale %d)\n' % options.scale)
+    prelude.close()
+    cache = tempfile.mkdtemp(prefix='lisplisp-bench-')
+
+    results = []
+    try:
+        for interpreter, command, env in interpreters(options.interpreter, cache):
+            for engine in engines:
+                for name, path in chosen:
+                    run = command + ['--engine', engine, '--no-cache'] + stdlib + [prelude.name, path]
+                    for i in range(options.warmup):
+                        time_run(run, env)
+                    times = [time_run(run, env) for i in range(options.repeat)]
+                    results.append({
+                        'name': name,
+                        'interpreter': interpreter,
+                        'engine': engine,
+                        'times': times,
+                        'median': median(times),
+                        'stddev': stddev(times),
+                    })
+                    sys.stderr.write('%-12s %-13s %-8s %8.3fs +- %.3fs\n' % (
+                        name, interpreter, engine, median(times), stddev(times)))
+    finally:
+        os.unlink(prelude.name)
+        shutil.rmtree(cache)
+
+    report = {'scale': options.scale, 'repeat': options.repeat, 'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print text
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != options.scale:
+            sys.stderr.write('baseline was run with a different --scale\n')
+        if compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
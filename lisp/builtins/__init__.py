@@ -1,14 +1,28 @@
-from .procedure import register as register_procedures
-from ..types import Symbol
+from .procedure import procedures, register as register_procedures
+from ..types import T
+from .. import resolver
+from .. import ports
 
 import core
 import math
 import types
 import io
 import ffi
+import vector
+import hashtable
+import bytecode
+import profiling
+
+for proc in procedures:
+    if proc.name in ['lambda', 'macro', 'let', 'dolist']:
+        resolver.binding_forms[proc.name] = proc
 
 def register(scope):
     # idempotent symbols
-    scope.set('t', Symbol('t'))
+    scope.set('t', T)
+    # the standard ports, which can also be named by quoted symbol
+    scope.set('stdout', ports.stdout)
+    scope.set('stderr', ports.stderr)
+    scope.set('stdin', ports.stdin)
     # now procedures
     register_procedures(scope)
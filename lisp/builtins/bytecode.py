@@ -0,0 +1,11 @@
+from .procedure import function, LambdaProcedure
+from ..types import String
+from ..eval import EvalException
+from ..compiler import compiled_code
+
+@function('disassemble', 1)
+def l_disassemble(scope, values):
+    proc = values[0]
+    if not isinstance(proc, LambdaProcedure):
+        raise EvalException("value is not a lambda or macro", proc)
+    return String(compiled_code(proc).disassemble())
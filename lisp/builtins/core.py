@@ -1,75 +1,145 @@
-from .procedure import procedure, parse_arguments
-from ..types import InvalidValue, Symbol, Cell, String, Procedure
-from ..eval import EvalException, eval, eval_list, eval_list_each
-from ..scope import Scope, NameNotSet
-from ..parser import parse
+from .procedure import procedure, function, arg, args_from, name_procedure
+from ..types import InvalidValue, Symbol, Cell, String, Procedure, T, intern, is_list, unparse_string
+from ..eval import EvalException, tracing, eval, eval_list_tail, eval_body, eval_body_tail, tail_eval
+from ..scope import Frame, FrameLayout, NameNotSet
+from ..resolver import LexicalSymbol, ResolvedCell
+from ..parser import parse, ParseError
 
-from pypy.rlib.jit import unroll_safe
+from pypy.rlib.jit import JitDriver, unroll_safe
 
-@procedure('quote')
+@procedure('quote', 1)
 def l_quote(scope, args):
-    req, _, _ = parse_arguments(args, 1)
-    return req[0]
+    return arg(args, 0)
 
-@procedure('eval')
+def _unquote_arg(sexp, name):
+    # the argument of (name arg) if sexp is one, or None
+    if not isinstance(sexp, Cell):
+        return None
+    head = sexp.car
+    if not isinstance(head, Symbol) or head.name != name:
+        return None
+    args = sexp.cdr
+    if not isinstance(args, Cell) or args.cdr is not None:
+        raise EvalException("invalid arguments to " + name, sexp)
+    return args
+
+@unroll_safe
+def _quasiquote(scope, template):
+    if not isinstance(template, Cell):
+        return template
+    arg = _unquote_arg(template, 'unquote')
+    if arg is not None:
+        return eval(scope, arg.car)
+    if _unquote_arg(template, 'unquote-splicing') is not None:
+        raise EvalException("unquote-splicing outside of a list", template)
+    
+    items = []
+    tail = None
+    while template is not None:
+        if not isinstance(template, Cell):
+            # a dotted template, which ends in an atom
+            tail = template
+            break
+        arg = _unquote_arg(template, 'unquote')
+        if arg is not None:
+            # `(a . ,b), which reads as (a unquote b)
+            tail = eval(scope, arg.car)
+            break
+        item = template.car
+        template = template.cdr
+        arg = _unquote_arg(item, 'unquote-splicing')
+        if arg is None:
+            items.append(_quasiquote(scope, item))
+            continue
+        spliced = eval(scope, arg.car)
+        if template is None:
+            # like append, the last list spliced in is shared, not copied
+            tail = spliced
+            break
+        while spliced is not None:
+            if not isinstance(spliced, Cell):
+                raise EvalException("value is not a list", spliced)
+            items.append(spliced.car)
+            spliced = spliced.cdr
+    
+    i = len(items) - 1
+    while i >= 0:
+        tail = Cell(items[i], tail)
+        i -= 1
+    return tail
+
+@procedure('quasiquote', 1)
+def l_quasiquote(scope, args):
+    return _quasiquote(scope, arg(args, 0))
+
+@procedure('eval', 0, 0, True)
+@unroll_safe
 def l_eval(scope, args):
-    _, _, rest = parse_arguments(args, 0, 0, True)
-    return eval_list(scope, eval_list_each(scope, rest))
+    # every argument is evaluated first, then each result in turn
+    sexps = []
+    while args is not None:
+        assert isinstance(args, Cell)
+        sexps.append(eval(scope, args.car))
+        args = args.cdr
+    return eval_list_tail(scope, sexps)
 
 @unroll_safe
 def _l_set(scope, args, eval_symbol):
-    _, _, rest = parse_arguments(args, 0, 0, True)
-    
-    if len(rest) % 2 != 0:
+    count = 0
+    rest = args
+    while rest is not None:
+        assert isinstance(rest, Cell)
+        count += 1
+        rest = rest.cdr
+    if count % 2 != 0:
         raise EvalException("set requires an even number of arguments")
     
-    i = 0
     value = None
-    while i < len(rest):
-        symbol = rest[i]
+    while args is not None:
+        assert isinstance(args, Cell)
+        symbol = args.car
         orig_symbol = symbol
+        args = args.cdr
+        assert isinstance(args, Cell)
         if eval_symbol:
             symbol = eval(scope, symbol)
-        value = eval(scope, rest[i + 1])
+        value = eval(scope, args.car)
+        args = args.cdr
         
         if not isinstance(symbol, Symbol):
             raise EvalException("value is not a symbol", orig_symbol)
         
-        scope.set(symbol.name, value)
-        
-        i += 2
+        name_procedure(value, symbol.name)
+        if isinstance(symbol, LexicalSymbol):
+            symbol.store(scope, value)
+        else:
+            scope.set(symbol.name, value)
     return value
 
-@procedure('set')
+@procedure('set', 0, 0, True)
 def l_set(scope, args):
     return _l_set(scope, args, True)
 
-@procedure('setq')
+@procedure('setq', 0, 0, True)
 def l_setq(scope, args):
     return _l_set(scope, args, False)
 
-@procedure('set-p')
-def l_set_p(scope, args):
-    req, _, _ = parse_arguments(args, 1)
-    symbol = eval(scope, req[0])
+@function('set-p', 1)
+def l_set_p(scope, values):
+    symbol = values[0]
     if not isinstance(symbol, Symbol):
-        raise EvalException("value is not a symbol", req[0])
+        raise EvalException("value is not a symbol", symbol)
     if scope.is_set(symbol.name):
-        return Symbol('t')
+        return T
     return None
 
-@procedure('let')
-@unroll_safe
-def l_let(scope, args):
-    req, _, rest = parse_arguments(args, 1, 0, True)
-    if not isinstance(req[0], Cell):
-        raise EvalException("let bindings are not a list")
+def _let_layout(bindings):
     try:
-        bindings = req[0].to_list()
+        bindings = bindings.to_list()
     except InvalidValue:
         raise EvalException("let bindings are not a list")
     
-    bindings_cached = {}
+    names = []
     for binding in bindings:
         orig_binding = binding
         if not isinstance(binding, Cell):
@@ -80,101 +150,229 @@ def l_let(scope, args):
             raise EvalException("let binding name is not a symbol", orig_binding)
         if not isinstance(binding, Cell):
             raise EvalException("let binding is not a 2-list", orig_binding)
-        value = binding.car
         if binding.cdr is not None:
             raise EvalException("let binding is not a 2-list", orig_binding)
-        value = eval(scope, value)
-        bindings_cached[symbol.name] = value
+        names.append(symbol.name)
+    return FrameLayout(names)
+
+@procedure('let', 1, 0, True)
+@unroll_safe
+def l_let(scope, args):
+    bindings = arg(args, 0)
+    if not isinstance(bindings, Cell):
+        raise EvalException("let bindings are not a list")
+    
+    # resolved lets were checked when their layout was built
+    if isinstance(bindings, ResolvedCell):
+        layout = bindings.layout
+    else:
+        layout = _let_layout(bindings)
     
-    newscope = Scope(scope)
-    for name, val in bindings_cached.items():
-        newscope.set(name, val, local_only=True)
-    return eval_list(newscope, rest)
-
-@procedure('throw')
-def l_throw(scope, args):
-    req, _, _ = parse_arguments(args, 1)
-    error = eval(scope, req[0])
+    values = [None] * layout.size()
+    i = 0
+    while bindings is not None:
+        assert isinstance(bindings, Cell)
+        binding = bindings.car
+        assert isinstance(binding, Cell)
+        value = binding.cdr
+        assert isinstance(value, Cell)
+        values[i] = eval(scope, value.car)
+        bindings = bindings.cdr
+        i += 1
+    return eval_body_tail(Frame(scope, layout, values), args_from(args, 1))
+
+@function('throw', 1)
+def l_throw(scope, values):
+    error = values[0]
     if not isinstance(error, String):
         raise EvalException("error is not a string")
     raise EvalException(error.data)
 
-@procedure('catch')
-@unroll_safe
+@procedure('catch', 1, 0, True)
 def l_catch(scope, args):
-    req, _, rest = parse_arguments(args, 1, 0, True)
-    handler = eval(scope, req[0])
+    # the handler is called with the message, and the trace too if it
+    # takes a second argument; if not, none is recorded
+    handler = eval(scope, arg(args, 0))
     if not isinstance(handler, Procedure):
         raise EvalException("handler is not a procedure")
-    ret = None
+    wants_trace = handler.accepts(2)
+    previous = tracing.enabled
+    tracing.enabled = wants_trace
     try:
-        ret = eval_list(scope, rest)
+        try:
+            return eval_body(scope, args_from(args, 1))
+        finally:
+            tracing.enabled = previous
     except EvalException, e:
-        message = e.message
-        trace = list(e.trace)
-        trace.reverse()
-        trace_lisp = None
-        for sexp in trace:
-            trace_lisp = Cell(sexp, trace_lisp)
-        args = Cell(String(message), Cell(Cell(Symbol('quote'), Cell(trace_lisp))))
-        ret = eval(scope, Cell(handler, args))
-    return ret
-
-@procedure('parse')
-def l_parse(scope, args):
-    req, _, _ = parse_arguments(args, 1)
-    s = eval(scope, req[0])
+        if wants_trace:
+            return handler.apply(scope, [String(e.message), e.trace_list()])
+        return handler.apply(scope, [String(e.message)])
+
+class Block(object):
+    def __init__(self, name):
+        self.name = name
+
+class ReturnFrom(Exception):
+    # not an EvalException, so nothing on the way out records a trace,
+    # and catch lets it through
+    def __init__(self, block, value):
+        self.block = block
+        self.value = value
+
+class BlockState(object):
+    # the blocks being run, innermost last
+    def __init__(self):
+        self.active = []
+
+blocks = BlockState()
+
+def _block_name(sexp):
+    if not isinstance(sexp, Symbol):
+        raise EvalException("block name is not a symbol")
+    return sexp.name
+
+@procedure('block', 1, 0, True)
+def l_block(scope, args):
+    block = Block(_block_name(arg(args, 0)))
+    blocks.active.append(block)
+    try:
+        try:
+            return eval_body(scope, args_from(args, 1))
+        finally:
+            blocks.active.pop()
+    except ReturnFrom, e:
+        if e.block is not block:
+            raise
+        return e.value
+
+@procedure('return-from', 1, 1)
+def l_return_from(scope, args):
+    # leaves the innermost running block of that name
+    name = _block_name(arg(args, 0))
+    value = None
+    if args_from(args, 1) is not None:
+        value = eval(scope, arg(args, 1))
+    i = len(blocks.active) - 1
+    while i >= 0:
+        block = blocks.active[i]
+        if block.name == name:
+            raise ReturnFrom(block, value)
+        i -= 1
+    raise EvalException("no block named " + name + " is running")
+
+@function('parse', 1)
+def l_parse(scope, values):
+    s = values[0]
     if not isinstance(s, String):
         raise EvalException("argument is not a string")
-    parsed = parse(s.data)
+    try:
+        parsed = parse(s.data)
+    except ParseError, e:
+        raise EvalException(e.message)
     if isinstance(parsed, Cell) and parsed.cdr is None:
         return parsed.car
     return parsed
 
-@procedure('unparse')
-def l_unparse(scope, args):
-    req, _, _ = parse_arguments(args, 1)
-    val = eval(scope, req[0])
-    if val is None:
-        return String('nil')
-    return String(val.unparse())
+@function('unparse', 1)
+def l_unparse(scope, values):
+    return String(unparse_string(values[0]))
 
-@procedure('begin')
+@procedure('begin', 0, 0, True)
 def l_begin(scope, args):
-    _, _, rest = parse_arguments(args, 0, 0, True)
-    return eval_list(scope, rest)
+    return eval_body_tail(scope, args)
 
-@procedure('and')
+@procedure('and', 0, 0, True)
+@unroll_safe
 def l_and(scope, args):
-    _, _, rest = parse_arguments(args, 0, 0, True)
-    ret = Symbol('t')
-    for sexp in rest:
-        ret = eval(scope, sexp)
-        if ret is None:
+    if args is None:
+        return T
+    while True:
+        assert isinstance(args, Cell)
+        if args.cdr is None:
+            return tail_eval(scope, args.car)
+        if eval(scope, args.car) is None:
             return None
-    return ret
+        args = args.cdr
 
-@procedure('or')
+@procedure('or', 0, 0, True)
+@unroll_safe
 def l_or(scope, args):
-    _, _, rest = parse_arguments(args, 0, 0, True)
-    for sexp in rest:
-        ret = eval(scope, sexp)
+    if args is None:
+        return None
+    while True:
+        assert isinstance(args, Cell)
+        if args.cdr is None:
+            return tail_eval(scope, args.car)
+        ret = eval(scope, args.car)
         if ret is not None:
             return ret
-    return None
+        args = args.cdr
 
-@procedure('if')
+@procedure('if', 2, 0, True)
 def l_if(scope, args):
-    req, _, rest = parse_arguments(args, 2, 0, True)
-    testval = eval(scope, req[0])
+    testval = eval(scope, arg(args, 0))
     if testval is not None:
-        return eval(scope, req[1])
-    return eval_list(scope, rest)
+        return tail_eval(scope, arg(args, 1))
+    return eval_body_tail(scope, args_from(args, 2))
+
+def get_while_location(test, body):
+    return "(while " + unparse_string(test) + " ...)"
+whiledriver = JitDriver(greens=['test', 'body'], reds=['scope'], get_printable_location=get_while_location)
 
-@procedure('while')
+@procedure('while', 1, 0, True)
 def l_while(scope, args):
-    req, _, rest = parse_arguments(args, 1, 0, True)
-    test = req[0]
-    while eval(scope, test) is not None:
-        eval_list(scope, rest)
+    test = arg(args, 0)
+    body = args_from(args, 1)
+    while True:
+        whiledriver.jit_merge_point(test=test, body=body, scope=scope)
+        if eval(scope, test) is None:
+            break
+        eval_body(scope, body)
     return None
+
+def get_dolist_location(binding, body):
+    return "(dolist " + unparse_string(binding) + " ...)"
+dolistdriver = JitDriver(greens=['binding', 'body'], reds=['work', 'frame'], get_printable_location=get_dolist_location)
+
+@procedure('dolist', 1, 0, True)
+def l_dolist(scope, args):
+    # (dolist (name list [result]) . body)
+    binding = arg(args, 0)
+    count = 0
+    rest = binding
+    while isinstance(rest, Cell):
+        count += 1
+        rest = rest.cdr
+    if rest is not None or (count != 2 and count != 3):
+        raise EvalException("dolist binding is not length 2 or 3")
+    assert isinstance(binding, Cell)
+    symbol = binding.car
+    if not isinstance(symbol, Symbol):
+        raise EvalException("not a valid binding name", symbol)
+    parts = binding.cdr
+    assert isinstance(parts, Cell)
+    
+    work = eval(scope, parts.car)
+    if not is_list(work):
+        raise EvalException("dolist target is not a list")
+    if isinstance(binding, ResolvedCell):
+        layout = binding.layout
+    else:
+        layout = FrameLayout([symbol.name])
+    frame = Frame(scope, layout, [None])
+    body = args_from(args, 1)
+    while True:
+        dolistdriver.jit_merge_point(binding=binding, body=body, work=work, frame=frame)
+        if work is None:
+            break
+        assert isinstance(work, Cell)
+        frame.values[0] = work.car
+        eval_body(frame, body)
+        work = work.cdr
+    
+    # the name still holds the last element here
+    result = parts.cdr
+    if result is None:
+        return None
+    assert isinstance(result, Cell)
+    return tail_eval(frame, result.car)
@@ -1,29 +1,67 @@
-from .procedure import procedure, parse_arguments
-from ..types import BoxedType, Cell, Symbol, String, Number, Integer, Float, Procedure
+from .procedure import procedure, arg, args_from, Arity
+from ..types import BoxedType, Cell, Symbol, String, Number, Integer, Float, Procedure, make_int
 from ..eval import EvalException, eval
 
 import pypy.rlib.clibffi as ffi
 from pypy.rpython.lltypesystem import rffi, lltype
 from pypy.rlib.rdynload import DLOpenError
+from pypy.rlib.jit import hint, unroll_safe
 
 c_free = rffi.llexternal("free", [rffi.VOIDP], lltype.Void)
 
+class ArgBuffer(object):
+    # raw memory for one char* argument of one procedure, kept from call
+    # to call so marshalling a string is a copy, not a malloc and free
+    max_kept = 65536
+    
+    def __init__(self):
+        self.charp = lltype.nullptr(rffi.CCHARP.TO)
+        self.size = 0
+        # the String whose data charp holds, if nothing can have changed it
+        self.held = None
+    
+    def fill(self, val):
+        data = val.data
+        if len(data) + 1 > self.size:
+            self.free()
+            self.size = len(data) + 1
+            self.charp = lltype.malloc(rffi.CCHARP.TO, self.size, flavor='raw')
+        for i in range(len(data)):
+            self.charp[i] = data[i]
+        self.charp[len(data)] = '\x00'
+        self.held = None
+    
+    def free(self):
+        if self.charp:
+            lltype.free(self.charp, flavor='raw')
+            self.charp = lltype.nullptr(rffi.CCHARP.TO)
+        self.size = 0
+        self.held = None
+    
+    def release(self):
+        # called after each call; a buffer for an unusually big string
+        # isn't worth keeping around
+        if self.size > self.max_kept:
+            self.free()
+
+# the types are stateless, so there's one of each, shared by every
+# procedure; anything that has to last through a call is in an ArgBuffer
+
 class FFIType(object):
     name = "void"
     type = lltype.Void
     ffi_type = ffi.ffi_type_void
     lisp_type = None
+    needs_buffer = False
     
     def check_lisp_type(self, obj):
         if not isinstance(obj, self.lisp_type):
             return False
         return True
     
-    def push_arg(self, func, val):
+    def push_arg(self, func, val, buf):
         #func.push_arg(val)
         raise NotImplementedError("push_arg")
-    def free_arg(self):
-        pass
     def call(self, func):
         func.call(lltype.Void)
         return None
@@ -33,17 +71,17 @@ class IntType(FFIType):
     type = rffi.INT
     ffi_type = ffi.ffi_type_sint
     lisp_type = Integer
-    def push_arg(self, func, val):
+    def push_arg(self, func, val, buf):
         assert isinstance(val, Integer)
         func.push_arg(val.value)
     def call(self, func):
-        return Integer(int(func.call(rffi.INT)))
+        return make_int(int(func.call(rffi.INT)))
 class DoubleType(FFIType):
     name = 'double'
     type = rffi.DOUBLE
     ffi_type = ffi.ffi_type_double
     lisp_type = Float
-    def push_arg(self, func, val):
+    def push_arg(self, func, val, buf):
         assert isinstance(val, Float)
         func.push_arg(val.value)
     def call(self, func):
@@ -53,23 +91,23 @@ class StringType(FFIType):
     type = rffi.CCHARP
     ffi_type = ffi.ffi_type_pointer
     lisp_type = String
+    needs_buffer = True
     def check_lisp_type(self, obj):
         if obj is None:
             return True
         if not isinstance(obj, String):
             return False
         return True
-    def push_arg(self, func, val):
+    def push_arg(self, func, val, buf):
         if val is None:
             # nil -> NULL
-            self.charp = lltype.nullptr(rffi.CCHARP.TO)
-        else:
-            assert isinstance(val, String)
-            self.charp = rffi.str2charp(val.data)
-        func.push_arg(self.charp)
-    def free_arg(self):
-        if self.charp:
-            lltype.free(self.charp, flavor='raw')
+            func.push_arg(lltype.nullptr(rffi.CCHARP.TO))
+            return
+        assert isinstance(val, String)
+        # the function may write through the pointer, so every call
+        # gets a fresh copy
+        buf.fill(val)
+        func.push_arg(buf.charp)
     def call(self, func):
         charp = func.call(rffi.CCHARP)
         if not charp:
@@ -77,12 +115,32 @@ class StringType(FFIType):
         ret = String(rffi.charp2str(charp))
         c_free(charp)
         return ret
+class ConstStringType(StringType):
+    # a char* the function promises not to write through (or, as a
+    # result, one it still owns, which is copied but never freed)
+    name = 'const-char*'
+    def push_arg(self, func, val, buf):
+        if val is None:
+            func.push_arg(lltype.nullptr(rffi.CCHARP.TO))
+            return
+        assert isinstance(val, String)
+        # strings never change, so the same one needs no copy at all
+        if buf.held is not val:
+            buf.fill(val)
+            buf.held = val
+        func.push_arg(buf.charp)
+    def call(self, func):
+        charp = func.call(rffi.CCHARP)
+        if not charp:
+            return None
+        return String(rffi.charp2str(charp))
 
 typelist = [
-    FFIType,
-    IntType,
-    DoubleType,
-    StringType,
+    FFIType(),
+    IntType(),
+    DoubleType(),
+    StringType(),
+    ConstStringType(),
 ]
 
 symbol_to_type = {}
@@ -90,53 +148,86 @@ for el in typelist:
     symbol_to_type[el.name] = el
 
 class FFIProcedure(Procedure):
+    # the argument and result types, and a buffer for each argument that
+    # needs one, are all settled here once, so a call just checks and
+    # pushes each value in turn
+    _immutable_fields_ = ['lib', 'ffi_func', 'argtypes[*]', 'restype', 'buffers[*]', 'arity']
     def __init__(self, lib, func, name, argtypes, restype):
         self.lib = lib
         self.ffi_func = func
-        self.argtypes = argtypes
+        self.argtypes = argtypes[:]
         self.restype = restype
+        self.buffers = [None] * len(argtypes)
+        for i in range(len(argtypes)):
+            if argtypes[i].needs_buffer:
+                self.buffers[i] = ArgBuffer()
+        self.arity = Arity(len(argtypes))
         Procedure.__init__(self, lib.name + '::' + name)
+    def is_strict(self):
+        return True
+    @unroll_safe
     def call(self, scope, args):
-        req, _, _ = parse_arguments(args, len(self.argtypes))
-
+        self = hint(self, promote=True)
+        self.arity.check(args)
+        # every argument is evaluated before any is pushed, in case one
+        # of them calls this procedure too
+        values = [None] * len(self.argtypes)
         i = 0
-        to_free = []
-        while i < len(self.argtypes):
-            sexp = req[i]
-            typ = self.argtypes[i]()
-            val = eval(scope, sexp)
-            if not typ.check_lisp_type(val):
-                self.ffi_func._clean_args()
-                for free_obj in to_free:
-                    free_obj.free_arg()
-                raise EvalException("argument is incorrect type", sexp)
-            typ.push_arg(self.ffi_func, val)
-            to_free.append(typ)
+        while args is not None:
+            assert isinstance(args, Cell)
+            values[i] = eval(scope, args.car)
+            args = args.cdr
             i += 1
-        
-        ret = self.restype().call(self.ffi_func)
-        for free_obj in to_free:
-            free_obj.free_arg()
+        return self.invoke(values)
+    def apply(self, scope, values):
+        self = hint(self, promote=True)
+        self.arity.check_count(len(values))
+        return self.invoke(values)
+    @unroll_safe
+    def invoke(self, values):
+        func = self.ffi_func
+        for i in range(len(self.argtypes)):
+            typ = self.argtypes[i]
+            val = values[i]
+            if not typ.check_lisp_type(val):
+                func._clean_args()
+                raise EvalException("argument is incorrect type", val)
+            typ.push_arg(func, val, self.buffers[i])
+        ret = self.restype.call(func)
+        for buf in self.buffers:
+            if buf is not None:
+                buf.release()
         return ret
 
 class FFILibrary(BoxedType):
     def __init__(self, name):
         self.name = name
         self.lib = ffi.CDLL(name)
+        # by name and signature, so declaring the same procedure again
+        # (in a loop, say) looks it up only the first time
+        self.procedures = {}
     def unparse(self):
         return "#<ffi-library #%s>" % (self.name,)
     
     def get_procedure(self, name, argtypes, restype):
+        key = name + ':' + restype.name
+        for typ in argtypes:
+            key += ':' + typ.name
+        try:
+            return self.procedures[key]
+        except KeyError:
+            pass
         ffi_argtypes = []
         for typ in argtypes:
             ffi_argtypes.append(typ.ffi_type)
         func = self.lib.getpointer(name, ffi_argtypes, restype.ffi_type)
-        return FFIProcedure(self, func, name, argtypes, restype)
+        proc = FFIProcedure(self, func, name, argtypes, restype)
+        self.procedures[key] = proc
+        return proc
 
-@procedure('ffi-library')
+@procedure('ffi-library', 1)
 def l_ffi_library(scope, args):
-    req, _, _ = parse_arguments(args, 1)
-    name = eval(scope, req[0])
+    name = eval(scope, arg(args, 0))
     if not isinstance(name, String):
         raise EvalException("library name is not a string")
     try:
@@ -144,21 +235,22 @@ def l_ffi_library(scope, args):
     except DLOpenError:
         raise EvalException("library could not be loaded")
 
-@procedure('ffi-procedure')
+@procedure('ffi-procedure', 2, 1, True)
 def l_ffi_procedure(scope, args):
-    req, opt, rest = parse_arguments(args, 2, 1, True)
-    
-    lib = eval(scope, req[0])
+    lib = eval(scope, arg(args, 0))
     if not isinstance(lib, FFILibrary):
         raise EvalException("first argument is not a library")
     
-    name = eval(scope, req[1])
+    name = eval(scope, arg(args, 1))
     if not isinstance(name, String):
         raise EvalException("procedure name is not a string")
     name = name.data
     
-    if len(opt) > 0:
-        restype = eval(scope, opt[0])
+    rest = args_from(args, 2)
+    if rest is not None:
+        assert isinstance(rest, Cell)
+        restype = eval(scope, rest.car)
+        rest = rest.cdr
         if not isinstance(restype, Symbol):
             raise EvalException("result type is not a symbol")
         restype = restype.name
@@ -166,7 +258,10 @@ def l_ffi_procedure(scope, args):
         restype = "void"
     
     argtypes = []
-    for sexp in rest:
+    while rest is not None:
+        assert isinstance(rest, Cell)
+        sexp = rest.car
+        rest = rest.cdr
         typ = eval(scope, sexp)
         if not isinstance(typ, Symbol):
             raise EvalException("argument type is not a symbol", sexp)
@@ -177,10 +272,10 @@ def l_ffi_procedure(scope, args):
     except KeyError:
         raise EvalException("unknown type: " + restype)
     full_argtypes = []
-    for arg in argtypes:
+    for typename in argtypes:
         try:
-            full_argtypes.append(symbol_to_type[arg])
+            full_argtypes.append(symbol_to_type[typename])
         except KeyError:
-            raise EvalException("unknown type: " + arg)
+            raise EvalException("unknown type: " + typename)
     
     return lib.get_procedure(name, full_argtypes, full_restype)
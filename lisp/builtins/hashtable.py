@@ -0,0 +1,39 @@
+from .procedure import function
+from ..types import HashTable, T, make_int
+from ..eval import EvalException
+
+def _table(val):
+    if not isinstance(val, HashTable):
+        raise EvalException("value is not a hash table", val)
+    return val
+
+@function('make-hash-table', 0)
+def l_make_hash_table(scope, values):
+    return HashTable()
+
+@function('hash-get', 2, 1)
+def l_hash_get(scope, values):
+    # the value for key, or the default (nil if not given)
+    default = None
+    if len(values) > 2:
+        default = values[2]
+    return _table(values[0]).get(values[1], default)
+
+@function('hash-set!', 3)
+def l_hash_set(scope, values):
+    _table(values[0]).set(values[1], values[2])
+    return values[2]
+
+@function('hash-remove!', 2)
+def l_hash_remove(scope, values):
+    if _table(values[0]).remove(values[1]):
+        return T
+    return None
+
+@function('hash-count', 1)
+def l_hash_count(scope, values):
+    return make_int(_table(values[0]).count())
+
+@function('hash-keys', 1)
+def l_hash_keys(scope, values):
+    return _table(values[0]).keys()
@@ -1,31 +1,182 @@
-from .procedure import procedure, parse_arguments
-from ..types import String, Symbol, Integer
-from ..eval import EvalException, eval
-
-import os
-
-def symbol_to_num(sym):
-    if sym == 'stdin':
-        return 0
-    elif sym == 'stdout':
-        return 1
-    elif sym == 'stderr':
-        return 2
-    return -1
-
-@procedure('write')
-def l_write(scope, args):
-    req, _, _ = parse_arguments(args, 2)
-    fd = eval(scope, req[0])
-    if not isinstance(fd, Symbol):
-        raise EvalException("unknown file")
-    destfd = symbol_to_num(fd.name)
-    if destfd == -1:
-        raise EvalException("unknown file")
+from .procedure import function
+from ..types import String, Symbol, Integer, Unparser, make_int
+from ..eval import EvalException
+from ..parser import ParseError
+from ..ports import OutputPort, InputPort, PortError, buffer_modes, standard_port, open_output_file, open_input_file, flush_all
+from .. import ports
+
+def _port(val):
+    # ports can be named by their symbol, as in (write 'stdout "hi")
+    if isinstance(val, OutputPort):
+        return val
+    if isinstance(val, Symbol):
+        port = standard_port(val.name)
+        if port is not None:
+            return port
+    raise EvalException("unknown file", val)
+
+def _input_port(val):
+    if isinstance(val, InputPort):
+        return val
+    if isinstance(val, Symbol) and val.name == 'stdin':
+        return ports.stdin
+    raise EvalException("unknown input file", val)
+
+def _string(val):
+    if not isinstance(val, String):
+        raise EvalException("argument is not a string", val)
+    return val.data
+
+class PortUnparser(Unparser):
+    # hands the text to port in chunks of about chunk_size bytes, so the
+    # whole of it is never in memory at once
+    chunk_size = 65536
+    
+    def __init__(self, port):
+        self.port = port
+        self.pieces = []
+        self.pending = 0
+        self.written = 0
     
-    s = eval(scope, req[1])
+    def emit(self, s):
+        self.pieces.append(s)
+        self.pending += len(s)
+        if self.pending >= self.chunk_size:
+            self.flush()
+    
+    def flush(self):
+        if self.pending > 0:
+            self.written += self.port.write("".join(self.pieces))
+            self.pieces = []
+            self.pending = 0
+
+@function('write', 2)
+def l_write(scope, values):
+    port = _port(values[0])
+    
+    s = values[1]
     if not isinstance(s, String):
         raise EvalException("data to write must be a string")
     
-    written = os.write(destfd, s.data)
-    return Integer(written)
+    try:
+        return make_int(port.write(s.data))
+    except PortError, e:
+        raise EvalException(e.message)
+
+@function('write-sexp', 2)
+def l_write_sexp(scope, values):
+    # writes what unparse would return, without building it first
+    unparser = PortUnparser(_port(values[0]))
+    try:
+        unparser.unparse(values[1])
+        unparser.flush()
+    except PortError, e:
+        raise EvalException(e.message)
+    return make_int(unparser.written)
+
+@function('open-output-file', 1, 1)
+def l_open_output_file(scope, values):
+    # truncates the file, unless the second argument is true
+    append = len(values) > 1 and values[1] is not None
+    try:
+        return open_output_file(_string(values[0]), append)
+    except PortError, e:
+        raise EvalException(e.message, values[0])
+
+@function('close-port', 1)
+def l_close_port(scope, values):
+    port = values[0]
+    if isinstance(port, InputPort):
+        port.close()
+        return None
+    try:
+        _port(port).close()
+    except PortError, e:
+        raise EvalException(e.message)
+    return None
+
+@function('flush', 0, 1)
+def l_flush(scope, values):
+    # one port, or all of them
+    if len(values) == 0:
+        flush_all()
+        return None
+    try:
+        _port(values[0]).flush()
+    except PortError, e:
+        raise EvalException(e.message)
+    return None
+
+@function('set-buffering', 2)
+def l_set_buffering(scope, values):
+    # mode is one of 'none, 'line or 'block
+    port = _port(values[0])
+    mode = values[1]
+    if not isinstance(mode, Symbol) or mode.name not in buffer_modes:
+        raise EvalException("buffering must be one of: " + ", ".join(buffer_modes), mode)
+    try:
+        port.flush()
+    except PortError, e:
+        raise EvalException(e.message)
+    for i in range(len(buffer_modes)):
+        if buffer_modes[i] == mode.name:
+            port.mode = i
+    return mode
+
+@function('open-input-file', 1)
+def l_open_input_file(scope, values):
+    try:
+        return open_input_file(_string(values[0]))
+    except PortError, e:
+        raise EvalException(e.message, values[0])
+
+def _read_result(data):
+    if data is None:
+        return None
+    return String(data)
+
+@function('read-line', 1)
+def l_read_line(scope, values):
+    # nil at the end of the file
+    port = _input_port(values[0])
+    try:
+        return _read_result(port.read_line())
+    except PortError, e:
+        raise EvalException(e.message)
+
+@function('read-char', 1)
+def l_read_char(scope, values):
+    port = _input_port(values[0])
+    try:
+        c = port.read_char()
+    except PortError, e:
+        raise EvalException(e.message)
+    if c is None:
+        return None
+    return String(c)
+
+@function('read-bytes', 2)
+def l_read_bytes(scope, values):
+    port = _input_port(values[0])
+    count = values[1]
+    if not isinstance(count, Integer) or count.value < 0:
+        raise EvalException("count is not a non-negative integer", count)
+    try:
+        return _read_result(port.read_bytes(count.value))
+    except PortError, e:
+        raise EvalException(e.message)
+
+@function('read-sexp', 1, 1)
+def l_read_sexp(scope, values):
+    # one form; at the end of the file, the second argument (or nil)
+    port = _input_port(values[0])
+    try:
+        if port.at_end():
+            if len(values) > 1:
+                return values[1]
+            return None
+        return port.read_sexp()
+    except PortError, e:
+        raise EvalException(e.message)
+    except ParseError, e:
+        raise EvalException(port.name + ": " + e.nice_error_message())
@@ -1,119 +1,151 @@
-from .procedure import procedure, parse_arguments
-from ..types import Number, Integer, Float, Symbol
-from ..eval import EvalException, eval
+from .procedure import function
+from ..types import Number, Integer, Float, T, make_int
+from ..eval import EvalException
 
 from pypy.rlib.jit import unroll_safe
 
-@procedure('+')
+# each operator has a two-argument version that the engines call
+# directly, and a general one for any other number of arguments
+
+def _number(val):
+    if not isinstance(val, Number):
+        raise EvalException('value not a number', val)
+    return val
+
+def _add2(scope, val1, val2):
+    if isinstance(val1, Integer) and isinstance(val2, Integer):
+        return make_int(val1.value + val2.value)
+    return Float(_number(val1).get_float() + _number(val2).get_float())
+
+@function('+', 0, 0, True, binary=_add2)
 @unroll_safe
-def l_add(scope, args):
-    _, _, rest = parse_arguments(args, 0, 0, True)
+def l_add(scope, values):
+    if len(values) == 2:
+        return _add2(scope, values[0], values[1])
+    gather = 0
+    gather_float = 0.0
     use_float = False
-    summands = []
-    for sexp in rest:
-        val = eval(scope, sexp)
-        if not isinstance(val, Number):
-            raise EvalException('value not a number', sexp)
-        if isinstance(val, Float):
+    for val in values:
+        if not use_float and isinstance(val, Integer):
+            gather += val.value
+            continue
+        if not use_float:
             use_float = True
-        summands.append(val)
+            gather_float = float(gather)
+        gather_float += _number(val).get_float()
     if use_float:
-        gather_float = 0.0
-        for val in summands:
-            gather_float += val.get_float()
         return Float(gather_float)
-    gather = 0
-    for val in summands:
-        assert isinstance(val, Integer)
-        gather += val.value
-    return Integer(gather)
+    return make_int(gather)
 
-@procedure('*')
+def _multiply2(scope, val1, val2):
+    if isinstance(val1, Integer) and isinstance(val2, Integer):
+        return make_int(val1.value * val2.value)
+    return Float(_number(val1).get_float() * _number(val2).get_float())
+
+@function('*', 0, 0, True, binary=_multiply2)
 @unroll_safe
-def l_multiply(scope, args):
-    _, _, rest = parse_arguments(args, 0, 0, True)
+def l_multiply(scope, values):
+    if len(values) == 2:
+        return _multiply2(scope, values[0], values[1])
+    gather = 1
+    gather_float = 1.0
     use_float = False
-    terms = []
-    for sexp in rest:
-        val = eval(scope, sexp)
-        if not isinstance(val, Number):
-            raise EvalException('value not a number', sexp)
-        if isinstance(val, Float):
+    for val in values:
+        if not use_float and isinstance(val, Integer):
+            gather *= val.value
+            continue
+        if not use_float:
             use_float = True
-        terms.append(val)
+            gather_float = float(gather)
+        gather_float *= _number(val).get_float()
     if use_float:
-        gather_float = 1.0
-        for val in terms:
-            gather_float *= val.get_float()
         return Float(gather_float)
-    gather = 1
-    for val in terms:
-        assert isinstance(val, Integer)
-        gather *= val.value
-    return Integer(gather)
-
-@procedure('-')
-def l_subtract(scope, args):
-    req, opt, _ = parse_arguments(args, 1, 1)
-    val1 = eval(scope, req[0])
-    if not isinstance(val1, Number):
-        raise EvalException('value not a number', req[0])
-    if len(opt) == 0:
-        assert isinstance(val1, Integer) or isinstance(val1, Float)
-        if isinstance(val1, Integer):
-            return Integer(-val1.value)
-        if isinstance(val1, Float):
-            return Float(-val1.value)
-    else:
-        val2 = eval(scope, opt[0])
-        if not isinstance(val2, Number):
-            raise EvalException('value not a number', opt[0])
-        if isinstance(val1, Float) or isinstance(val2, Float):
-            return Float(val1.get_float() - val2.get_float())
-        assert isinstance(val1, Integer) and isinstance(val2, Integer)
-        return Integer(val1.value - val2.value)
-
-@procedure('/')
-def l_divide(scope, args):
-    req, opt, _ = parse_arguments(args, 1, 1)
-    val1 = eval(scope, req[0])
-    if not isinstance(val1, Number):
-        raise EvalException('value not a number', req[0])
-    if len(opt) == 0:
-        if isinstance(val1, Integer) and (val1.value == 1 or val1.value == -1):
-            return Integer(1 / val1.value)
-        return Float(1.0 / val1.get_float())
-    else:
-        val2 = eval(scope, opt[0])
-        if not isinstance(val2, Number):
-            raise EvalException('value not a number', opt[0])
-        if isinstance(val1, Integer) and isinstance(val2, Integer):
-            if val2.value * (val1.value / val2.value) == val1.value:
-                return Integer(val1.value / val2.value)
-        return Float(val1.get_float() / val2.get_float())
-
-@procedure('>')
-def l_greater_than(scope, args):
-    req, _, _ = parse_arguments(args, 2)
-    val1 = eval(scope, req[0])
-    if not isinstance(val1, Number):
-        raise EvalException('value is not a number', req[0])
-    val2 = eval(scope, req[1])
-    if not isinstance(val2, Number):
-        raise EvalException('value is not a number', req[1])
-    if val1.get_float() > val2.get_float():
-        return Symbol('t')
-    return None
-
-@procedure('<')
-def l_less_than(scope, args):
-    req, _, _ = parse_arguments(args, 2)
-    val1 = eval(scope, req[0])
-    if not isinstance(val1, Number):
-        raise EvalException('value is not a number', req[0])
-    val2 = eval(scope, req[1])
-    if not isinstance(val2, Number):
-        raise EvalException('value is not a number', req[1])
-    if val1.get_float() < val2.get_float():
-        return Symbol('t')
-    return None
+    return make_int(gather)
+
+def _subtract2(scope, val1, val2):
+    if isinstance(val1, Integer) and isinstance(val2, Integer):
+        return make_int(val1.value - val2.value)
+    return Float(_number(val1).get_float() - _number(val2).get_float())
+
+@function('-', 1, 1, binary=_subtract2)
+def l_subtract(scope, values):
+    if len(values) == 2:
+        return _subtract2(scope, values[0], values[1])
+    val1 = _number(values[0])
+    if isinstance(val1, Integer):
+        return make_int(-val1.value)
+    return Float(-val1.get_float())
+
+def _divide2(scope, val1, val2):
+    if isinstance(val1, Integer) and isinstance(val2, Integer):
+        if val2.value != 0 and val2.value * (val1.value / val2.value) == val1.value:
+            return make_int(val1.value / val2.value)
+    return Float(_number(val1).get_float() / _number(val2).get_float())
+
+@function('/', 1, 1, binary=_divide2)
+def l_divide(scope, values):
+    if len(values) == 2:
+        return _divide2(scope, values[0], values[1])
+    val1 = _number(values[0])
+    if isinstance(val1, Integer) and (val1.value == 1 or val1.value == -1):
+        return make_int(1 / val1.value)
+    return Float(1.0 / val1.get_float())
+
+LESS = 0
+GREATER = 1
+LESS_EQUAL = 2
+GREATER_EQUAL = 3
+EQUAL = 4
+
+def _test_int(op, x, y):
+    if op == LESS:
+        return x < y
+    elif op == GREATER:
+        return x > y
+    elif op == LESS_EQUAL:
+        return x <= y
+    elif op == GREATER_EQUAL:
+        return x >= y
+    return x == y
+
+def _test_float(op, x, y):
+    if op == LESS:
+        return x < y
+    elif op == GREATER:
+        return x > y
+    elif op == LESS_EQUAL:
+        return x <= y
+    elif op == GREATER_EQUAL:
+        return x >= y
+    return x == y
+
+def _compare(op, val1, val2):
+    # integers are compared as integers, anything else as floats
+    if isinstance(val1, Integer) and isinstance(val2, Integer):
+        return _test_int(op, val1.value, val2.value)
+    return _test_float(op, _number(val1).get_float(), _number(val2).get_float())
+
+def make_comparison(name, op):
+    def inner_compare2(scope, val1, val2):
+        if _compare(op, val1, val2):
+            return T
+        return None
+
+    # with more arguments, each must hold against the next; all of them
+    # must be numbers, even past the first pair that doesn't
+    @function(name, 1, 0, True, binary=inner_compare2)
+    @unroll_safe
+    def inner_compare(scope, values):
+        for val in values:
+            _number(val)
+        for i in range(len(values) - 1):
+            if not _compare(op, values[i], values[i + 1]):
+                return None
+        return T
+    return inner_compare
+
+make_comparison('<', LESS)
+make_comparison('>', GREATER)
+make_comparison('<=', LESS_EQUAL)
+make_comparison('>=', GREATER_EQUAL)
+make_comparison('=', EQUAL)
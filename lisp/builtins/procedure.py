@@ -1,24 +1,151 @@
-from ..types import InvalidValue, Procedure, Cell, Symbol
-from ..eval import EvalException, eval, eval_list
-from ..scope import Scope
+from ..types import InvalidValue, Procedure, Cell, Symbol, make_int
+from ..eval import EvalException, TailCall, eval, eval_list, eval_list_tail, tail_eval, force
+from ..scope import Frame
+from ..resolver import ResolvedCell, lambda_layout, resolve_body
 
-from pypy.rlib.jit import unroll_safe, hint
+from .. import profiler
+
+from pypy.rlib.jit import JitDriver, unroll_safe, hint
+from pypy.rlib.rweakref import RWeakKeyDictionary
 
 procedures = []
 
+class Arity(object):
+    # how many arguments a procedure takes, worked out once when it's made.
+    # checking allocates nothing; the error message is only built when a
+    # check fails.
+    _immutable_fields_ = ['num_required', 'num_optional', 'use_rest']
+    def __init__(self, num_required, num_optional=0, use_rest=False):
+        self.num_required = num_required
+        self.num_optional = num_optional
+        self.use_rest = use_rest
+    
+    def accepts(self, num):
+        if num < self.num_required:
+            return False
+        return self.use_rest or num <= self.num_required + self.num_optional
+    
+    def error(self):
+        if self.use_rest:
+            return "invalid number of arguments: takes at least " + str(self.num_required)
+        if self.num_optional > 0:
+            return "invalid number of arguments: takes between " + str(self.num_required) + " and " + str(self.num_required + self.num_optional)
+        return "invalid number of arguments: takes exactly " + str(self.num_required)
+    
+    def check_count(self, num):
+        if not self.accepts(num):
+            raise EvalException(self.error())
+    
+    @unroll_safe
+    def check(self, args):
+        # walk the argument list once, so a bad call fails before any of
+        # its arguments are evaluated; returns the number of arguments
+        num_fixed = self.num_required + self.num_optional
+        count = 0
+        while args is not None:
+            if not isinstance(args, Cell):
+                raise EvalException("not a valid argument list")
+            count += 1
+            if count > num_fixed and not self.use_rest:
+                break
+            args = args.cdr
+        if count < self.num_required or (count > num_fixed and not self.use_rest):
+            raise EvalException(self.error())
+        return count
+
+@unroll_safe
+def arg(args, i):
+    # the i-th argument from a list that has already been checked
+    while i > 0:
+        assert isinstance(args, Cell)
+        args = args.cdr
+        i -= 1
+    assert isinstance(args, Cell)
+    return args.car
+
+@unroll_safe
+def args_from(args, i):
+    # the arguments from the i-th on, from a list already checked
+    while i > 0:
+        assert isinstance(args, Cell)
+        args = args.cdr
+        i -= 1
+    return args
+
 class AutoProcedure(Procedure):
-    _immutable_fields_ = ['func']
-    def __init__(self, name, func):
+    # a builtin that takes its arguments unevaluated, as the argument list
+    # of the form; the list is checked against arity before func sees it
+    _immutable_fields_ = ['func', 'arity']
+    def __init__(self, name, func, arity):
         self.func = func
+        self.arity = arity
         self.name = name
         Procedure.__init__(self, name)
     def call(self, scope, args):
+        return force(self.call_tail(scope, args))
+    def call_tail(self, scope, args):
         self = hint(self, promote=True)
+        self.arity.check(args)
         return self.func(scope, args)
 
-def procedure(name):
+class BuiltinFunction(Procedure):
+    # a builtin that always evaluates all of its arguments, in order, and
+    # takes them as a list of values. binary, if given, is used instead
+    # for calls with exactly two arguments, without building the list.
+    _immutable_fields_ = ['func', 'arity', 'binary']
+    def __init__(self, name, func, arity, binary):
+        self.func = func
+        self.arity = arity
+        self.binary = binary
+        Procedure.__init__(self, name)
+    def is_strict(self):
+        return True
+    @unroll_safe
+    def call(self, scope, args):
+        self = hint(self, promote=True)
+        num = self.arity.check(args)
+        if num == 2 and self.binary is not None:
+            assert isinstance(args, Cell)
+            rest = args.cdr
+            assert isinstance(rest, Cell)
+            val1 = eval(scope, args.car)
+            val2 = eval(scope, rest.car)
+            try:
+                return self.binary(scope, val1, val2)
+            except EvalException, e:
+                raise e.blame_argument([val1, val2], args)
+        values = []
+        forms = args
+        while args is not None:
+            assert isinstance(args, Cell)
+            values.append(eval(scope, args.car))
+            args = args.cdr
+        try:
+            return self.func(scope, values)
+        except EvalException, e:
+            raise e.blame_argument(values, forms)
+    def apply(self, scope, values):
+        self = hint(self, promote=True)
+        self.arity.check_count(len(values))
+        return self.func(scope, values)
+    def apply2(self, scope, val1, val2):
+        self = hint(self, promote=True)
+        if self.binary is not None:
+            return self.binary(scope, val1, val2)
+        return self.apply(scope, [val1, val2])
+
+def procedure(name, num_required, num_optional=0, use_rest=False):
     def register(func):
-        proc = AutoProcedure(name, func)
+        proc = AutoProcedure(name, func, Arity(num_required, num_optional, use_rest))
+        procedures.append(proc)
+        return func
+    return register
+
+def function(name, num_required, num_optional=0, use_rest=False, binary=None):
+    if binary is not None:
+        assert num_required <= 2 and (use_rest or num_required + num_optional >= 2)
+    def register(func):
+        proc = BuiltinFunction(name, func, Arity(num_required, num_optional, use_rest), binary)
         procedures.append(proc)
         return func
     return register
@@ -27,114 +154,250 @@ def register(scope):
     for proc in procedures:
         scope.set_semiconstant(proc.name, proc)
 
-@unroll_safe
-def parse_arguments(args, num_required, num_optional=0, use_rest=False):
-    required = []
-    optional = []
-    rest = []
-    
-    if use_rest:
-        errorstr = "invalid number of arguments: takes at least " + str(num_required)
-    else:
-        if num_optional > 0:
-            errorstr = "invalid number of arguments: takes between " + str(num_required) + " and " + str(num_required + num_optional)
-        else:
-            errorstr = "invalid number of arguments: takes exactly " + str(num_required)
-    
-    for _ in xrange(num_required):
-        if args is None:
-            raise EvalException(errorstr)
-        if not isinstance(args, Cell):
-            raise EvalException("not a valid argument list")
-        required.append(args.car)
-        args = args.cdr
-    
-    for _ in xrange(num_optional):
-        if args is None:
-            break
-        if not isinstance(args, Cell):
-            raise EvalException("not a valid argument list")
-        optional.append(args.car)
-        args = args.cdr
-    
-    while use_rest and (args is not None):
-        if not isinstance(args, Cell):
-            raise EvalException("not a valid argument list")
-        rest.append(args.car)
-        args = args.cdr
-    
-    if args is not None:
-        if not isinstance(args, Cell):
-            raise EvalException("not a valid argument list")
-        raise EvalException(errorstr)
-    
-    return (required, optional, rest)
+class Expansion(object):
+    # what a macro expanded to at one call site, along with whatever the
+    # compiling engines made of it
+    def __init__(self, macro, sexp):
+        self.macro = macro
+        self.sexp = sexp
+        self.nodes = None
+        self.code = None
+
+class ExpansionStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+# expansions by the argument cell of the form they came from, which is
+# unique to the call site and dies with it
+expansions = RWeakKeyDictionary(Cell, Expansion)
+expansion_stats = ExpansionStats()
 
 class LambdaProcedure(Procedure):
-    _immutable_fields_ = ['required', 'optional', 'rest', 'body', 'eval_args', 'eval_return']
-    def __init__(self, scope, required, optional, rest, body, eval_args=True, eval_return=False):
+    _immutable_fields_ = ['required', 'optional', 'rest', 'arity', 'layout', 'body', 'eval_args', 'eval_return']
+    def __init__(self, scope, required, optional, rest, layout, body, eval_args=True, eval_return=False):
         self.scope = scope
         self.required = required
         self.optional = optional
         self.rest = rest
+        self.arity = Arity(len(required), len(optional), rest is not None)
+        self.layout = layout
         self.body = body
         
         self.eval_args = eval_args
         self.eval_return = eval_return
         
+        # the body compiled by lisp.nodes, the first time it's needed
+        self.nodes = None
+        # and by lisp.compiler, for lisp.vm
+        self.code = None
+        
+        # macros whose expansion depends on more than their arguments
+        # (a gensym counter, say) must expand every time
+        self.cache_expansions = True
+        
         Procedure.__init__(self, 'nil')
     
+    def _arg(self, scope, sexp):
+        if self.eval_args:
+            return eval(scope, sexp)
+        return sexp
+    
     @unroll_safe
-    def call(self, scope, args):
-        self = hint(self, promote=True)
-        
-        reqvals, optvals, restvals = parse_arguments(args, len(self.required), len(self.optional), self.rest is not None)
-        restvals.reverse()
-        newscope = {}
-        
-        for i in range(len(self.required)):
-            if self.eval_args:
-                tmp = eval(scope, reqvals[i])
-            else:
-                tmp = reqvals[i]
-            newscope[self.required[i]] = tmp
-        for i in range(len(self.optional)):
-            if i < len(optvals):
-                if self.eval_args:
-                    tmp = eval(scope, optvals[i])
-                else:
-                    tmp = optvals[i]
-                newscope[self.optional[i]] = tmp
-            else:
-                newscope[self.optional[i]] = None
+    def _rest(self, scope, args):
+        if args is None or not self.eval_args:
+            return args
+        restvals = []
+        while args is not None:
+            assert isinstance(args, Cell)
+            restvals.append(eval(scope, args.car))
+            args = args.cdr
         rest_cell = None
-        for sexp in restvals:
-            if self.eval_args:
-                tmp = eval(scope, sexp)
-            else:
-                tmp = sexp
-            rest_cell = Cell(tmp, rest_cell)
-        if self.rest is not None:
-            newscope[self.rest] = rest_cell
+        i = len(restvals) - 1
+        while i >= 0:
+            rest_cell = Cell(restvals[i], rest_cell)
+            i -= 1
+        return rest_cell
+    
+    @unroll_safe
+    def bind(self, scope, args):
+        self.arity.check(args)
         
-        newscope_obj = Scope(self.scope)
-        for name, value in newscope.items():
-            newscope_obj.set_semiconstant(name, value, local_only=True)
-        ret = eval_list(newscope_obj, self.body)
+        # required and optional values fill the frame in order, with the
+        # rest list (if any) in the last slot
+        values = [None] * self.layout.size()
+        num_fixed = len(self.required) + len(self.optional)
+        i = 0
+        while i < num_fixed and args is not None:
+            assert isinstance(args, Cell)
+            values[i] = self._arg(scope, args.car)
+            args = args.cdr
+            i += 1
+        if self.rest is not None:
+            values[num_fixed] = self._rest(scope, args)
+        return Frame(self.scope, self.layout, values)
+    
+    @unroll_safe
+    def bind_values(self, vals):
+        num_fixed = len(self.required) + len(self.optional)
+        num = len(vals)
+        self.arity.check_count(num)
         
+        values = [None] * self.layout.size()
+        i = 0
+        while i < num_fixed and i < num:
+            values[i] = vals[i]
+            i += 1
+        if self.rest is not None:
+            rest_cell = None
+            j = num - 1
+            while j >= num_fixed:
+                rest_cell = Cell(vals[j], rest_cell)
+                j -= 1
+            values[num_fixed] = rest_cell
+        return Frame(self.scope, self.layout, values)
+    
+    def call(self, scope, args):
+        return force(self.call_tail(scope, args))
+    
+    def call_tail(self, scope, args):
+        self = hint(self, promote=True)
         if self.eval_return:
-            return eval(scope, ret)
-        return ret
+            expansion = self.cached_expansion(args)
+            if expansion is None:
+                sexp = eval_list(self.bind(scope, args), self.body)
+                expansion = self.new_expansion(args, sexp)
+            # the expansion is evaluated in the caller's scope
+            return tail_eval(scope, expansion.sexp)
+        return run_lambda(self, self.bind(scope, args))
+    
+    def cached_expansion(self, args):
+        # the expansion made last time at this call site, if it came from
+        # this same macro; redefining a macro makes a new procedure, so
+        # old expansions stop matching
+        if not self.cache_expansions or not isinstance(args, Cell):
+            return None
+        expansion = expansions.get(args)
+        if expansion is None or expansion.macro is not self:
+            return None
+        expansion_stats.hits += 1
+        return expansion
+    
+    def new_expansion(self, args, sexp):
+        expansion_stats.misses += 1
+        expansion = Expansion(self, sexp)
+        if self.cache_expansions and isinstance(args, Cell):
+            expansions.set(args, expansion)
+        return expansion
+    
+    def is_strict(self):
+        return self.eval_args and not self.eval_return
+    
+    def source(self):
+        # enough of the original form to recognise an unnamed lambda by
+        names = self.required
+        if len(self.optional) > 0:
+            names = names + ['&optional'] + self.optional
+        if self.rest is not None:
+            names = names + ['&rest', self.rest]
+        head = "lambda"
+        if self.eval_return:
+            head = "macro"
+        ret = "(" + head + " (" + " ".join(names) + ")"
+        if len(self.body) > 0:
+            first = self.body[0]
+            if first is None:
+                ret += " nil"
+            else:
+                ret += " " + first.unparse()
+            if len(ret) > 60:
+                ret = ret[:57] + "..."
+        return ret + ")"
+    
+    def profile_name(self):
+        name = self.name
+        if name == 'nil':
+            name = self.source()
+        if self.eval_return:
+            # only the expansion happens inside the call
+            return "expand " + name
+        return name
+    
+    def apply(self, scope, values):
+        self = hint(self, promote=True)
+        if not self.is_strict():
+            return Procedure.apply(self, scope, values)
+        return force(run_lambda(self, self.bind_values(values)))
+
+def get_lambda_location(proc):
+    return proc.profile_name()
+lambdadriver = JitDriver(greens=['proc'], reds=['frame', 'form'], get_printable_location=get_lambda_location)
+
+def _tail_lambda(ret):
+    # the strict lambda a tail call is to, if its head is a plain symbol
+    # (so looking it up here as well as in eval can't do any harm)
+    if profiler.state.profiler is not None:
+        return None
+    sexp = ret.sexp
+    assert isinstance(sexp, Cell)
+    if not isinstance(sexp.car, Symbol):
+        return None
+    try:
+        function = eval(ret.scope, sexp.car)
+    except EvalException:
+        return None
+    if isinstance(function, LambdaProcedure) and function.is_strict():
+        return function
+    return None
+
+def run_lambda(proc, frame):
+    # runs the body of a lambda. a tail call to another strict lambda
+    # (or the same one) carries on around this loop instead of going
+    # back out to eval, so tail recursion is a loop as far as the JIT
+    # can see; form is the tail call that got us here, if any
+    form = None
+    while True:
+        lambdadriver.jit_merge_point(proc=proc, frame=frame, form=form)
+        try:
+            ret = eval_list_tail(frame, proc.body)
+        except EvalException, e:
+            if form is not None:
+                e = e.propogate(form)
+            raise e
+        if not isinstance(ret, TailCall):
+            return ret
+        function = _tail_lambda(ret)
+        if function is None:
+            return ret
+        form = ret.sexp
+        assert isinstance(form, Cell)
+        try:
+            frame = function.bind(ret.scope, form.cdr)
+        except EvalException, e:
+            raise e.propogate(form)
+        proc = function
+        lambdadriver.can_enter_jit(proc=proc, frame=frame, form=form)
+
+def name_procedure(value, name):
+    # a lambda is known by the first name it's stored under
+    if isinstance(value, LambdaProcedure) and value.name == 'nil':
+        value.name = name
 
 @unroll_safe
 def _l_lambda_macro(scope, args, eval_args, eval_return):
-    req, _, rest = parse_arguments(args, 1, 0, True)
-    if not isinstance(req[0], Cell):
+    arglist = arg(args, 0)
+    if not isinstance(arglist, Cell):
         raise EvalException("not a valid argument list")
     try:
-        argnames = req[0].to_list()
+        argnames = arglist.to_list()
     except InvalidValue:
         raise EvalException("not a valid argument list")
+    rest = []
+    body = args_from(args, 1)
+    while body is not None:
+        assert isinstance(body, Cell)
+        rest.append(body.car)
+        body = body.cdr
     
     phase = 0
     required = []
@@ -169,12 +432,32 @@ def _l_lambda_macro(scope, args, eval_args, eval_return):
         else:
             restname = name
         
-    return LambdaProcedure(scope, required, optional, restname, rest, eval_args, eval_return)
+    
+    if isinstance(arglist, ResolvedCell):
+        # already resolved as part of an enclosing body
+        layout = arglist.layout
+        body = rest
+    else:
+        layout = lambda_layout(required, optional, restname)
+        body = resolve_body(rest, layout, scope)
+    return LambdaProcedure(scope, required, optional, restname, layout, body, eval_args, eval_return)
 
-@procedure('lambda')
+@procedure('lambda', 1, 0, True)
 def l_lambda(scope, args):
     return _l_lambda_macro(scope, args, True, False)
 
-@procedure('macro')
+@procedure('macro', 1, 0, True)
 def l_lambda(scope, args):
     return _l_lambda_macro(scope, args, False, True)
+
+@function('volatile-macro', 1)
+def l_volatile_macro(scope, values):
+    proc = values[0]
+    if not isinstance(proc, LambdaProcedure) or not proc.eval_return:
+        raise EvalException("value is not a macro", proc)
+    proc.cache_expansions = False
+    return proc
+
+@function('macro-cache-stats', 0)
+def l_macro_cache_stats(scope, values):
+    return Cell(make_int(expansion_stats.hits), Cell(make_int(expansion_stats.misses)))
@@ -0,0 +1,24 @@
+from .procedure import procedure, arg
+from ..types import Cell, String, Float, make_int
+from ..eval import eval
+from .. import profiler
+
+@procedure('profile', 1)
+def l_profile(scope, args):
+    # evaluates its argument with a profiler of its own, and returns
+    # ((name calls self-time cumulative-time) ...), slowest first
+    previous = profiler.state.profiler
+    profiling = profiler.start()
+    try:
+        eval(scope, arg(args, 0))
+    finally:
+        profiler.stop(previous)
+    entries = profiling.sorted_entries()
+    ret = None
+    i = len(entries) - 1
+    while i >= 0:
+        entry = entries[i]
+        times = Cell(Float(entry.self_time), Cell(Float(entry.total_time)))
+        ret = Cell(Cell(String(entry.name), Cell(make_int(entry.calls), times)), ret)
+        i -= 1
+    return ret
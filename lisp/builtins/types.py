@@ -1,14 +1,13 @@
-from .procedure import procedure, parse_arguments
-from ..types import BoxedType, Cell, Symbol, String, Number, Integer, Float, Procedure
-from ..eval import EvalException, eval
+from .procedure import function
+from ..types import BoxedType, Cell, Symbol, String, Number, Integer, Float, Procedure, Vector, HashTable, T, make_int, is_list, eq_values
+from ..eval import EvalException
+from ..ports import OutputPort, InputPort
 
 def make_checker(name, typ):
-    @procedure(name + '-p')
-    def inner_checker(scope, args):
-        req, _, _ = parse_arguments(args, 1)
-        val = eval(scope, req[0])
-        if isinstance(val, typ):
-            return Symbol('t')
+    @function(name + '-p', 1)
+    def inner_checker(scope, values):
+        if isinstance(values[0], typ):
+            return T
         return None
     return inner_checker
 
@@ -20,47 +19,145 @@ make_checker('number', Number)
 make_checker('integer', Integer)
 make_checker('float', Float)
 make_checker('procedure', Procedure)
+make_checker('vector', Vector)
+make_checker('hash-table', HashTable)
+make_checker('output-port', OutputPort)
+make_checker('input-port', InputPort)
 
-@procedure('nil-p')
-def l_nil_p(scope, args):
-    req, _, _ = parse_arguments(args, 1)
-    val = eval(scope, req[0])
-    if val is None:
-        return Symbol('t')
+@function('nil-p', 1)
+def l_nil_p(scope, values):
+    if values[0] is None:
+        return T
     return None
 
-@procedure('cons')
-def l_cons(scope, args):
-    req, _, _ = parse_arguments(args, 2)
-    val1 = eval(scope, req[0])
-    val2 = eval(scope, req[1])
-    return Cell(val1, val2)
-
-@procedure('car')
-def l_car(scope, args):
-    req, _, _ = parse_arguments(args, 1)
-    val = eval(scope, req[0])
+@function('cons', 2)
+def l_cons(scope, values):
+    return Cell(values[0], values[1])
+
+@function('car', 1)
+def l_car(scope, values):
+    val = values[0]
     if not isinstance(val, Cell):
-        raise EvalException("value not a cell", req[0])
+        raise EvalException("value not a cell", val)
     return val.car
 
-@procedure('cdr')
-def l_cdr(scope, args):
-    req, _, _ = parse_arguments(args, 1)
-    val = eval(scope, req[0])
+@function('cdr', 1)
+def l_cdr(scope, values):
+    val = values[0]
     if not isinstance(val, Cell):
-        raise EvalException("value not a cell", req[0])
+        raise EvalException("value not a cell", val)
     return val.cdr
 
-@procedure('eq')
-def l_eq(scope, args):
-    req, _, _ = parse_arguments(args, 2)
-    val1 = eval(scope, req[0])
-    val2 = eval(scope, req[1])
-    if val1 is None:
-        if val2 is None:
-            return Symbol('t')
+@function('eq', 2)
+def l_eq(scope, values):
+    if eq_values(values[0], values[1]):
+        return T
+    return None
+
+@function('list-p', 1)
+def l_list_p(scope, values):
+    if is_list(values[0]):
+        return T
+    return None
+
+@function('length', 1)
+def l_length(scope, values):
+    val = values[0]
+    count = 0
+    while isinstance(val, Cell):
+        count += 1
+        val = val.cdr
+    if val is not None:
+        raise EvalException("argument is not a list", values[0])
+    return make_int(count)
+
+def _rebuild(items, tail):
+    i = len(items) - 1
+    while i >= 0:
+        tail = Cell(items[i], tail)
+        i -= 1
+    return tail
+
+@function('append', 0, 0, True)
+def l_append(scope, values):
+    if len(values) == 0:
+        return None
+    # every list but the last is copied; the last becomes the shared tail
+    items = []
+    for i in range(len(values) - 1):
+        val = values[i]
+        while isinstance(val, Cell):
+            items.append(val.car)
+            val = val.cdr
+        if val is not None:
+            raise EvalException("argument is not a list", values[i])
+    return _rebuild(items, values[len(values) - 1])
+
+@function('reverse', 1)
+def l_reverse(scope, values):
+    val = values[0]
+    ret = None
+    while isinstance(val, Cell):
+        ret = Cell(val.car, ret)
+        val = val.cdr
+    if val is not None:
+        raise EvalException("argument is not a list", values[0])
+    return ret
+
+@function('nth', 2)
+def l_nth(scope, values):
+    n = values[0]
+    if not isinstance(n, Integer) or n.value < 0:
+        raise EvalException("index is not a non-negative integer", n)
+    val = values[1]
+    i = n.value
+    while isinstance(val, Cell):
+        if i == 0:
+            return val.car
+        i -= 1
+        val = val.cdr
+    if val is not None:
+        raise EvalException("argument is not a list", values[1])
+    return None
+
+@function('last', 1)
+def l_last(scope, values):
+    # the last cell of the list, not its last element
+    val = values[0]
+    if val is None:
         return None
-    if val1.eq(val2):
-        return Symbol('t')
+    if not isinstance(val, Cell):
+        raise EvalException("argument is not a list", val)
+    while True:
+        rest = val.cdr
+        if not isinstance(rest, Cell):
+            return val
+        val = rest
+
+@function('assoc', 2)
+def l_assoc(scope, values):
+    key = values[0]
+    alist = values[1]
+    while isinstance(alist, Cell):
+        pair = alist.car
+        if pair is not None:
+            if not isinstance(pair, Cell):
+                raise EvalException("association list entry is not a cell", pair)
+            if eq_values(key, pair.car):
+                return pair
+        alist = alist.cdr
+    if alist is not None:
+        raise EvalException("argument is not a list", values[1])
+    return None
+
+@function('member', 2)
+def l_member(scope, values):
+    item = values[0]
+    val = values[1]
+    while isinstance(val, Cell):
+        if eq_values(item, val.car):
+            return val
+        val = val.cdr
+    if val is not None:
+        raise EvalException("argument is not a list", values[1])
     return None
@@ -0,0 +1,176 @@
+from .procedure import function
+from ..types import InvalidValue, Number, Integer, Float, Procedure, Vector, IntVector, FloatVector, make_int
+from ..eval import EvalException
+
+def _vector(val):
+    if not isinstance(val, Vector):
+        raise EvalException("value is not a vector", val)
+    return val
+
+def _index(vector, val):
+    if not isinstance(val, Integer):
+        raise EvalException("index is not an integer", val)
+    if val.value < 0 or val.value >= vector.length():
+        raise EvalException("index out of range", val)
+    return val.value
+
+def _pair(values):
+    a = _vector(values[0])
+    b = _vector(values[1])
+    if a.length() != b.length():
+        raise EvalException("vectors are not the same length")
+    return a, b
+
+def _from_numbers(nums):
+    # an int vector if every number is an integer, else a float vector
+    use_float = False
+    for val in nums:
+        if not isinstance(val, Number):
+            raise EvalException("value not a number", val)
+        if isinstance(val, Float):
+            use_float = True
+    if use_float:
+        floats = [0.0] * len(nums)
+        for i in range(len(nums)):
+            val = nums[i]
+            assert isinstance(val, Number)
+            floats[i] = val.get_float()
+        return FloatVector(floats)
+    ints = [0] * len(nums)
+    for i in range(len(nums)):
+        val = nums[i]
+        assert isinstance(val, Integer)
+        ints[i] = val.value
+    return IntVector(ints)
+
+@function('make-vector', 1, 1)
+def l_make_vector(scope, values):
+    size = values[0]
+    if not isinstance(size, Integer) or size.value < 0:
+        raise EvalException("size is not a non-negative integer", size)
+    init = make_int(0)
+    if len(values) > 1:
+        init = values[1]
+    if isinstance(init, Integer):
+        return IntVector([init.value] * size.value)
+    if isinstance(init, Float):
+        return FloatVector([init.value] * size.value)
+    raise EvalException("value not a number", init)
+
+@function('vector', 0, 0, True)
+def l_vector(scope, values):
+    return _from_numbers(values)
+
+@function('vector-length', 1)
+def l_vector_length(scope, values):
+    return make_int(_vector(values[0]).length())
+
+@function('vector-ref', 2)
+def l_vector_ref(scope, values):
+    vector = _vector(values[0])
+    return vector.ref(_index(vector, values[1]))
+
+@function('vector-set!', 3)
+def l_vector_set(scope, values):
+    vector = _vector(values[0])
+    i = _index(vector, values[1])
+    try:
+        vector.set(i, values[2])
+    except InvalidValue, e:
+        raise EvalException(e.message, values[2])
+    return values[2]
+
+@function('v+', 2)
+def l_v_add(scope, values):
+    a, b = _pair(values)
+    n = a.length()
+    if isinstance(a, IntVector) and isinstance(b, IntVector):
+        ints = [0] * n
+        for i in range(n):
+            ints[i] = a.values[i] + b.values[i]
+        return IntVector(ints)
+    af = a.floats()
+    bf = b.floats()
+    floats = [0.0] * n
+    for i in range(n):
+        floats[i] = af[i] + bf[i]
+    return FloatVector(floats)
+
+@function('v*', 2)
+def l_v_multiply(scope, values):
+    a, b = _pair(values)
+    n = a.length()
+    if isinstance(a, IntVector) and isinstance(b, IntVector):
+        ints = [0] * n
+        for i in range(n):
+            ints[i] = a.values[i] * b.values[i]
+        return IntVector(ints)
+    af = a.floats()
+    bf = b.floats()
+    floats = [0.0] * n
+    for i in range(n):
+        floats[i] = af[i] * bf[i]
+    return FloatVector(floats)
+
+@function('v-scale', 2)
+def l_v_scale(scope, values):
+    vector = _vector(values[0])
+    k = values[1]
+    if not isinstance(k, Number):
+        raise EvalException("value not a number", k)
+    n = vector.length()
+    if isinstance(vector, IntVector) and isinstance(k, Integer):
+        ints = [0] * n
+        for i in range(n):
+            ints[i] = vector.values[i] * k.value
+        return IntVector(ints)
+    kf = k.get_float()
+    vf = vector.floats()
+    floats = [0.0] * n
+    for i in range(n):
+        floats[i] = vf[i] * kf
+    return FloatVector(floats)
+
+@function('v-dot', 2)
+def l_v_dot(scope, values):
+    a, b = _pair(values)
+    if isinstance(a, IntVector) and isinstance(b, IntVector):
+        total = 0
+        for i in range(a.length()):
+            total += a.values[i] * b.values[i]
+        return make_int(total)
+    af = a.floats()
+    bf = b.floats()
+    total_float = 0.0
+    for i in range(a.length()):
+        total_float += af[i] * bf[i]
+    return Float(total_float)
+
+@function('v-sum', 1)
+def l_v_sum(scope, values):
+    vector = _vector(values[0])
+    if isinstance(vector, IntVector):
+        total = 0
+        for x in vector.values:
+            total += x
+        return make_int(total)
+    total_float = 0.0
+    for x in vector.floats():
+        total_float += x
+    return Float(total_float)
+
+@function('v-map', 2)
+def l_v_map(scope, values):
+    proc = values[0]
+    if not isinstance(proc, Procedure):
+        raise EvalException("value is not a procedure", proc)
+    vector = _vector(values[1])
+    if vector.length() == 0:
+        # nothing to decide the kind by, so it stays what it was
+        if isinstance(vector, FloatVector):
+            return FloatVector([])
+        return IntVector([])
+    results = [None] * vector.length()
+    for i in range(vector.length()):
+        results[i] = proc.apply(scope, [vector.ref(i)])
+    return _from_numbers(results)
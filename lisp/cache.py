@@ -0,0 +1,132 @@
+import os
+import stat
+
+from pypy.rlib import rsha
+
+from .image import encode_forms, decode_forms, read_fd, write_file, ImageError
+from .parser import FileReader
+
+# parsed source files, kept on disk under the hash of their contents,
+# so running an unchanged file again skips the reader entirely. bump
+# VERSION whenever the reader changes what it makes of a file.
+
+VERSION = "2"
+SUFFIX = ".forms"
+
+# only regular files this size or smaller are cached. a cached file is
+# read twice when it misses, once to hash it, and its forms are all kept
+# until it has been read; bigger files, and pipes or terminals, are
+# streamed from disk as usual and never cached.
+MAX_FILE_SIZE = 1024 * 1024
+
+def default_directory():
+    # None if there's nowhere sensible to put it
+    path = os.environ.get('LISPLISP_CACHE')
+    if path:
+        return path
+    path = os.environ.get('XDG_CACHE_HOME')
+    if path:
+        return path + '/lisplisp'
+    path = os.environ.get('HOME')
+    if path:
+        return path + '/.cache/lisplisp'
+    return None
+
+def _make_directories(path):
+    i = 1
+    while i <= len(path):
+        if i == len(path) or path[i] == '/':
+            try:
+                os.mkdir(path[:i], 0755)
+            except OSError:
+                pass
+        i += 1
+
+class FormCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def new_hash(self):
+        return rsha.new(VERSION + "\0")
+
+    def wants(self, fd):
+        st = os.fstat(fd)
+        return stat.S_ISREG(st.st_mode) and st.st_size <= MAX_FILE_SIZE
+
+    def key_fd(self, fd):
+        # the key for what's in fd, which is left at the start again
+        sha = self.new_hash()
+        while True:
+            chunk = os.read(fd, FileReader.chunk_size)
+            if len(chunk) == 0:
+                break
+            sha.update(chunk)
+        os.lseek(fd, 0, 0)
+        return sha.hexdigest()
+
+    def path(self, key):
+        return self.directory + '/' + key + SUFFIX
+
+    def load(self, key):
+        # the cached forms, or None if there aren't any we can use
+        try:
+            fd = os.open(self.path(key), os.O_RDONLY, 0777)
+        except OSError:
+            return None
+        try:
+            data = read_fd(fd)
+        except OSError:
+            os.close(fd)
+            return None
+        os.close(fd)
+        try:
+            return decode_forms(data)
+        except ImageError:
+            return None
+
+    def store(self, key, sexps):
+        # written to a temporary file and renamed into place, so no other
+        # run ever sees half of one. failing to write is not an error.
+        path = self.path(key)
+        tmp = path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            _make_directories(self.directory)
+            write_file(tmp, encode_forms(sexps))
+            os.rename(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def purge(self):
+        # removes every cached file; returns how many there were
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+        count = 0
+        for name in names:
+            if not name.endswith(SUFFIX) and not name.endswith('.tmp'):
+                continue
+            try:
+                os.unlink(self.directory + '/' + name)
+                count += 1
+            except OSError:
+                pass
+        return count
+
+class HashingFileReader(FileReader):
+    # a FileReader that hashes everything it reads, so forms are only
+    # stored under the key of the data they were actually read from
+    def __init__(self, fd, cache):
+        FileReader.__init__(self, fd)
+        self.sha = cache.new_hash()
+
+    def read_chunk(self, size):
+        chunk = FileReader.read_chunk(self, size)
+        self.sha.update(chunk)
+        return chunk
+
+    def key(self):
+        return self.sha.hexdigest()
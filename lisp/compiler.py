@@ -0,0 +1,358 @@
+from .types import Cell, Symbol, T
+from .scope import frame_layouts
+from .resolver import LexicalSymbol, ResolvedCell, resolve
+from .specials import find_special, arg_list
+
+# lowers resolved forms to bytecode for lisp.vm. every instruction is
+# three ints: an opcode and two arguments, most of which index into one
+# of the Code object's tables.
+
+LOAD_CONST = 0          # push consts[a]
+LOAD_LOCAL = 1          # push the value of lexical symbol consts[a]
+LOAD_GLOBAL = 2         # push the value of non-lexical symbol consts[a]
+STORE = 3               # store the top of the stack in symbol consts[a]
+POP = 4
+JUMP = 5                # jump to a
+JUMP_IF_NIL = 6         # pop, and jump to a if it was nil
+JUMP_IF_NIL_KEEP = 7    # jump to a if the top is nil, else pop it
+JUMP_IF_TRUE_KEEP = 8   # jump to a if the top isn't nil, else pop it
+GUARD = 9               # if symbol guards[a] no longer names its builtin,
+                        # push the result of evaluating the form and jump to b
+CALL_PREPARE = 10       # if the procedure on top won't take values, call
+                        # it with the raw arguments of its form and jump to b
+CALL_FORM = 11          # call the procedure on top with the raw arguments
+                        # of its form
+CALL = 12               # call with a arguments from the stack
+TAIL_CALL = 13          # same, but replacing the current frame
+RETURN = 14
+PUSH_FRAME = 15         # pop b values into a new frame with layouts[a]
+POP_FRAME = 16
+MAKE_CLOSURE = 17       # build the lambda or macro in closures[a]
+DOLIST_START = 18       # fail unless the top of the stack is a list
+DOLIST_NEXT = 19        # jump to a if the list on top is empty, else replace
+                        # it with its cdr and push its car
+
+opnames = [
+    'LOAD_CONST', 'LOAD_LOCAL', 'LOAD_GLOBAL', 'STORE', 'POP', 'JUMP',
+    'JUMP_IF_NIL', 'JUMP_IF_NIL_KEEP', 'JUMP_IF_TRUE_KEEP', 'GUARD',
+    'CALL_PREPARE', 'CALL_FORM', 'CALL', 'TAIL_CALL', 'RETURN',
+    'PUSH_FRAME', 'POP_FRAME', 'MAKE_CLOSURE', 'DOLIST_START', 'DOLIST_NEXT',
+]
+
+def _pad(s, width, right):
+    if len(s) >= width:
+        return s
+    if right:
+        return ' ' * (width - len(s)) + s
+    return s + ' ' * (width - len(s))
+
+class Guard(object):
+    _immutable_fields_ = ['symbol', 'builtin', 'form']
+    def __init__(self, symbol, builtin, form):
+        self.symbol = symbol
+        self.builtin = builtin
+        self.form = form
+
+class Closure(object):
+    # what MAKE_CLOSURE needs: the builtin to build the procedure with,
+    # the (args . body) it takes, and the body already compiled
+    _immutable_fields_ = ['builtin', 'args', 'code']
+    def __init__(self, builtin, args, code):
+        self.builtin = builtin
+        self.args = args
+        self.code = code
+
+class Code(object):
+    _immutable_fields_ = ['name', 'ops[*]', 'forms[*]', 'consts[*]', 'guards[*]', 'layouts[*]', 'closures[*]', 'stack_size']
+    def __init__(self, name, ops, forms, consts, guards, layouts, closures, stack_size):
+        self.name = name
+        self.ops = ops[:]
+        self.forms = forms[:]
+        self.consts = consts[:]
+        self.guards = guards[:]
+        self.layouts = layouts[:]
+        self.closures = closures[:]
+        self.stack_size = stack_size
+
+    def _describe(self, op, a):
+        if op == LOAD_CONST or op == LOAD_LOCAL or op == LOAD_GLOBAL or op == STORE:
+            const = self.consts[a]
+            if const is None:
+                return 'nil'
+            return const.unparse()
+        elif op == GUARD:
+            return self.guards[a].symbol.name
+        elif op == PUSH_FRAME:
+            return ' '.join(self.layouts[a].names)
+        return ''
+
+    def disassemble(self):
+        ret = "code for " + self.name + ":\n"
+        pc = 0
+        while pc < len(self.ops):
+            op = self.ops[pc]
+            a = self.ops[pc + 1]
+            b = self.ops[pc + 2]
+            line = _pad(str(pc), 6, True) + " " + _pad(opnames[op], 18, False) + _pad(str(a), 4, True) + " " + _pad(str(b), 4, True)
+            desc = self._describe(op, a)
+            if desc != '':
+                line += "  (" + desc + ")"
+            ret += line + "\n"
+            pc += 3
+        for closure in self.closures:
+            ret += "\n" + closure.code.disassemble()
+        return ret
+
+class Compiler(object):
+    def __init__(self, name):
+        self.name = name
+        self.ops = []
+        self.forms = []
+        self.consts = []
+        self.guards = []
+        self.layouts = []
+        self.closures = []
+        # the forms the next instruction is part of, innermost first
+        self.enclosing = []
+        self.depth = 0
+        self.max_depth = 0
+
+    def finish(self):
+        return Code(self.name, self.ops, self.forms, self.consts, self.guards,
+                    self.layouts, self.closures, self.max_depth)
+
+    def emit(self, op, a=0, b=0, effect=0):
+        pos = len(self.ops)
+        self.ops.append(op)
+        self.ops.append(a)
+        self.ops.append(b)
+        self.forms.append(self.enclosing)
+        self.depth += effect
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+        return pos
+
+    def here(self):
+        return len(self.ops)
+
+    def patch(self, pos, index, target):
+        self.ops[pos + index] = target
+
+    def const(self, value):
+        self.consts.append(value)
+        return len(self.consts) - 1
+
+    def ret(self, tail):
+        if tail:
+            self.emit(RETURN, effect=-1)
+
+    def expr(self, sexp, tail):
+        if isinstance(sexp, LexicalSymbol) and sexp.slot >= 0:
+            self.emit(LOAD_LOCAL, self.const(sexp), effect=1)
+        elif isinstance(sexp, Symbol):
+            self.emit(LOAD_GLOBAL, self.const(sexp), effect=1)
+        elif not isinstance(sexp, Cell):
+            self.emit(LOAD_CONST, self.const(sexp), effect=1)
+        else:
+            self.form(sexp, tail)
+            return
+        self.ret(tail)
+
+    def body(self, sexps, tail):
+        if len(sexps) == 0:
+            self.expr(None, tail)
+            return
+        for i in range(len(sexps) - 1):
+            self.expr(sexps[i], False)
+            self.emit(POP, effect=-1)
+        self.expr(sexps[len(sexps) - 1], tail)
+
+    def form(self, sexp, tail):
+        assert isinstance(sexp, Cell)
+        outer = self.enclosing
+        self.enclosing = [sexp] + outer
+        self.form_inner(sexp, tail)
+        self.enclosing = outer
+
+    def form_inner(self, sexp, tail):
+        head = sexp.car
+        args = arg_list(sexp.cdr)
+        if isinstance(head, Symbol) and args is not None:
+            local = isinstance(head, LexicalSymbol) and head.slot >= 0
+            builtin = find_special(head.name)
+            if builtin is not None and not local and self.can_special(head.name, args):
+                base = self.depth
+                guard = Guard(head, builtin, sexp)
+                self.guards.append(guard)
+                pos = self.emit(GUARD, len(self.guards) - 1, 0)
+                self.special(head.name, builtin, sexp, args, tail)
+                self.patch(pos, 2, self.here())
+                self.depth = base + 1
+                self.ret(tail)
+                return
+        self.call(sexp, args, tail)
+
+    def call(self, sexp, args, tail):
+        assert isinstance(sexp, Cell)
+        self.expr(sexp.car, False)
+        if args is None:
+            self.emit(CALL_FORM)
+            self.ret(tail)
+            return
+        base = self.depth
+        pos = self.emit(CALL_PREPARE)
+        for arg in args:
+            self.expr(arg, False)
+        if tail:
+            self.emit(TAIL_CALL, len(args), effect=-len(args))
+        else:
+            self.emit(CALL, len(args), effect=-len(args))
+        self.patch(pos, 2, self.here())
+        self.depth = base
+        self.ret(tail)
+
+    def can_special(self, name, args):
+        # the same shape checks the builtins make; anything else is
+        # compiled as a normal call, so the builtin reports the error
+        if name == 'quote':
+            return len(args) == 1
+        elif name == 'if':
+            return len(args) >= 2
+        elif name == 'let' or name == 'dolist' or name == 'lambda' or name == 'macro':
+            return len(args) >= 1 and isinstance(args[0], ResolvedCell)
+        elif name == 'while':
+            return len(args) >= 1
+        elif name == 'setq':
+            if len(args) % 2 != 0:
+                return False
+            i = 0
+            while i < len(args):
+                if not isinstance(args[i], Symbol):
+                    return False
+                i += 2
+        return True
+
+    def special(self, name, builtin, sexp, args, tail):
+        if name == 'quote':
+            self.emit(LOAD_CONST, self.const(args[0]), effect=1)
+            self.ret(tail)
+        elif name == 'if':
+            self.expr(args[0], False)
+            jump_else = self.emit(JUMP_IF_NIL, effect=-1)
+            base = self.depth
+            self.expr(args[1], tail)
+            jump_end = -1
+            if not tail:
+                jump_end = self.emit(JUMP)
+            self.patch(jump_else, 1, self.here())
+            self.depth = base
+            self.body(args[2:], tail)
+            if jump_end >= 0:
+                self.patch(jump_end, 1, self.here())
+        elif name == 'begin':
+            self.body(args, tail)
+        elif name == 'and' or name == 'or':
+            if len(args) == 0:
+                if name == 'and':
+                    self.emit(LOAD_CONST, self.const(T), effect=1)
+                else:
+                    self.emit(LOAD_CONST, self.const(None), effect=1)
+                self.ret(tail)
+                return
+            if name == 'and':
+                jump_op = JUMP_IF_NIL_KEEP
+            else:
+                jump_op = JUMP_IF_TRUE_KEEP
+            jumps = []
+            for i in range(len(args) - 1):
+                self.expr(args[i], False)
+                jumps.append(self.emit(jump_op, effect=-1))
+            self.expr(args[len(args) - 1], tail)
+            for pos in jumps:
+                self.patch(pos, 1, self.here())
+            self.ret(tail)
+        elif name == 'let':
+            bindings = args[0]
+            assert isinstance(bindings, ResolvedCell)
+            values = arg_list(bindings)
+            for binding in values:
+                assert isinstance(binding, Cell)
+                value = binding.cdr
+                assert isinstance(value, Cell)
+                self.expr(value.car, False)
+            self.layouts.append(bindings.layout)
+            self.emit(PUSH_FRAME, len(self.layouts) - 1, len(values), effect=-len(values))
+            self.body(args[1:], tail)
+            if not tail:
+                self.emit(POP_FRAME)
+        elif name == 'while':
+            top = self.here()
+            self.expr(args[0], False)
+            jump_end = self.emit(JUMP_IF_NIL, effect=-1)
+            for sexp in args[1:]:
+                self.expr(sexp, False)
+                self.emit(POP, effect=-1)
+            self.emit(JUMP, top)
+            self.patch(jump_end, 1, self.here())
+            self.expr(None, tail)
+        elif name == 'dolist':
+            binding = args[0]
+            assert isinstance(binding, ResolvedCell)
+            symbol = binding.car
+            assert isinstance(symbol, Symbol)
+            parts = binding.cdr
+            assert isinstance(parts, Cell)
+            # the list stays on the stack under the loop
+            self.expr(parts.car, False)
+            self.emit(DOLIST_START)
+            self.emit(LOAD_CONST, self.const(None), effect=1)
+            self.layouts.append(binding.layout)
+            self.emit(PUSH_FRAME, len(self.layouts) - 1, 1, effect=-1)
+            var = LexicalSymbol(symbol.name, 0, 0, [binding.layout])
+            top = self.emit(DOLIST_NEXT, effect=1)
+            self.emit(STORE, self.const(var))
+            self.emit(POP, effect=-1)
+            for sexp in args[1:]:
+                self.expr(sexp, False)
+                self.emit(POP, effect=-1)
+            self.emit(JUMP, top)
+            self.patch(top, 1, self.here())
+            self.emit(POP, effect=-1)
+            result = None
+            if parts.cdr is not None:
+                rest = parts.cdr
+                assert isinstance(rest, Cell)
+                result = rest.car
+            self.expr(result, tail)
+            if not tail:
+                self.emit(POP_FRAME)
+        elif name == 'setq':
+            if len(args) == 0:
+                self.expr(None, tail)
+                return
+            i = 0
+            while i < len(args):
+                if i > 0:
+                    self.emit(POP, effect=-1)
+                self.expr(args[i + 1], False)
+                self.emit(STORE, self.const(args[i]))
+                i += 2
+            self.ret(tail)
+        elif name == 'lambda' or name == 'macro':
+            code = compile_body(args[1:], 'lambda')
+            self.closures.append(Closure(builtin, sexp.cdr, code))
+            self.emit(MAKE_CLOSURE, len(self.closures) - 1, effect=1)
+            self.ret(tail)
+
+def compile_body(sexps, name):
+    compiler = Compiler(name)
+    compiler.body(sexps, True)
+    return compiler.finish()
+
+def compiled_code(proc):
+    if proc.code is None:
+        proc.code = compile_body(proc.body, 'lambda')
+    return proc.code
+
+def compile_form(scope, sexp):
+    return compile_body([resolve(sexp, frame_layouts(scope), scope)], 'toplevel')
@@ -1,9 +1,11 @@
-from .types import Cell, Symbol, Procedure
+from .types import LispType, Cell, Symbol, Procedure
 from .scope import NameNotSet
+from .resolver import LexicalSymbol
+from . import profiler
 
 from pypy.rlib.jit import JitDriver, unroll_safe, hint
 
-def get_location(i, sexps_len, sexps):
+def get_location(i, sexps_len, tail, sexps):
     j = 0
     ret = ""
     while j < sexps_len:
@@ -20,79 +22,214 @@ def get_location(i, sexps_len, sexps):
             ret += " "
         j += 1
     return ret
-jitdriver = JitDriver(greens=['i', 'sexps_len', 'sexps'], reds=['scope'], get_printable_location=get_location)
+jitdriver = JitDriver(greens=['i', 'sexps_len', 'tail', 'sexps'], reds=['ret', 'scope'], get_printable_location=get_location)
+
+# at most this many forms are kept in a trace, innermost first; the rest
+# are only counted
+TRACE_LIMIT = 200
+
+class TraceState(object):
+    # off while running the body of a catch whose handler doesn't want
+    # the trace, so throwing out of it records nothing
+    def __init__(self):
+        self.enabled = True
+
+tracing = TraceState()
 
 class EvalException(Exception):
     def __init__(self, message, sexp=None):
         self.message = message
-        self.trace = []
+        # allocated with the first form, so an untraced exception is
+        # just its message
+        self.trace = None
+        self.omitted = 0
         if sexp is not None:
-            self.trace.append(sexp)
+            self.propogate(sexp)
         #Exception.__init__(self, message)
     def propogate(self, sexp):
-        self.trace.append(sexp)
+        if not tracing.enabled:
+            return self
+        if self.trace is None:
+            self.trace = []
+        if len(self.trace) < TRACE_LIMIT:
+            self.trace.append(sexp)
+        else:
+            self.omitted += 1
+        return self
+    
+    @unroll_safe
+    def blame_argument(self, values, args):
+        # builtins name a bad argument by its value; if that's all the
+        # trace has, the form in args that produced it says more
+        if self.trace is None or len(self.trace) != 1:
+            return self
+        culprit = self.trace[0]
+        i = 0
+        while isinstance(args, Cell) and i < len(values):
+            if values[i] is culprit:
+                self.trace[0] = args.car
+                break
+            args = args.cdr
+            i += 1
         return self
     
+    def trace_list(self):
+        # the trace as a lisp list, innermost form first
+        ret = None
+        if self.trace is not None:
+            i = len(self.trace) - 1
+            while i >= 0:
+                ret = Cell(self.trace[i], ret)
+                i -= 1
+        return ret
+    
     def pretty_print(self):
         print ""
         print "*** Exception:"
         print ""
-        i = len(self.trace) - 1
-        while i >= 0:
-            sexp = self.trace[i]
-            if sexp is None:
-                print 'nil'
-            else:
-                print sexp.unparse()
-            i -= 1
+        if self.omitted > 0:
+            print "... " + str(self.omitted) + " more"
+        if self.trace is not None:
+            i = len(self.trace) - 1
+            while i >= 0:
+                sexp = self.trace[i]
+                if sexp is None:
+                    print 'nil'
+                else:
+                    print sexp.unparse()
+                i -= 1
         print ""
         print "***", self.message
 
-def eval(scope, sexp):
+class TailCall(LispType):
+    # returned from Procedure.call_tail instead of a value, when all
+    # that's left to do is evaluate sexp in scope; eval picks it up and
+    # loops rather than recursing, so tail calls run in constant stack
+    _immutable_fields_ = ['scope', 'sexp']
+    def __init__(self, scope, sexp):
+        self.scope = scope
+        self.sexp = sexp
+
+def tail_eval(scope, sexp):
     if isinstance(sexp, Cell):
-        try:
-            function = eval(scope, sexp.car)
-        except EvalException, e:
+        return TailCall(scope, sexp)
+    return eval(scope, sexp)
+
+def force(ret):
+    if isinstance(ret, TailCall):
+        return eval(ret.scope, ret.sexp)
+    return ret
+
+def eval(scope, sexp):
+    while True:
+        if isinstance(sexp, Cell):
+            try:
+                function = eval(scope, sexp.car)
+            except EvalException, e:
+                raise e.propogate(sexp)
+            args = sexp.cdr
+            # call function with args
+            if isinstance(function, Procedure):
+                profiling = profiler.state.profiler
+                if profiling is not None:
+                    return eval_profiled(profiling, scope, sexp, function)
+                try:
+                    ret = function.call_tail(scope, args)
+                except EvalException, e:
+                    raise e.propogate(sexp)
+                except Exception, e:
+                    raise
+                    #raise EvalException("An unknown error occurred.", sexp)
+                if isinstance(ret, TailCall):
+                    scope = ret.scope
+                    sexp = ret.sexp
+                    continue
+                return ret
+            # raise an eval exception
+            e = EvalException("value does not evaluate to a procedure", function)
             raise e.propogate(sexp)
-        args = sexp.cdr
-        # call function with args
-        if isinstance(function, Procedure):
+        elif isinstance(sexp, Symbol):
             try:
-                return function.call(scope, args)
+                if isinstance(sexp, LexicalSymbol):
+                    return sexp.lookup(scope)
+                return scope.get(sexp.name)
+            except NameNotSet:
+                raise EvalException("symbol is not set", sexp)
+        
+        # non-cells, non-symbols are atomic
+        return sexp
+
+def eval_profiled(profiling, scope, sexp, function):
+    # eval's loop for a call, with a profiler on. each call is left open
+    # until the whole chain of tail calls is done, so the profiler can
+    # charge tail-position work to the call that handed it back
+    base = profiling.depth()
+    try:
+        while True:
+            profiling.enter(function, base)
+            try:
+                ret = function.call_tail(scope, sexp.cdr)
             except EvalException, e:
                 raise e.propogate(sexp)
-            except Exception, e:
-                raise
-                #raise EvalException("An unknown error occurred.", sexp)
-        # raise an eval exception
-        e = EvalException("value does not evaluate to a procedure", function)
-        raise e.propogate(sexp)
-    elif isinstance(sexp, Symbol):
-        try:
-            return scope.get(sexp.name)
-        except NameNotSet:
-            raise EvalException("symbol is not set", sexp)
-    
-    # non-cells, non-symbols are atomic
-    return sexp
+            if not isinstance(ret, TailCall):
+                return ret
+            scope = ret.scope
+            sexp = ret.sexp
+            if not isinstance(sexp, Cell):
+                return eval(scope, sexp)
+            try:
+                function = eval(scope, sexp.car)
+            except EvalException, e:
+                raise e.propogate(sexp)
+            if not isinstance(function, Procedure):
+                e = EvalException("value does not evaluate to a procedure", function)
+                raise e.propogate(sexp)
+    finally:
+        profiling.leave_to(base)
 
 @unroll_safe
-def eval_list(scope, sexps):
+def _eval_list(scope, sexps, tail):
     i = 0
     ret = None
     sexps_len = len(sexps)
     while i < sexps_len:
-        jitdriver.jit_merge_point(sexps=sexps, sexps_len=sexps_len, scope=scope, i=i)
+        jitdriver.jit_merge_point(sexps=sexps, sexps_len=sexps_len, tail=tail, scope=scope, i=i, ret=ret)
         sexp = hint(sexps[i], promote=True)
+        if tail and i == sexps_len - 1:
+            return tail_eval(scope, sexp)
         ret = eval(scope, sexp)
         i += 1
     return ret
 
-@unroll_safe
-def eval_list_each(scope, sexps):
-    i = 0
-    ret = []
-    while i < len(sexps):
-        ret.append(eval(scope, sexps[i]))
-        i += 1
+def eval_list(scope, sexps):
+    return _eval_list(scope, sexps, False)
+
+def eval_list_tail(scope, sexps):
+    return _eval_list(scope, sexps, True)
+
+def get_body_location(tail, body):
+    assert isinstance(body, Cell)
+    sexp = body.car
+    if sexp is None:
+        return "nil"
+    return sexp.unparse()
+bodydriver = JitDriver(greens=['tail', 'body'], reds=['ret', 'scope'], get_printable_location=get_body_location)
+
+def _eval_body(scope, body, tail):
+    # like _eval_list, but for the rest of a form's argument list, which
+    # builtins like begin and let get as cells rather than a list
+    ret = None
+    while body is not None:
+        bodydriver.jit_merge_point(body=body, tail=tail, scope=scope, ret=ret)
+        assert isinstance(body, Cell)
+        if tail and body.cdr is None:
+            return tail_eval(scope, body.car)
+        ret = eval(scope, body.car)
+        body = body.cdr
     return ret
+
+def eval_body(scope, body):
+    return _eval_body(scope, body, False)
+
+def eval_body_tail(scope, body):
+    return _eval_body(scope, body, True)
@@ -0,0 +1,634 @@
+import os
+
+from pypy.rlib.rstring import StringBuilder
+from pypy.rlib.rarithmetic import r_uint, r_int64, intmask
+from pypy.rlib.longlong2float import float2longlong, longlong2float
+
+from .types import Cell, Symbol, String, Integer, Float, IntVector, FloatVector, HashTable, nil_key, intern, make_int
+from .scope import Frame, FrameLayout
+from .resolver import LexicalSymbol, ResolvedCell
+from .builtins.procedure import procedures, AutoProcedure, BuiltinFunction, LambdaProcedure
+from .ports import OutputPort, InputPort, closed_output_port, closed_input_port, standard_port
+from . import ports
+
+# saves the global scope, and everything reachable from it, so a later
+# run can start from it instead of evaluating the same files again.
+#
+# an image holds three tables -- frame layouts, frames, and values --
+# and the global bindings. each object is written after the objects it
+# is made from (a cell after its car and cdr, a lambda after its body,
+# a frame after its parent), so it can be made with its final contents;
+# the references that can change later -- frame slots, a lambda's
+# scope, hash table entries -- are written once every object exists, so
+# sharing and cycles come back as they were. builtins are saved by name
+# and looked up again on load. a port is saved by its name too; a
+# standard port comes back as this process's, and any other comes back
+# closed, since its file belongs to the process that opened it.
+
+MAGIC = "lisplisp image 2\n"
+# the same tables, holding a list of forms instead of global bindings
+FORMS_MAGIC = "lisplisp forms 2\n"
+
+INTEGER = 0
+FLOAT = 1
+STRING = 2
+SYMBOL = 3
+LEXICAL_SYMBOL = 4
+CELL = 5
+RESOLVED_CELL = 6
+INT_VECTOR = 7
+FLOAT_VECTOR = 8
+BUILTIN = 9
+LAMBDA = 10
+HASH_TABLE = 11
+OUTPUT_PORT = 12
+INPUT_PORT = 13
+
+class ImageError(Exception):
+    def __init__(self, message):
+        self.message = message
+    def nice_error_message(self):
+        return "image error: " + self.message
+
+class ImageWriter(object):
+    def __init__(self, scope):
+        self.scope = scope
+        self.builder = StringBuilder()
+        # every object, in the order it was found; references are indices
+        # into these, plus one for values (0 is nil) and frames (0 is the
+        # global scope)
+        self.layouts = []
+        self.layout_index = {}
+        self.frames = []
+        self.frame_index = {}
+        self.values = []
+        self.value_index = {}
+        self.frames_done = 0
+        self.values_done = 0
+
+    def layout_ref(self, layout):
+        try:
+            return self.layout_index[layout]
+        except KeyError:
+            self.layout_index[layout] = len(self.layouts)
+            self.layouts.append(layout)
+            return len(self.layouts) - 1
+
+    def scope_ref(self, scope):
+        if scope is self.scope:
+            return 0
+        if not isinstance(scope, Frame):
+            raise ImageError("can't save a scope other than the global one")
+        try:
+            return self.frame_index[scope] + 1
+        except KeyError:
+            self.frame_index[scope] = len(self.frames)
+            self.frames.append(scope)
+            return len(self.frames)
+
+    def value_ref(self, value):
+        if value is None:
+            return 0
+        try:
+            return self.value_index[value] + 1
+        except KeyError:
+            self.value_index[value] = len(self.values)
+            self.values.append(value)
+            return len(self.values)
+
+    def find_frame(self, frame):
+        self.scope_ref(frame.parent)
+        self.layout_ref(frame.layout)
+        for value in frame.values:
+            self.value_ref(value)
+        if frame.table is not None:
+            for value in frame.table.values():
+                self.value_ref(value)
+
+    def find_value(self, value):
+        if isinstance(value, LexicalSymbol):
+            for layout in value.path:
+                self.layout_ref(layout)
+        elif isinstance(value, Cell):
+            if isinstance(value, ResolvedCell):
+                self.layout_ref(value.layout)
+            self.value_ref(value.car)
+            self.value_ref(value.cdr)
+        elif isinstance(value, LambdaProcedure):
+            self.scope_ref(value.scope)
+            self.layout_ref(value.layout)
+            for sexp in value.body:
+                self.value_ref(sexp)
+        elif isinstance(value, Integer) or isinstance(value, Float) or isinstance(value, String):
+            pass
+        elif isinstance(value, Symbol) or isinstance(value, IntVector) or isinstance(value, FloatVector):
+            pass
+        elif isinstance(value, HashTable):
+            for key in value.table.keys():
+                if key is not nil_key:
+                    self.value_ref(key)
+                self.value_ref(value.table[key])
+        elif isinstance(value, AutoProcedure) or isinstance(value, BuiltinFunction):
+            pass
+        elif isinstance(value, OutputPort) or isinstance(value, InputPort):
+            pass
+        else:
+            raise ImageError("can't save value: " + value.unparse())
+
+    def find_all(self, roots):
+        # number everything reachable from roots, a table at a time
+        # rather than recursively, so long lists are fine
+        for value in roots:
+            self.value_ref(value)
+        while self.frames_done < len(self.frames) or self.values_done < len(self.values):
+            while self.frames_done < len(self.frames):
+                self.find_frame(self.frames[self.frames_done])
+                self.frames_done += 1
+            while self.values_done < len(self.values):
+                self.find_value(self.values[self.values_done])
+                self.values_done += 1
+        self.order_frames()
+        self.order_values()
+
+    def order_frames(self):
+        # renumbers the frames so each comes after its parent
+        order = []
+        placed = {}
+        for frame in self.frames:
+            chain = []
+            scope = frame
+            while isinstance(scope, Frame) and scope not in placed:
+                placed[scope] = None
+                chain.append(scope)
+                scope = scope.parent
+            i = len(chain) - 1
+            while i >= 0:
+                order.append(chain[i])
+                i -= 1
+        self.frames = order
+        self.frame_index = {}
+        for i in range(len(order)):
+            self.frame_index[order[i]] = i
+
+    def made_from(self, value):
+        # the values that must exist before value can be made
+        ret = []
+        if isinstance(value, Cell):
+            ret.append(value.car)
+            ret.append(value.cdr)
+        elif isinstance(value, LambdaProcedure):
+            for sexp in value.body:
+                ret.append(sexp)
+        return ret
+
+    def order_values(self):
+        # renumbers the values so each comes after what it's made from,
+        # walking with an explicit stack so long lists are fine
+        order = []
+        seen = {}
+        for root in self.values:
+            if root in seen:
+                continue
+            seen[root] = None
+            stack = [root]
+            positions = [0]
+            while len(stack) > 0:
+                value = stack[-1]
+                children = self.made_from(value)
+                i = positions[-1]
+                if i < len(children):
+                    positions[-1] = i + 1
+                    child = children[i]
+                    if child is not None and child not in seen:
+                        seen[child] = None
+                        stack.append(child)
+                        positions.append(0)
+                else:
+                    stack.pop()
+                    positions.pop()
+                    order.append(value)
+        self.values = order
+        self.value_index = {}
+        for i in range(len(order)):
+            self.value_index[order[i]] = i
+
+    def write_int(self, n):
+        # zigzag, then 7 bits at a time, low bits first
+        u = r_uint(n) << 1
+        if n < 0:
+            u = ~u
+        while u >= 0x80:
+            self.builder.append(chr(intmask(u & 0x7f) | 0x80))
+            u >>= 7
+        self.builder.append(chr(intmask(u)))
+
+    def write_bool(self, b):
+        if b:
+            self.write_int(1)
+        else:
+            self.write_int(0)
+
+    def write_str(self, s):
+        self.write_int(len(s))
+        self.builder.append(s)
+
+    def write_names(self, names):
+        self.write_int(len(names))
+        for name in names:
+            self.write_str(name)
+
+    def write_value(self, value):
+        if isinstance(value, Integer):
+            self.write_int(INTEGER)
+            self.write_int(value.value)
+        elif isinstance(value, Float):
+            self.write_int(FLOAT)
+            self.write_int(intmask(float2longlong(value.value)))
+        elif isinstance(value, String):
+            self.write_int(STRING)
+            self.write_str(value.data)
+        elif isinstance(value, LexicalSymbol):
+            self.write_int(LEXICAL_SYMBOL)
+            self.write_str(value.name)
+            self.write_int(value.depth)
+            self.write_int(value.slot)
+            self.write_int(len(value.path))
+            for layout in value.path:
+                self.write_int(self.layout_index[layout])
+        elif isinstance(value, Symbol):
+            self.write_int(SYMBOL)
+            self.write_str(value.name)
+        elif isinstance(value, ResolvedCell):
+            self.write_int(RESOLVED_CELL)
+            self.write_int(self.layout_index[value.layout])
+            self.write_int(self.value_ref(value.car))
+            self.write_int(self.value_ref(value.cdr))
+        elif isinstance(value, Cell):
+            self.write_int(CELL)
+            self.write_int(self.value_ref(value.car))
+            self.write_int(self.value_ref(value.cdr))
+        elif isinstance(value, IntVector):
+            self.write_int(INT_VECTOR)
+            self.write_int(len(value.values))
+            for n in value.values:
+                self.write_int(n)
+        elif isinstance(value, FloatVector):
+            self.write_int(FLOAT_VECTOR)
+            self.write_int(len(value.values))
+            for f in value.values:
+                self.write_int(intmask(float2longlong(f)))
+        elif isinstance(value, LambdaProcedure):
+            self.write_int(LAMBDA)
+            self.write_str(value.name)
+            self.write_names(value.required)
+            self.write_names(value.optional)
+            if value.rest is None:
+                self.write_bool(False)
+            else:
+                self.write_bool(True)
+                self.write_str(value.rest)
+            self.write_int(self.layout_index[value.layout])
+            self.write_bool(value.eval_args)
+            self.write_bool(value.eval_return)
+            self.write_bool(value.cache_expansions)
+            self.write_int(len(value.body))
+            for sexp in value.body:
+                self.write_int(self.value_ref(sexp))
+        elif isinstance(value, HashTable):
+            self.write_int(HASH_TABLE)
+        elif isinstance(value, OutputPort):
+            self.write_int(OUTPUT_PORT)
+            self.write_str(value.name)
+            self.write_bool(value is ports.stdout or value is ports.stderr)
+        elif isinstance(value, InputPort):
+            self.write_int(INPUT_PORT)
+            self.write_str(value.name)
+            self.write_bool(value is ports.stdin)
+        else:
+            assert isinstance(value, AutoProcedure) or isinstance(value, BuiltinFunction)
+            self.write_int(BUILTIN)
+            self.write_str(value.name)
+
+    def write_links(self, value):
+        if isinstance(value, LambdaProcedure):
+            self.write_int(self.scope_ref(value.scope))
+        elif isinstance(value, HashTable):
+            self.write_int(value.count())
+            for key in value.table.keys():
+                if key is nil_key:
+                    self.write_int(0)
+                else:
+                    self.write_int(self.value_ref(key))
+                self.write_int(self.value_ref(value.table[key]))
+
+    def write_table(self, table):
+        self.write_int(len(table))
+        for name, value in table.items():
+            self.write_str(name)
+            self.write_int(self.value_ref(value))
+
+    def write_tables(self):
+        self.write_int(len(self.layouts))
+        for layout in self.layouts:
+            self.write_names(layout.names[:])
+        self.write_int(len(self.frames))
+        for frame in self.frames:
+            self.write_int(self.layout_index[frame.layout])
+            self.write_int(self.scope_ref(frame.parent))
+            self.write_int(len(frame.values))
+        self.write_int(len(self.values))
+        for value in self.values:
+            self.write_value(value)
+
+        for frame in self.frames:
+            for value in frame.values:
+                self.write_int(self.value_ref(value))
+            if frame.table is None:
+                self.write_int(0)
+            else:
+                self.write_table(frame.table)
+        for value in self.values:
+            self.write_links(value)
+
+    def write(self):
+        self.find_all(self.scope.table.values())
+        self.builder.append(MAGIC)
+        self.write_tables()
+        self.write_int(len(self.scope.table))
+        for name, value in self.scope.table.items():
+            self.write_str(name)
+            self.write_bool(name in self.scope.semiconstants)
+            self.write_int(self.value_ref(value))
+        return self.builder.build()
+
+    def write_forms(self, sexps):
+        self.find_all(sexps)
+        self.builder.append(FORMS_MAGIC)
+        self.write_tables()
+        self.write_int(len(sexps))
+        for sexp in sexps:
+            self.write_int(self.value_ref(sexp))
+        return self.builder.build()
+
+class ImageReader(object):
+    def __init__(self, data, scope):
+        self.data = data
+        self.pos = 0
+        self.scope = scope
+        self.layouts = []
+        self.frames = []
+        self.values = []
+        self.builtins = {}
+        for proc in procedures:
+            self.builtins[proc.name] = proc
+
+    def read_int(self):
+        u = r_uint(0)
+        shift = 0
+        while True:
+            if self.pos >= len(self.data):
+                raise ImageError("image is truncated")
+            if shift > 63:
+                raise ImageError("image is corrupt")
+            c = ord(self.data[self.pos])
+            self.pos += 1
+            u |= r_uint(c & 0x7f) << shift
+            shift += 7
+            if c < 0x80:
+                break
+        n = intmask(u >> 1)
+        if u & 1:
+            n = ~n
+        return n
+
+    def read_bool(self):
+        return self.read_int() != 0
+
+    def read_float(self):
+        return longlong2float(r_int64(self.read_int()))
+
+    def read_str(self):
+        size = self.read_int()
+        start = self.pos
+        stop = start + size
+        if size < 0 or stop > len(self.data):
+            raise ImageError("image is truncated")
+        assert start >= 0 and stop >= 0
+        self.pos = stop
+        return self.data[start:stop]
+
+    def read_names(self):
+        names = []
+        for i in range(self.read_int()):
+            names.append(self.read_str())
+        return names
+
+    def read_index(self, items):
+        i = self.read_int()
+        if i < 0 or i >= len(items):
+            raise ImageError("image is corrupt")
+        return i
+
+    def layout(self):
+        return self.layouts[self.read_index(self.layouts)]
+
+    def scope_ref(self):
+        i = self.read_int()
+        if i == 0:
+            return self.scope
+        if i < 0 or i > len(self.frames):
+            raise ImageError("image is corrupt")
+        return self.frames[i - 1]
+
+    def value_ref(self):
+        i = self.read_int()
+        if i == 0:
+            return None
+        if i < 0 or i > len(self.values):
+            raise ImageError("image is corrupt")
+        return self.values[i - 1]
+
+    def read_value(self):
+        kind = self.read_int()
+        if kind == INTEGER:
+            return make_int(self.read_int())
+        elif kind == FLOAT:
+            return Float(self.read_float())
+        elif kind == STRING:
+            return String(self.read_str())
+        elif kind == SYMBOL:
+            return intern(self.read_str())
+        elif kind == LEXICAL_SYMBOL:
+            name = self.read_str()
+            depth = self.read_int()
+            slot = self.read_int()
+            path = []
+            for i in range(self.read_int()):
+                path.append(self.layout())
+            return LexicalSymbol(name, depth, slot, path)
+        elif kind == CELL:
+            car = self.value_ref()
+            return Cell(car, self.value_ref())
+        elif kind == RESOLVED_CELL:
+            layout = self.layout()
+            car = self.value_ref()
+            return ResolvedCell(car, self.value_ref(), layout)
+        elif kind == INT_VECTOR:
+            ints = []
+            for i in range(self.read_int()):
+                ints.append(self.read_int())
+            return IntVector(ints)
+        elif kind == FLOAT_VECTOR:
+            floats = []
+            for i in range(self.read_int()):
+                floats.append(self.read_float())
+            return FloatVector(floats)
+        elif kind == LAMBDA:
+            name = self.read_str()
+            required = self.read_names()
+            optional = self.read_names()
+            rest = None
+            if self.read_bool():
+                rest = self.read_str()
+            layout = self.layout()
+            eval_args = self.read_bool()
+            eval_return = self.read_bool()
+            cache_expansions = self.read_bool()
+            body = []
+            for i in range(self.read_int()):
+                body.append(self.value_ref())
+            # the scope is linked later, since frames hold values too
+            proc = LambdaProcedure(self.scope, required, optional, rest, layout, body, eval_args, eval_return)
+            proc.name = name
+            proc.cache_expansions = cache_expansions
+            return proc
+        elif kind == HASH_TABLE:
+            # filled in with the other links, once its keys exist
+            return HashTable()
+        elif kind == OUTPUT_PORT:
+            name = self.read_str()
+            if self.read_bool():
+                port = standard_port(name)
+                if port is None:
+                    raise ImageError("image is corrupt")
+                return port
+            return closed_output_port(name)
+        elif kind == INPUT_PORT:
+            name = self.read_str()
+            if self.read_bool():
+                return ports.stdin
+            return closed_input_port(name)
+        elif kind == BUILTIN:
+            name = self.read_str()
+            try:
+                return self.builtins[name]
+            except KeyError:
+                raise ImageError("unknown builtin: " + name)
+        raise ImageError("image is corrupt")
+
+    def read_links(self, value):
+        if isinstance(value, LambdaProcedure):
+            value.scope = self.scope_ref()
+        elif isinstance(value, HashTable):
+            for i in range(self.read_int()):
+                key = self.value_ref()
+                value.set(key, self.value_ref())
+
+    def read_magic(self, magic):
+        if not self.data.startswith(magic):
+            raise ImageError("not an image, or from a different version")
+        self.pos = len(magic)
+
+    def read_tables(self):
+        for i in range(self.read_int()):
+            self.layouts.append(FrameLayout(self.read_names()))
+        num_frames = self.read_int()
+        if num_frames > 0 and self.scope is None:
+            raise ImageError("image is corrupt")
+        for i in range(num_frames):
+            layout = self.layout()
+            parent = self.scope_ref()
+            size = self.read_int()
+            if size < 0:
+                raise ImageError("image is corrupt")
+            self.frames.append(Frame(parent, layout, [None] * size))
+        for i in range(self.read_int()):
+            self.values.append(self.read_value())
+
+        for frame in self.frames:
+            for i in range(len(frame.values)):
+                frame.values[i] = self.value_ref()
+            for i in range(self.read_int()):
+                if frame.table is None:
+                    frame.table = {}
+                name = self.read_str()
+                frame.table[name] = self.value_ref()
+        for value in self.values:
+            self.read_links(value)
+
+    def read(self):
+        self.read_magic(MAGIC)
+        self.read_tables()
+        for i in range(self.read_int()):
+            name = self.read_str()
+            semiconstant = self.read_bool()
+            value = self.value_ref()
+            if semiconstant:
+                self.scope.set_semiconstant(name, value)
+            else:
+                self.scope.set(name, value)
+
+    def read_forms(self):
+        self.read_magic(FORMS_MAGIC)
+        self.read_tables()
+        sexps = []
+        for i in range(self.read_int()):
+            sexps.append(self.value_ref())
+        return sexps
+
+def encode_forms(sexps):
+    return ImageWriter(None).write_forms(sexps)
+
+def decode_forms(data):
+    return ImageReader(data, None).read_forms()
+
+def read_fd(fd):
+    # everything left in fd, read until the end rather than trusting its
+    # size, which a pipe doesn't have
+    builder = StringBuilder()
+    while True:
+        chunk = os.read(fd, 65536)
+        if len(chunk) == 0:
+            break
+        builder.append(chunk)
+    return builder.build()
+
+def write_file(fname, data):
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+    finally:
+        os.close(fd)
+
+def save_image(scope, fname):
+    data = ImageWriter(scope).write()
+    try:
+        write_file(fname, data)
+    except OSError:
+        raise ImageError("can't write " + fname)
+
+def load_image(scope, fname):
+    # scope should be a fresh global scope with the builtins registered
+    try:
+        fd = os.open(fname, os.O_RDONLY, 0777)
+    except OSError:
+        raise ImageError("can't read " + fname)
+    try:
+        data = read_fd(fd)
+    except OSError:
+        os.close(fd)
+        raise ImageError("can't read " + fname)
+    os.close(fd)
+    ImageReader(data, scope).read()
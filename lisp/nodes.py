@@ -0,0 +1,456 @@
+from .types import LispType, Cell, Symbol, Procedure, T, is_list
+from .scope import Frame, NameNotSet, frame_layouts
+from .resolver import LexicalSymbol, ResolvedCell, resolve
+from .specials import find_special, arg_list
+from .eval import EvalException
+from .builtins.procedure import LambdaProcedure, name_procedure
+
+from pypy.rlib.jit import JitDriver, unroll_safe
+
+# an alternative to eval: each form is compiled once into a tree of
+# nodes, which can then be executed as many times as needed. forms are
+# resolved first, so every symbol already knows its frame address.
+
+class TailApply(LispType):
+    # what execute_tail returns in place of a value when the last thing
+    # to do is run a lambda body; run_body loops on these
+    _immutable_fields_ = ['proc', 'frame']
+    def __init__(self, proc, frame):
+        self.proc = proc
+        self.frame = frame
+
+class Node(object):
+    def execute(self, scope):
+        raise NotImplementedError('execute')
+    def execute_tail(self, scope):
+        # may return a TailApply instead of a value
+        return self.execute(scope)
+
+def _run(node, scope, tail):
+    if tail:
+        return node.execute_tail(scope)
+    return node.execute(scope)
+
+class ConstNode(Node):
+    _immutable_fields_ = ['value']
+    def __init__(self, value):
+        self.value = value
+    def execute(self, scope):
+        return self.value
+
+class LexicalRefNode(Node):
+    _immutable_fields_ = ['symbol']
+    def __init__(self, symbol):
+        self.symbol = symbol
+    def execute(self, scope):
+        try:
+            return self.symbol.lookup(scope)
+        except NameNotSet:
+            raise EvalException("symbol is not set", self.symbol)
+
+class SymbolRefNode(Node):
+    _immutable_fields_ = ['symbol']
+    def __init__(self, symbol):
+        self.symbol = symbol
+    def execute(self, scope):
+        try:
+            return scope.get(self.symbol.name)
+        except NameNotSet:
+            raise EvalException("symbol is not set", self.symbol)
+
+class BodyNode(Node):
+    _immutable_fields_ = ['nodes[*]']
+    def __init__(self, nodes):
+        self.nodes = nodes[:]
+    @unroll_safe
+    def execute(self, scope):
+        ret = None
+        for node in self.nodes:
+            ret = node.execute(scope)
+        return ret
+    @unroll_safe
+    def execute_tail(self, scope):
+        num = len(self.nodes)
+        if num == 0:
+            return None
+        i = 0
+        while i < num - 1:
+            self.nodes[i].execute(scope)
+            i += 1
+        return self.nodes[num - 1].execute_tail(scope)
+
+class FormNode(Node):
+    # a node standing for a whole form, which ends up in the trace of
+    # any exception passing through it
+    _immutable_fields_ = ['sexp']
+    def __init__(self, sexp):
+        self.sexp = sexp
+    def execute(self, scope):
+        try:
+            return self.run(scope, False)
+        except EvalException, e:
+            raise e.propogate(self.sexp)
+    def execute_tail(self, scope):
+        try:
+            return self.run(scope, True)
+        except EvalException, e:
+            raise e.propogate(self.sexp)
+    def run(self, scope, tail):
+        raise NotImplementedError('run')
+
+class CallNode(FormNode):
+    _immutable_fields_ = ['head', 'args', 'proper', 'arg_nodes?']
+    def __init__(self, sexp, head):
+        FormNode.__init__(self, sexp)
+        assert isinstance(sexp, Cell)
+        self.head = head
+        self.args = sexp.cdr
+        self.proper = arg_list(self.args) is not None
+        # compiled on the first call that needs them, since macros and
+        # special forms never do
+        self.arg_nodes = None
+
+    def _get_arg_nodes(self):
+        if self.arg_nodes is None:
+            self.arg_nodes = compile_list(arg_list(self.args))
+        return self.arg_nodes
+
+    @unroll_safe
+    def run(self, scope, tail):
+        function = self.head.execute(scope)
+        if not isinstance(function, Procedure):
+            raise EvalException("value does not evaluate to a procedure", function)
+        if function.is_strict() and self.proper:
+            arg_nodes = self._get_arg_nodes()
+            if len(arg_nodes) == 2 and not isinstance(function, LambdaProcedure):
+                val1 = arg_nodes[0].execute(scope)
+                val2 = arg_nodes[1].execute(scope)
+                try:
+                    return function.apply2(scope, val1, val2)
+                except EvalException, e:
+                    raise e.blame_argument([val1, val2], self.args)
+            values = [None] * len(arg_nodes)
+            for i in range(len(arg_nodes)):
+                values[i] = arg_nodes[i].execute(scope)
+            if isinstance(function, LambdaProcedure):
+                frame = function.bind_values(values)
+                if tail:
+                    return TailApply(function, frame)
+                return run_body(function, frame)
+            try:
+                return function.apply(scope, values)
+            except EvalException, e:
+                raise e.blame_argument(values, self.args)
+        if isinstance(function, LambdaProcedure) and function.eval_return:
+            # a macro: expand it, then compile and run the expansion here
+            expansion = function.cached_expansion(self.args)
+            if expansion is None:
+                sexp = run_body(function, function.bind(scope, self.args))
+                expansion = function.new_expansion(self.args, sexp)
+            if expansion.nodes is None:
+                expansion.nodes = compile_form(scope, expansion.sexp)
+            return _run(expansion.nodes, scope, tail)
+        return function.call(scope, self.args)
+
+class SpecialNode(FormNode):
+    # a special form, compiled on the assumption that its head still
+    # names the builtin it did at compile time; if not, it's run as an
+    # ordinary call instead
+    _immutable_fields_ = ['head', 'builtin', 'fallback']
+    def __init__(self, sexp, head, builtin):
+        FormNode.__init__(self, sexp)
+        self.head = head
+        self.builtin = builtin
+        self.fallback = CallNode(sexp, head)
+    def run(self, scope, tail):
+        if self.head.execute(scope) is not self.builtin:
+            return self.fallback.run(scope, tail)
+        return self.special(scope, tail)
+    def special(self, scope, tail):
+        raise NotImplementedError('special')
+
+class QuoteNode(SpecialNode):
+    _immutable_fields_ = ['value']
+    def __init__(self, sexp, head, builtin, value):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.value = value
+    def special(self, scope, tail):
+        return self.value
+
+class IfNode(SpecialNode):
+    _immutable_fields_ = ['test', 'then', 'orelse']
+    def __init__(self, sexp, head, builtin, test, then, orelse):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.test = test
+        self.then = then
+        self.orelse = orelse
+    def special(self, scope, tail):
+        if self.test.execute(scope) is not None:
+            return _run(self.then, scope, tail)
+        return _run(self.orelse, scope, tail)
+
+class BeginNode(SpecialNode):
+    _immutable_fields_ = ['body']
+    def __init__(self, sexp, head, builtin, body):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.body = body
+    def special(self, scope, tail):
+        return _run(self.body, scope, tail)
+
+class AndNode(SpecialNode):
+    _immutable_fields_ = ['nodes[*]']
+    def __init__(self, sexp, head, builtin, nodes):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.nodes = nodes[:]
+    @unroll_safe
+    def special(self, scope, tail):
+        num = len(self.nodes)
+        if num == 0:
+            return T
+        for i in range(num - 1):
+            if self.nodes[i].execute(scope) is None:
+                return None
+        return _run(self.nodes[num - 1], scope, tail)
+
+class OrNode(SpecialNode):
+    _immutable_fields_ = ['nodes[*]']
+    def __init__(self, sexp, head, builtin, nodes):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.nodes = nodes[:]
+    @unroll_safe
+    def special(self, scope, tail):
+        num = len(self.nodes)
+        if num == 0:
+            return None
+        for i in range(num - 1):
+            ret = self.nodes[i].execute(scope)
+            if ret is not None:
+                return ret
+        return _run(self.nodes[num - 1], scope, tail)
+
+class LetNode(SpecialNode):
+    _immutable_fields_ = ['layout', 'values[*]', 'body']
+    def __init__(self, sexp, head, builtin, layout, values, body):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.layout = layout
+        self.values = values[:]
+        self.body = body
+    @unroll_safe
+    def special(self, scope, tail):
+        values = [None] * len(self.values)
+        for i in range(len(self.values)):
+            values[i] = self.values[i].execute(scope)
+        return _run(self.body, Frame(scope, self.layout, values), tail)
+
+def get_while_location(node):
+    return node.sexp.unparse()
+whiledriver = JitDriver(greens=['node'], reds=['scope'], get_printable_location=get_while_location)
+
+class WhileNode(SpecialNode):
+    _immutable_fields_ = ['test', 'body']
+    def __init__(self, sexp, head, builtin, test, body):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.test = test
+        self.body = body
+    def special(self, scope, tail):
+        node = self
+        while True:
+            whiledriver.jit_merge_point(node=node, scope=scope)
+            if node.test.execute(scope) is None:
+                break
+            node.body.execute(scope)
+        return None
+
+def get_dolist_location(node):
+    return node.sexp.unparse()
+dolistdriver = JitDriver(greens=['node'], reds=['work', 'frame'], get_printable_location=get_dolist_location)
+
+class DolistNode(SpecialNode):
+    _immutable_fields_ = ['layout', 'target', 'result', 'body']
+    def __init__(self, sexp, head, builtin, layout, target, result, body):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.layout = layout
+        self.target = target
+        # None if there's no result form
+        self.result = result
+        self.body = body
+    def special(self, scope, tail):
+        work = self.target.execute(scope)
+        if not is_list(work):
+            raise EvalException("dolist target is not a list")
+        frame = Frame(scope, self.layout, [None])
+        node = self
+        while True:
+            dolistdriver.jit_merge_point(node=node, work=work, frame=frame)
+            if work is None:
+                break
+            assert isinstance(work, Cell)
+            frame.values[0] = work.car
+            node.body.execute(frame)
+            work = work.cdr
+        if node.result is None:
+            return None
+        return _run(node.result, frame, tail)
+
+class SetqNode(SpecialNode):
+    _immutable_fields_ = ['symbols[*]', 'values[*]']
+    def __init__(self, sexp, head, builtin, symbols, values):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.symbols = symbols[:]
+        self.values = values[:]
+    @unroll_safe
+    def special(self, scope, tail):
+        value = None
+        for i in range(len(self.symbols)):
+            value = self.values[i].execute(scope)
+            symbol = self.symbols[i]
+            name_procedure(value, symbol.name)
+            if isinstance(symbol, LexicalSymbol):
+                symbol.store(scope, value)
+            else:
+                scope.set(symbol.name, value)
+        return value
+
+class LambdaNode(SpecialNode):
+    _immutable_fields_ = ['body']
+    def __init__(self, sexp, head, builtin, body):
+        SpecialNode.__init__(self, sexp, head, builtin)
+        self.body = body
+    def special(self, scope, tail):
+        assert isinstance(self.sexp, Cell)
+        proc = self.builtin.call(scope, self.sexp.cdr)
+        assert isinstance(proc, LambdaProcedure)
+        proc.nodes = self.body
+        return proc
+
+def compiled_body(proc):
+    if proc.nodes is None:
+        proc.nodes = BodyNode(compile_list(proc.body))
+    return proc.nodes
+
+def get_body_location(proc):
+    return proc.profile_name()
+bodydriver = JitDriver(greens=['proc'], reds=['frame'], get_printable_location=get_body_location)
+
+def run_body(proc, frame):
+    # tail calls between lambdas come back here, so tail recursion is a
+    # loop as far as the JIT can see
+    while True:
+        bodydriver.jit_merge_point(proc=proc, frame=frame)
+        ret = compiled_body(proc).execute_tail(frame)
+        if isinstance(ret, TailApply):
+            proc = ret.proc
+            frame = ret.frame
+            bodydriver.can_enter_jit(proc=proc, frame=frame)
+            continue
+        return ret
+
+def _compile_special(name, sexp, head, builtin):
+    assert isinstance(sexp, Cell)
+    args = arg_list(sexp.cdr)
+    if args is None:
+        return None
+    if name == 'quote':
+        if len(args) != 1:
+            return None
+        return QuoteNode(sexp, head, builtin, args[0])
+    elif name == 'if':
+        if len(args) < 2:
+            return None
+        return IfNode(sexp, head, builtin, compile(args[0]), compile(args[1]), compile_body(args[2:]))
+    elif name == 'begin':
+        return BeginNode(sexp, head, builtin, compile_body(args))
+    elif name == 'and':
+        return AndNode(sexp, head, builtin, compile_list(args))
+    elif name == 'or':
+        return OrNode(sexp, head, builtin, compile_list(args))
+    elif name == 'let':
+        if len(args) < 1:
+            return None
+        bindings = args[0]
+        if not isinstance(bindings, ResolvedCell):
+            return None
+        values = []
+        for binding in arg_list(bindings):
+            assert isinstance(binding, Cell)
+            value = binding.cdr
+            assert isinstance(value, Cell)
+            values.append(compile(value.car))
+        return LetNode(sexp, head, builtin, bindings.layout, values, compile_body(args[1:]))
+    elif name == 'while':
+        if len(args) < 1:
+            return None
+        return WhileNode(sexp, head, builtin, compile(args[0]), compile_body(args[1:]))
+    elif name == 'dolist':
+        if len(args) < 1 or not isinstance(args[0], ResolvedCell):
+            return None
+        binding = args[0]
+        assert isinstance(binding, ResolvedCell)
+        parts = binding.cdr
+        assert isinstance(parts, Cell)
+        result = None
+        if parts.cdr is not None:
+            rest = parts.cdr
+            assert isinstance(rest, Cell)
+            result = compile(rest.car)
+        return DolistNode(sexp, head, builtin, binding.layout, compile(parts.car), result, compile_body(args[1:]))
+    elif name == 'setq':
+        if len(args) % 2 != 0:
+            return None
+        symbols = []
+        values = []
+        i = 0
+        while i < len(args):
+            symbol = args[i]
+            if not isinstance(symbol, Symbol):
+                return None
+            symbols.append(symbol)
+            values.append(compile(args[i + 1]))
+            i += 2
+        return SetqNode(sexp, head, builtin, symbols, values)
+    elif name == 'lambda' or name == 'macro':
+        if len(args) < 1 or not isinstance(args[0], ResolvedCell):
+            return None
+        return LambdaNode(sexp, head, builtin, compile_body(args[1:]))
+    return None
+
+def compile(sexp):
+    # sexp must already have been through the resolver
+    if isinstance(sexp, LexicalSymbol):
+        return LexicalRefNode(sexp)
+    elif isinstance(sexp, Symbol):
+        return SymbolRefNode(sexp)
+    elif not isinstance(sexp, Cell):
+        return ConstNode(sexp)
+
+    head = sexp.car
+    head_node = compile(head)
+    if isinstance(head, Symbol):
+        local = isinstance(head, LexicalSymbol) and head.slot >= 0
+        builtin = find_special(head.name)
+        if builtin is not None and not local:
+            node = _compile_special(head.name, sexp, head_node, builtin)
+            if node is not None:
+                return node
+    return CallNode(sexp, head_node)
+
+def compile_list(sexps):
+    nodes = []
+    for sexp in sexps:
+        nodes.append(compile(sexp))
+    return nodes
+
+def compile_body(sexps):
+    return BodyNode(compile_list(sexps))
+
+def compile_form(scope, sexp):
+    return compile(resolve(sexp, frame_layouts(scope), scope))
+
+def execute(scope, sexp):
+    return compile_form(scope, sexp).execute(scope)
+
+def execute_list(scope, sexps):
+    ret = None
+    for sexp in sexps:
+        ret = execute(scope, sexp)
+    return ret
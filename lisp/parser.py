@@ -1,106 +1,291 @@
-from pypy.rlib.parsing.ebnfparse import parse_ebnf, make_parse_function
-from pypy.rlib.parsing.parsing import ParseError, Rule
-
 import os
-import os.path
 
-from .types import Cell, Symbol, String, Integer, Float
+from pypy.rlib.rstring import StringBuilder
+
+from .types import InvalidValue, Cell, String, Float, intern, make_int
+
+# a single-pass reader: characters go straight to Cells, Symbols and
+# numbers, with no token stream or parse tree in between. lists are
+# built with an explicit stack, so deep nesting doesn't recurse.
+# (the old grammar-driven parser is still in ebnfparser.py, for the
+# benchmark in benchmarks/parser.py)
 
-BNF_RULES_FILE = os.path.join(os.path.dirname(__file__), 'grammar.txt')
+class ParseError(Exception):
+    def __init__(self, message, line):
+        self.message = message
+        self.line = line
+    def nice_error_message(self):
+        return "parse error on line " + str(self.line) + ": " + self.message
 
-try:
-    with open(BNF_RULES_FILE, 'r') as f:
-        t = f.read()
-    regexs, rules, toAST = parse_ebnf(t)
-except ParseError, e:
-    print e.nice_error_message(filename=BNF_RULES_FILE, source=t)
-    raise
+_whitespace = " \n\r\t"
+_delimiters = " \n\r\t()[]\";'`,"
 
-parsefunc = make_parse_function(regexs, rules, eof=True)
+_prefixes = {
+    "'": 'quote',
+    "`": 'quasiquote',
+    ",": 'unquote',
+    ",@": 'unquote-splicing',
+}
 
 string_escape_table = {
-    r'\\' : '\\',
-    r'\"' : '\"',
-    r'\a' : '\a',
-    r'\b' : '\b',
-    r'\f' : '\f',
-    r'\n' : '\n',
-    r'\r' : '\r',
-    r'\t' : '\t',
-    r'\v' : '\v',
+    '\\': '\\',
+    '"': '"',
+    'a': '\a',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    'v': '\v',
 }
 
-def parse_string(s):
-    result = ""
-    i = 1
-    while i < len(s) - 1:
-        done = False
-        if s[i] == '\\':
-            key = '\\' + s[i + 1]
-            if key in string_escape_table:
-                result += string_escape_table[key]
-                i += len(key)
-                done = True
-            if key == r'\x':
-                for j in range(256):
-                    test_escape = r'\x%x%x' % (j // 16, j % 16)
-                    if s[i:].startswith(test_escape):
-                        result += chr(j)
-                        i += 4
-                        done = True
-        if not done:
-            result += s[i]
+def _hex_value(c):
+    if c >= '0' and c <= '9':
+        return ord(c) - ord('0')
+    if c >= 'a' and c <= 'f':
+        return ord(c) - ord('a') + 10
+    if c >= 'A' and c <= 'F':
+        return ord(c) - ord('A') + 10
+    return -1
+
+def _all_digits(s, start, stop):
+    if stop <= start:
+        return False
+    for i in range(start, stop):
+        if s[i] < '0' or s[i] > '9':
+            return False
+    return True
+
+class _Open(object):
+    # something on the reader's stack, waiting for values: either a list
+    # (closed by close) or a prefix like ' that wraps the next value
+    def __init__(self, close, prefix):
+        self.close = close
+        self.prefix = prefix
+        self.items = []
+        self.tail = None
+        # 0 for a plain list, 1 just after a dot, 2 once the tail is read
+        self.dotted = 0
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        # newlines in data that has already been thrown away
+        self.lines_before = 0
+        # where the token being read starts, if there is one
+        self.token_start = -1
+
+    def fill(self):
+        # called when pos reaches the end of data; returns True if
+        # more data was added
+        return False
+
+    def error(self, message):
+        line = 1 + self.lines_before
+        i = 0
+        end = self.pos
+        if end > len(self.data):
+            end = len(self.data)
+        while i < end:
+            if self.data[i] == '\n':
+                line += 1
             i += 1
-    return result
-
-def ast_to_types(ast):
-    symbol = ast.symbol
-    if symbol == 'valuelist':
-        if len(ast.children) == 2:
-            return Cell(ast_to_types(ast.children[0]), ast_to_types(ast.children[1]))
-        elif len(ast.children) == 1:
-            return Cell(ast_to_types(ast.children[0]))
-        else:
-            raise RuntimeError("too many children for 'valuelist' AST")
-    elif symbol == 'INTEGER':
-        return Integer(int(ast.additional_info))
-    elif symbol == 'FLOAT':
-        return Float(float(ast.additional_info))
-    elif symbol == 'SYMBOL':
-        return Symbol(ast.additional_info)
-    elif symbol == 'STRING':
-        parsed_string = parse_string(ast.additional_info)
-        return String(parsed_string)
-    elif symbol == 'prefixed':
-        if len(ast.children) == 2:
-           prefix = ast.children[0].additional_info
-           if prefix == "'":
-               long_prefix = 'quote'
-           elif prefix == "`":
-               long_prefix = 'quasiquote'
-           elif prefix == ",":
-               long_prefix = 'unquote'
-           elif prefix == ',@':
-               long_prefix = 'unquote-splicing'
-           else:
-               raise RuntimeError("unknown prefix: " + prefix)
-           return Cell(Symbol(long_prefix), Cell(ast_to_types(ast.children[1])))
-        else:
-           raise RuntimeError("too many children for 'prefixed' AST")
-        return None
-    elif symbol == 'cell':
-        if len(ast.children) == 1:
-            return Cell(ast_to_types(ast.children[0]))
-        elif len(ast.children) == 2:
-            return Cell(ast_to_types(ast.children[0]), ast_to_types(ast.children[1]))
-        else:
-            raise RuntimeError("too many children for 'cell' AST")
-    elif symbol == 'nil':
-        return None
-    else:
-        raise RuntimeError("unhandled AST")
+        return ParseError(message, line)
+
+    def eof(self):
+        return self.pos >= len(self.data) and not self.fill()
+
+    def ensure(self, count):
+        # makes sure count characters are available from pos
+        while self.pos + count > len(self.data):
+            if not self.fill():
+                return False
+        return True
+
+    def skip_whitespace(self):
+        # skips whitespace and comments
+        while not self.eof():
+            c = self.data[self.pos]
+            if c == ';':
+                while not self.eof() and self.data[self.pos] != '\n':
+                    self.pos += 1
+            elif c in _whitespace:
+                self.pos += 1
+            else:
+                return
+
+    def at_end(self):
+        self.skip_whitespace()
+        return self.eof()
+
+    def read_token(self):
+        self.token_start = self.pos
+        while not self.eof() and self.data[self.pos] not in _delimiters:
+            self.pos += 1
+        start = self.token_start
+        stop = self.pos
+        self.token_start = -1
+        assert start >= 0 and stop >= 0
+        return self.data[start:stop]
+
+    def read_string(self):
+        # the opening quote has already been seen
+        self.pos += 1
+        builder = StringBuilder()
+        while True:
+            if self.eof():
+                raise self.error("unterminated string")
+            c = self.data[self.pos]
+            self.pos += 1
+            if c == '"':
+                return builder.build()
+            if c != '\\':
+                builder.append(c)
+                continue
+            if self.eof():
+                raise self.error("unterminated string")
+            e = self.data[self.pos]
+            if e == 'x' and self.ensure(3):
+                hi = _hex_value(self.data[self.pos + 1])
+                lo = _hex_value(self.data[self.pos + 2])
+                if hi >= 0 and lo >= 0:
+                    builder.append(chr(hi * 16 + lo))
+                    self.pos += 3
+                    continue
+            if e in string_escape_table:
+                builder.append(string_escape_table[e])
+                self.pos += 1
+                continue
+            # unknown escapes are left as they are
+            builder.append('\\')
+
+    def atom(self, token):
+        if token == 'nil':
+            return None
+        start = 0
+        if token[0] == '-' and len(token) > 1:
+            start = 1
+        if _all_digits(token, start, len(token)):
+            return make_int(int(token))
+        dot = token.find('.')
+        if dot > start and _all_digits(token, start, dot) and _all_digits(token, dot + 1, len(token)):
+            return Float(float(token))
+        try:
+            return intern(token)
+        except InvalidValue, e:
+            raise self.error(e.message)
+
+    def read(self):
+        # reads one value; the caller must check at_end first
+        stack = []
+        while True:
+            self.skip_whitespace()
+            if self.eof():
+                raise self.error("unexpected end of input")
+            c = self.data[self.pos]
+            if c == '(' or c == '[':
+                self.pos += 1
+                if c == '(':
+                    stack.append(_Open(')', None))
+                else:
+                    stack.append(_Open(']', None))
+                continue
+            elif c == "'" or c == '`' or c == ',':
+                self.pos += 1
+                prefix = c
+                if c == ',' and not self.eof() and self.data[self.pos] == '@':
+                    self.pos += 1
+                    prefix = ',@'
+                stack.append(_Open('', intern(_prefixes[prefix])))
+                continue
+            elif c == ')' or c == ']':
+                if len(stack) == 0 or stack[-1].close != c:
+                    raise self.error("unexpected '" + c + "'")
+                self.pos += 1
+                top = stack.pop()
+                if top.dotted == 1:
+                    raise self.error("expected a value after '.'")
+                value = top.tail
+                i = len(top.items) - 1
+                while i >= 0:
+                    value = Cell(top.items[i], value)
+                    i -= 1
+            elif c == '"':
+                value = String(self.read_string())
+            else:
+                token = self.read_token()
+                if token == '.':
+                    if len(stack) == 0 or stack[-1].close == '' or len(stack[-1].items) == 0 or stack[-1].dotted != 0:
+                        raise self.error("unexpected '.'")
+                    stack[-1].dotted = 1
+                    continue
+                value = self.atom(token)
+
+            # a complete value; give it to whatever is waiting for one
+            while len(stack) > 0 and stack[-1].prefix is not None:
+                top = stack.pop()
+                value = Cell(top.prefix, Cell(value))
+            if len(stack) == 0:
+                return value
+            top = stack[-1]
+            if top.dotted == 1:
+                top.tail = value
+                top.dotted = 2
+            elif top.dotted == 2:
+                raise self.error("more than one value after '.'")
+            else:
+                top.items.append(value)
+
+    def read_all(self):
+        values = []
+        while not self.at_end():
+            values.append(self.read())
+        return values
+
+class FileReader(Reader):
+    # reads from a file descriptor a chunk at a time, keeping only the
+    # unread data (and the token in progress) in memory
+    chunk_size = 65536
+
+    def __init__(self, fd):
+        Reader.__init__(self, "")
+        self.fd = fd
+        self.done = False
+
+    def fill(self):
+        if self.done:
+            return False
+        keep = self.pos
+        if self.token_start >= 0:
+            keep = self.token_start
+        size = self.chunk_size
+        if len(self.data) - keep > size:
+            size = len(self.data) - keep
+        chunk = self.read_chunk(size)
+        if len(chunk) == 0:
+            self.done = True
+            return False
+        for i in range(keep):
+            if self.data[i] == '\n':
+                self.lines_before += 1
+        assert keep >= 0
+        self.data = self.data[keep:] + chunk
+        self.pos -= keep
+        if self.token_start >= 0:
+            self.token_start -= keep
+        return True
+
+    def read_chunk(self, size):
+        # up to size more bytes, or "" at the end of the file
+        return os.read(self.fd, size)
 
 def parse(code):
-    t = parsefunc(code)
-    ast = toAST().transform(t)
-    return ast_to_types(ast)
+    # every value in code, as a lisp list
+    values = Reader(code).read_all()
+    ret = None
+    i = len(values) - 1
+    while i >= 0:
+        ret = Cell(values[i], ret)
+        i -= 1
+    return ret
@@ -0,0 +1,240 @@
+import os
+
+from .types import BoxedType
+from .parser import FileReader
+
+# how an output port decides when to hand its buffer to the OS
+BUFFER_NONE = 0
+BUFFER_LINE = 1
+BUFFER_BLOCK = 2
+
+buffer_modes = ['none', 'line', 'block']
+
+class PortError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+def write_all(fd, data):
+    # os.write may take less than it was given
+    total = 0
+    while total < len(data):
+        total += os.write(fd, data[total:])
+    return total
+
+class OutputPort(BoxedType):
+    buffer_size = 65536
+
+    def __init__(self, fd, name, mode, owns_fd=True):
+        self.fd = fd
+        self.name = name
+        self.mode = mode
+        # closing a port doesn't close stdout or stderr
+        self.owns_fd = owns_fd
+        self.closed = False
+        self.pieces = []
+        self.pending = 0
+
+    def unparse(self):
+        return "#<output-port #%s>" % (self.name,)
+
+    def write(self, data):
+        if self.closed:
+            raise PortError("port is closed")
+        self.pieces.append(data)
+        self.pending += len(data)
+        if self.mode == BUFFER_NONE or self.pending >= self.buffer_size:
+            self.flush()
+        elif self.mode == BUFFER_LINE and data.find('\n') >= 0:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        data = "".join(self.pieces)
+        self.pieces = []
+        self.pending = 0
+        try:
+            write_all(self.fd, data)
+        except OSError:
+            raise PortError("could not write to " + self.name)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.closed = True
+            ports.remove(self)
+            if self.owns_fd:
+                os.close(self.fd)
+
+class PortState(object):
+    # every output port still open, so they can all be flushed at exit
+    def __init__(self):
+        self.open = []
+
+    def add(self, port):
+        self.open.append(port)
+
+    def remove(self, port):
+        for i in range(len(self.open)):
+            if self.open[i] is port:
+                del self.open[i]
+                return
+
+ports = PortState()
+
+stdout = OutputPort(1, 'stdout', BUFFER_LINE, False)
+stderr = OutputPort(2, 'stderr', BUFFER_NONE, False)
+ports.add(stdout)
+ports.add(stderr)
+
+class InputPort(BoxedType):
+    # reads through a parser.FileReader, so lines, characters and whole
+    # forms can be mixed, and only the unread part of the current chunk
+    # is held in memory
+    def __init__(self, fd, name, reader, owns_fd=True):
+        self.fd = fd
+        self.name = name
+        self.reader = reader
+        self.owns_fd = owns_fd
+        self.closed = False
+        # flushed before every read, so a prompt shows up in time
+        self.tied = None
+
+    def unparse(self):
+        return "#<input-port #%s>" % (self.name,)
+
+    def _start(self):
+        if self.closed:
+            raise PortError("port is closed")
+        if self.tied is not None:
+            self.tied.flush()
+
+    def read_line(self):
+        # the next line, without its newline, or None at the end
+        self._start()
+        reader = self.reader
+        searched = 0
+        while True:
+            start = reader.pos
+            assert start >= 0
+            search = start + searched
+            assert search >= 0
+            i = reader.data.find('\n', search)
+            if i >= 0:
+                reader.pos = i + 1
+                return reader.data[start:i]
+            searched = len(reader.data) - start
+            if not reader.fill():
+                break
+        start = reader.pos
+        assert start >= 0
+        if start >= len(reader.data):
+            return None
+        reader.pos = len(reader.data)
+        return reader.data[start:]
+
+    def read_char(self):
+        self._start()
+        reader = self.reader
+        if reader.eof():
+            return None
+        c = reader.data[reader.pos]
+        reader.pos += 1
+        return c
+
+    def read_bytes(self, count):
+        # up to count bytes; fewer only at the end, and None after it.
+        # a count of 0 always gets "", even there
+        self._start()
+        if count == 0:
+            return ""
+        reader = self.reader
+        reader.ensure(count)
+        end = reader.pos + count
+        if end > len(reader.data):
+            end = len(reader.data)
+        if end <= reader.pos:
+            return None
+        start = reader.pos
+        assert start >= 0 and end >= 0
+        reader.pos = end
+        return reader.data[start:end]
+
+    def read_sexp(self):
+        # the next form, checking at_end first; a ParseError on bad input
+        self._start()
+        return self.reader.read()
+
+    def at_end(self):
+        self._start()
+        return self.reader.at_end()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.owns_fd:
+            os.close(self.fd)
+
+stdin = InputPort(0, 'stdin', FileReader(0), False)
+stdin.tied = stdout
+
+def open_input_file(path):
+    try:
+        fd = os.open(path, os.O_RDONLY, 0777)
+    except OSError:
+        raise PortError("could not open " + path)
+    return InputPort(fd, path, FileReader(fd))
+
+def open_output_file(path, append):
+    flags = os.O_WRONLY | os.O_CREAT
+    if append:
+        flags |= os.O_APPEND
+    else:
+        flags |= os.O_TRUNC
+    try:
+        fd = os.open(path, flags, 0666)
+    except OSError:
+        raise PortError("could not open " + path)
+    port = OutputPort(fd, path, BUFFER_BLOCK)
+    ports.add(port)
+    return port
+
+def closed_output_port(name):
+    # what a port saved in an image comes back as; the file it wrote to
+    # was opened by the process that saved it
+    port = OutputPort(-1, name, BUFFER_BLOCK, False)
+    port.closed = True
+    return port
+
+def closed_input_port(name):
+    port = InputPort(-1, name, FileReader(-1), False)
+    port.closed = True
+    return port
+
+def standard_port(name):
+    # the port a symbol like 'stdout names, or None
+    if name == 'stdout':
+        return stdout
+    if name == 'stderr':
+        return stderr
+    return None
+
+def setup():
+    # a terminal sees each line as it's finished; anything else gets
+    # whole blocks
+    if not os.isatty(1):
+        stdout.mode = BUFFER_BLOCK
+
+def flush_all():
+    # at exit and before reporting an error; a port that can't be
+    # written any more is no reason to fail then
+    for port in ports.open:
+        try:
+            port.flush()
+        except PortError:
+            pass
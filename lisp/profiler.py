@@ -0,0 +1,122 @@
+import time
+
+# a deterministic profiler: eval hands every procedure call to the
+# current Profiler, if there is one. the check is on a quasi-immutable
+# field, so with profiling off the JIT removes it entirely.
+#
+# a call stays open until the tail calls it hands back to eval have
+# finished, so they're part of its cumulative time rather than its
+# caller's. a tail call back to a procedure still open in the same
+# chain (tail recursion, say) finishes the calls above it and carries
+# on as that one, so a loop written as a tail call doesn't pile up.
+
+class ProfileState(object):
+    _immutable_fields_ = ['profiler?']
+    def __init__(self):
+        self.profiler = None
+
+state = ProfileState()
+
+class ProfileEntry(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.self_time = 0.0
+        self.total_time = 0.0
+        # calls to this entry currently running, so recursion doesn't
+        # count the same time twice in total_time
+        self.active = 0
+
+class _Call(object):
+    def __init__(self, entry, start):
+        self.entry = entry
+        self.start = start
+        self.child_time = 0.0
+
+class Profiler(object):
+    def __init__(self):
+        self.entries = {}
+        self.by_procedure = {}
+        self.stack = []
+
+    def entry(self, function):
+        try:
+            return self.by_procedure[function]
+        except KeyError:
+            pass
+        name = function.profile_name()
+        try:
+            entry = self.entries[name]
+        except KeyError:
+            entry = ProfileEntry(name)
+            self.entries[name] = entry
+        self.by_procedure[function] = entry
+        return entry
+
+    def depth(self):
+        return len(self.stack)
+
+    def enter(self, function, base):
+        # a call in the chain of tail calls whose calls start at
+        # stack[base]
+        entry = self.entry(function)
+        entry.calls += 1
+        i = len(self.stack) - 1
+        while i >= base:
+            if self.stack[i].entry is entry:
+                self.leave_to(i + 1)
+                return
+            i -= 1
+        entry.active += 1
+        self.stack.append(_Call(entry, time.time()))
+
+    def leave_to(self, depth):
+        # finishes calls, innermost first, until depth are left
+        while len(self.stack) > depth:
+            call = self.stack.pop()
+            elapsed = time.time() - call.start
+            entry = call.entry
+            entry.active -= 1
+            entry.self_time += elapsed - call.child_time
+            if entry.active == 0:
+                entry.total_time += elapsed
+            if len(self.stack) > 0:
+                self.stack[-1].child_time += elapsed
+
+    def sorted_entries(self):
+        # by cumulative time, slowest first
+        entries = self.entries.values()
+        for i in range(1, len(entries)):
+            entry = entries[i]
+            j = i - 1
+            while j >= 0 and entries[j].total_time < entry.total_time:
+                entries[j + 1] = entries[j]
+                j -= 1
+            entries[j + 1] = entry
+        return entries
+
+    def report(self):
+        ret = _pad("calls", 10) + _pad("self", 12) + _pad("cumulative", 12) + "  procedure\n"
+        for entry in self.sorted_entries():
+            ret += _pad(str(entry.calls), 10) + _pad(_seconds(entry.self_time), 12)
+            ret += _pad(_seconds(entry.total_time), 12) + "  " + entry.name + "\n"
+        return ret
+
+def _pad(s, width):
+    if len(s) >= width:
+        return s
+    return ' ' * (width - len(s)) + s
+
+def _seconds(t):
+    # microseconds are plenty, and str() on a float isn't fixed-width
+    micros = int(t * 1000000.0)
+    frac = str(micros % 1000000)
+    return str(micros / 1000000) + "." + "0" * (6 - len(frac)) + frac
+
+def start():
+    profiler = Profiler()
+    state.profiler = profiler
+    return profiler
+
+def stop(previous):
+    state.profiler = previous
@@ -0,0 +1,258 @@
+from .types import Cell, Symbol, intern
+from .scope import Frame, FrameLayout, NameNotSet, frame_layouts
+
+from pypy.rlib.jit import unroll_safe
+
+class LexicalSymbol(Symbol):
+    # a symbol whose frame address was worked out when its lambda or let
+    # was built. path holds the layout we expect to find at each depth; if
+    # the frames we walk at runtime don't match (say, a macro wrapped us in
+    # a let we couldn't see), we fall back to an ordinary lookup by name.
+    # a slot of -1 means the name isn't bound lexically at all.
+    _immutable_fields_ = ['depth', 'slot', 'path[*]']
+    def __init__(self, name, depth, slot, path):
+        # never interned itself; it stands in for the interned symbol
+        self.name = name
+        self.canonical = intern(name)
+        self.depth = depth
+        self.slot = slot
+        self.path = path[:]
+
+    @unroll_safe
+    def _walk(self, scope):
+        i = 0
+        while i < self.depth:
+            if not isinstance(scope, Frame):
+                return None
+            if scope.layout is not self.path[i]:
+                return None
+            if scope.has_extra(self.name):
+                return None
+            scope = scope.parent
+            i += 1
+        return scope
+
+    def _target(self, scope):
+        found = self._walk(scope)
+        if isinstance(found, Frame) and found.layout is self.path[self.depth]:
+            return found
+        return None
+
+    def lookup(self, scope):
+        if self.slot >= 0:
+            frame = self._target(scope)
+            if frame is not None:
+                return frame.values[self.slot]
+        else:
+            found = self._walk(scope)
+            if found is not None:
+                return found.get(self.name)
+        return scope.get(self.name)
+
+    def store(self, scope, val):
+        if self.slot >= 0:
+            frame = self._target(scope)
+            if frame is not None:
+                frame.values[self.slot] = val
+                return
+        scope.set(self.name, val)
+
+class ResolvedCell(Cell):
+    # marks the argument list of a lambda, or the binding list of a let,
+    # whose body has already been resolved against this layout
+    _immutable_fields_ = ['layout']
+    def __init__(self, car, cdr, layout):
+        Cell.__init__(self, car, cdr)
+        self.layout = layout
+
+def lambda_layout(required, optional, restname):
+    names = required + optional
+    if restname is not None:
+        names = names + [restname]
+    return FrameLayout(names)
+
+def _lambda_list_layout(args):
+    # mirrors the checks in _l_lambda_macro; returns None on anything it
+    # would reject, so the error still happens at runtime
+    phase = 0
+    required = []
+    optional = []
+    restname = None
+    while args is not None:
+        if not isinstance(args, Cell):
+            return None
+        sexp = args.car
+        args = args.cdr
+        if not isinstance(sexp, Symbol):
+            return None
+        name = sexp.name
+        if name == "&optional":
+            if phase != 0:
+                return None
+            phase = 1
+        elif name == "&rest":
+            if phase == 2:
+                return None
+            phase = 2
+        elif phase == 0:
+            required.append(name)
+        elif phase == 1:
+            optional.append(name)
+        else:
+            restname = name
+    return lambda_layout(required, optional, restname)
+
+# the builtins whose forms bind names in their bodies, by name; filled in
+# by lisp.builtins once they've been made
+binding_forms = {}
+
+def _binds(name, env, scope):
+    # whether name still means the builtin that binds names: it mustn't
+    # be shadowed by a name in env, and scope must have it bound to the
+    # builtin. if not, the form is resolved as an ordinary call
+    for layout in env:
+        if layout.index(name) >= 0:
+            return False
+    try:
+        return scope.get(name) is binding_forms[name]
+    except NameNotSet:
+        return False
+
+def address(name, env):
+    depth = 0
+    while depth < len(env):
+        slot = env[depth].index(name)
+        if slot >= 0:
+            return LexicalSymbol(name, depth, slot, env[:depth + 1])
+        depth += 1
+    return LexicalSymbol(name, depth, -1, env)
+
+def _is_unquote(sexp):
+    if not isinstance(sexp, Cell):
+        return False
+    head = sexp.car
+    if not isinstance(head, Symbol):
+        return False
+    name = head.name
+    return name == 'unquote' or name == 'unquote-splicing'
+
+def _rebuild(items, tail):
+    i = len(items) - 1
+    while i >= 0:
+        tail = Cell(items[i], tail)
+        i -= 1
+    return tail
+
+def resolve_each(sexp, env, scope):
+    items = []
+    while isinstance(sexp, Cell):
+        items.append(resolve(sexp.car, env, scope))
+        sexp = sexp.cdr
+    return _rebuild(items, resolve(sexp, env, scope))
+
+def resolve_template(sexp, env, scope):
+    # only the unquoted parts of a quasiquote template get evaluated
+    if not isinstance(sexp, Cell):
+        return sexp
+    if _is_unquote(sexp):
+        return Cell(sexp.car, resolve_each(sexp.cdr, env, scope))
+    items = []
+    while isinstance(sexp, Cell) and not _is_unquote(sexp):
+        items.append(resolve_template(sexp.car, env, scope))
+        sexp = sexp.cdr
+    if isinstance(sexp, Cell):
+        sexp = resolve_template(sexp, env, scope)
+    return _rebuild(items, sexp)
+
+def _resolve_lambda(sexp, env, scope):
+    # (lambda args . body)
+    rest = sexp.cdr
+    if not isinstance(rest, Cell) or not isinstance(rest.car, Cell):
+        return resolve_each(sexp, env, scope)
+    args = rest.car
+    layout = _lambda_list_layout(args)
+    if layout is None:
+        return resolve_each(sexp, env, scope)
+    assert isinstance(args, Cell)
+    args = ResolvedCell(args.car, args.cdr, layout)
+    body = resolve_each(rest.cdr, [layout] + env, scope)
+    return Cell(resolve(sexp.car, env, scope), Cell(args, body))
+
+def _resolve_let(sexp, env, scope):
+    # (let ((name value) ...) . body)
+    rest = sexp.cdr
+    if not isinstance(rest, Cell) or not isinstance(rest.car, Cell):
+        return resolve_each(sexp, env, scope)
+    names = []
+    bindings = []
+    b = rest.car
+    while b is not None:
+        if not isinstance(b, Cell):
+            return resolve_each(sexp, env, scope)
+        binding = b.car
+        if not isinstance(binding, Cell) or not isinstance(binding.car, Symbol):
+            return resolve_each(sexp, env, scope)
+        value = binding.cdr
+        if not isinstance(value, Cell) or value.cdr is not None:
+            return resolve_each(sexp, env, scope)
+        symbol = binding.car
+        assert isinstance(symbol, Symbol)
+        names.append(symbol.name)
+        bindings.append(Cell(symbol, Cell(resolve(value.car, env, scope))))
+        b = b.cdr
+    layout = FrameLayout(names)
+    resolved = ResolvedCell(bindings[0], _rebuild(bindings[1:], None), layout)
+    body = resolve_each(rest.cdr, [layout] + env, scope)
+    return Cell(resolve(sexp.car, env, scope), Cell(resolved, body))
+
+def _resolve_dolist(sexp, env, scope):
+    # (dolist (name list [result]) . body)
+    rest = sexp.cdr
+    if not isinstance(rest, Cell) or not isinstance(rest.car, Cell):
+        return resolve_each(sexp, env, scope)
+    binding = rest.car
+    assert isinstance(binding, Cell)
+    symbol = binding.car
+    parts = binding.cdr
+    if not isinstance(symbol, Symbol) or not isinstance(parts, Cell):
+        return resolve_each(sexp, env, scope)
+    result = parts.cdr
+    if result is not None and (not isinstance(result, Cell) or result.cdr is not None):
+        return resolve_each(sexp, env, scope)
+    layout = FrameLayout([symbol.name])
+    inner = [layout] + env
+    if result is not None:
+        assert isinstance(result, Cell)
+        result = Cell(resolve(result.car, inner, scope))
+    # the list is evaluated outside the loop's frame
+    resolved = ResolvedCell(symbol, Cell(resolve(parts.car, env, scope), result), layout)
+    body = resolve_each(rest.cdr, inner, scope)
+    return Cell(resolve(sexp.car, env, scope), Cell(resolved, body))
+
+def resolve(sexp, env, scope):
+    if isinstance(sexp, Symbol):
+        return address(sexp.name, env)
+    if not isinstance(sexp, Cell):
+        return sexp
+    head = sexp.car
+    if isinstance(head, Symbol):
+        name = head.name
+        if name == 'quote':
+            return sexp
+        if name == 'quasiquote':
+            return Cell(resolve(head, env, scope), resolve_template(sexp.cdr, env, scope))
+        if name in binding_forms and _binds(name, env, scope):
+            if name == 'lambda' or name == 'macro':
+                return _resolve_lambda(sexp, env, scope)
+            if name == 'let':
+                return _resolve_let(sexp, env, scope)
+            if name == 'dolist':
+                return _resolve_dolist(sexp, env, scope)
+    return resolve_each(sexp, env, scope)
+
+def resolve_body(body, layout, scope):
+    env = [layout] + frame_layouts(scope)
+    resolved = []
+    for sexp in body:
+        resolved.append(resolve(sexp, env, scope))
+    return resolved
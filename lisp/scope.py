@@ -74,3 +74,81 @@ class Scope(object):
             return self._get_semiconstant(name, sc_version)
         else:
             return self._get_intern(name)
+
+class FrameLayout(object):
+    _immutable_fields_ = ['names[*]', 'indices']
+    def __init__(self, names):
+        self.names = names[:]
+        self.indices = {}
+        for i in range(len(names)):
+            self.indices[names[i]] = i
+    
+    def size(self):
+        return len(self.names)
+    
+    @purefunction
+    def index(self, name):
+        return self.indices.get(name, -1)
+
+class Frame(Scope):
+    # a scope whose names are fixed by a shared layout, so the values
+    # can live in a plain array; anything set at runtime that isn't in
+    # the layout goes into an overflow table
+    _immutable_fields_ = ['layout', 'values']
+    def __init__(self, parent, layout, values):
+        assert parent is not None
+        self.parent = parent
+        self.layout = layout
+        self.values = values
+        self.table = None
+    
+    def has_extra(self, name):
+        return self.table is not None and name in self.table
+    
+    def is_set(self, name):
+        if self.layout.index(name) >= 0:
+            return True
+        if self.has_extra(name):
+            return True
+        return self.parent.is_set(name)
+    
+    def _set_intern(self, name, val, local_only):
+        i = self.layout.index(name)
+        if i >= 0:
+            self.values[i] = val
+        elif self.has_extra(name):
+            self.table[name] = val
+        elif not local_only and self.parent.is_set(name):
+            self.parent.set(name, val)
+        else:
+            if self.table is None:
+                self.table = {}
+            self.table[name] = val
+    def set_semiconstant(self, name, val, local_only=False):
+        # frames are never promoted, so there's no version to bump here
+        if not local_only and self.layout.index(name) < 0 and not self.has_extra(name) and self.parent.is_set(name):
+            self.parent.set_semiconstant(name, val)
+        else:
+            self._set_intern(name, val, True)
+    def set(self, name, val, local_only=False):
+        self._set_intern(name, val, local_only)
+    
+    def _get_intern(self, name):
+        i = self.layout.index(name)
+        if i >= 0:
+            return self.values[i]
+        if self.table is not None:
+            try:
+                return self.table[name]
+            except KeyError:
+                pass
+        return self.parent.get(name)
+    def get(self, name):
+        return self._get_intern(name)
+
+def frame_layouts(scope):
+    layouts = []
+    while isinstance(scope, Frame):
+        layouts.append(scope.layout)
+        scope = scope.parent
+    return layouts
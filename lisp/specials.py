@@ -0,0 +1,26 @@
+from .types import Cell
+from .builtins.procedure import procedures
+
+# the builtins that the closure engine and the compiler both handle
+# themselves, with their own nodes or bytecode, rather than by calling
+special_names = ['quote', 'if', 'begin', 'and', 'or', 'let', 'while', 'dolist', 'setq', 'lambda', 'macro']
+specials = {}
+
+def find_special(name):
+    # filled on first use, since builtins may import the engines before
+    # every procedure is registered
+    if len(specials) == 0:
+        for proc in procedures:
+            if proc.name in special_names:
+                specials[proc.name] = proc
+    return specials.get(name, None)
+
+def arg_list(args):
+    # the elements of a proper list, or None if it isn't one
+    ret = []
+    while args is not None:
+        if not isinstance(args, Cell):
+            return None
+        ret.append(args.car)
+        args = args.cdr
+    return ret
@@ -1,10 +1,27 @@
 from pypy.rlib.jit import elidable as purefunction
+from pypy.rlib.objectmodel import r_dict, compute_hash, compute_identity_hash
+from pypy.rlib.rarithmetic import intmask
+from pypy.rlib.rstring import StringBuilder
 
 class LispType(object):
     def unparse(self):
         raise NotImplementedError("unparse")
     def eq(self, other):
         raise NotImplementedError("eq")
+    def hash(self):
+        # must agree with eq: values that are eq hash the same
+        raise NotImplementedError("hash")
+
+def eq_values(val1, val2):
+    # eq, for values that may be nil
+    if val1 is None:
+        return val2 is None
+    return val1.eq(val2)
+
+def hash_value(val):
+    if val is None:
+        return 0
+    return val.hash()
 
 class BoxedType(LispType):
     @purefunction
@@ -12,42 +29,59 @@ class BoxedType(LispType):
         if not isinstance(other, BoxedType):
             return False
         return (self is other)
+    def hash(self):
+        return compute_identity_hash(self)
 
 class InvalidValue(Exception):
-    pass
+    def __init__(self, message):
+        self.message = message
 
 class Cell(LispType):
     _immutable_fields_ = ['car', 'cdr']
     def __init__(self, car, cdr=None):
         self.car = car
         self.cdr = cdr
-    def _unparse_internal(self):
-        gather = ""
-        if self.car is None:
-            gather += "nil"
-        else:
-            gather += self.car.unparse()
-        if self.cdr is not None:
-            if isinstance(self.cdr, Cell):
-                gather += ' ' + self.cdr._unparse_internal()
-            else:
-                gather += ' . ' + self.cdr.unparse()
-        return gather
     def unparse(self):
-        return "(" + self._unparse_internal() + ")"
+        return unparse_string(self)
     @purefunction
     def eq(self, other):
-        if not isinstance(other, Cell):
-            return False
-        if self.car is None and other.car is None:
-            return True
-        if self.car is not None and self.car.eq(other.car):
-            return True
-        if self.cdr is None and other.cdr is None:
-            return True
-        if self.cdr is not None and self.cdr.eq(other.cdr):
-            return True
-        return False
+        # the same shape, with eq atoms. nested lists wait on a stack of
+        # pairs still to compare, so neither depth nor length recurses
+        stack = [self, other]
+        while len(stack) > 0:
+            b = stack.pop()
+            a = stack.pop()
+            while isinstance(a, Cell):
+                if not isinstance(b, Cell):
+                    return False
+                if isinstance(a.car, Cell):
+                    stack.append(a.car)
+                    stack.append(b.car)
+                elif not eq_values(a.car, b.car):
+                    return False
+                a = a.cdr
+                b = b.cdr
+            if not eq_values(a, b):
+                return False
+        return True
+    @purefunction
+    def hash(self):
+        # walks the lists in the same order as eq; a nested list mixes in
+        # a marker where it starts, and its contents when it's reached
+        ret = 0x345678
+        stack = [self]
+        while len(stack) > 0:
+            sexp = stack.pop()
+            while isinstance(sexp, Cell):
+                car = sexp.car
+                if isinstance(car, Cell):
+                    stack.append(car)
+                    ret = intmask((ret * 1000003) ^ 0x2f)
+                else:
+                    ret = intmask((ret * 1000003) ^ hash_value(car))
+                sexp = sexp.cdr
+            ret = intmask(ret ^ hash_value(sexp))
+        return ret
     @purefunction
     def to_list(self):
         ret = []
@@ -59,6 +93,73 @@ class Cell(LispType):
             sexp = sexp.cdr
         return ret
 
+def is_list(sexp):
+    # nil, or cells all the way to a nil
+    while isinstance(sexp, Cell):
+        sexp = sexp.cdr
+    return sexp is None
+
+class Unparser(object):
+    # writes out the text of a value a piece at a time, without recursing,
+    # so neither the depth nor the length of a list is limited. where the
+    # pieces go is up to emit.
+    def emit(self, s):
+        raise NotImplementedError("emit")
+    
+    def unparse(self, value):
+        # the cells whose car is being written, innermost last
+        stack = []
+        while True:
+            if isinstance(value, Cell):
+                self.emit("(")
+                stack.append(value)
+                value = value.car
+                continue
+            self.unparse_atom(value)
+            # close every list that just ended, and move on to the next
+            # element of the innermost one still open
+            while len(stack) > 0:
+                cell = stack[-1]
+                rest = cell.cdr
+                if isinstance(rest, Cell):
+                    self.emit(" ")
+                    stack[-1] = rest
+                    break
+                if rest is not None:
+                    self.emit(" . ")
+                    self.unparse_atom(rest)
+                self.emit(")")
+                stack.pop()
+            if len(stack) == 0:
+                return
+            value = stack[-1].car
+    
+    def unparse_atom(self, value):
+        if value is None:
+            self.emit("nil")
+        elif isinstance(value, Vector):
+            self.emit("#(")
+            for i in range(value.length()):
+                if i > 0:
+                    self.emit(" ")
+                self.emit(value.ref(i).unparse())
+            self.emit(")")
+        else:
+            self.emit(value.unparse())
+
+class StringUnparser(Unparser):
+    def __init__(self):
+        self.builder = StringBuilder()
+    def emit(self, s):
+        self.builder.append(s)
+    def build(self):
+        return self.builder.build()
+
+def unparse_string(value):
+    unparser = StringUnparser()
+    unparser.unparse(value)
+    return unparser.build()
+
 class Number(LispType):
     def get_float(self):
         raise NotImplementedError('get_float')
@@ -76,6 +177,18 @@ class Integer(Number):
         if not isinstance(other, Integer):
             return False
         return self.value == other.value
+    def hash(self):
+        return self.value
+
+# integers in this range are preallocated, and shared by make_int
+SMALL_INT_MIN = -128
+SMALL_INT_MAX = 1024
+small_ints = [Integer(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
+
+def make_int(value):
+    if value >= SMALL_INT_MIN and value <= SMALL_INT_MAX:
+        return small_ints[value - SMALL_INT_MIN]
+    return Integer(value)
 
 class Float(Number):
     _immutable_fields_ = ['value']
@@ -90,23 +203,95 @@ class Float(Number):
         if not isinstance(other, Float):
             return False
         return self.value == other.value
+    def hash(self):
+        return compute_hash(self.value)
+
+class Vector(LispType):
+    # a fixed-length array of numbers, all integers or all floats
+    def length(self):
+        raise NotImplementedError('length')
+    def ref(self, i):
+        raise NotImplementedError('ref')
+    def set(self, i, val):
+        raise NotImplementedError('set')
+    def floats(self):
+        # the contents as floats; may be the vector's own storage
+        raise NotImplementedError('floats')
+    def unparse(self):
+        return unparse_string(self)
+    @purefunction
+    def eq(self, other):
+        if not isinstance(other, Vector):
+            return False
+        return (self is other)
+    def hash(self):
+        return compute_identity_hash(self)
+
+class IntVector(Vector):
+    _immutable_fields_ = ['values']
+    def __init__(self, values):
+        self.values = values
+    def length(self):
+        return len(self.values)
+    def ref(self, i):
+        return make_int(self.values[i])
+    def set(self, i, val):
+        if not isinstance(val, Integer):
+            raise InvalidValue("value is not an integer")
+        self.values[i] = val.value
+    def floats(self):
+        return [float(x) for x in self.values]
+
+class FloatVector(Vector):
+    _immutable_fields_ = ['values']
+    def __init__(self, values):
+        self.values = values
+    def length(self):
+        return len(self.values)
+    def ref(self, i):
+        return Float(self.values[i])
+    def set(self, i, val):
+        if not isinstance(val, Number):
+            raise InvalidValue("value is not a number")
+        self.values[i] = val.get_float()
+    def floats(self):
+        return self.values
 
 _symbol_disallowed = "\".`',; \n\r\t()[]";
 
+# the interned symbol for each name. any other Symbol with the same name
+# points at it through canonical, so eq is an identity check
+symbol_table = {}
+
 class Symbol(LispType):
-    _immutable_fields_ = ['name']
+    _immutable_fields_ = ['name', 'canonical']
     def __init__(self, name):
-        for c in name:
-            if c in _symbol_disallowed:
-                raise InvalidValue("character not allowed in symbols: '%s'" % (c,))
+        canonical = symbol_table.get(name, None)
+        if canonical is None:
+            for c in name:
+                if c in _symbol_disallowed:
+                    raise InvalidValue("character not allowed in symbols: '%s'" % (c,))
+            symbol_table[name] = self
+            canonical = self
         self.name = name
+        self.canonical = canonical
     def unparse(self):
         return self.name
     @purefunction
     def eq(self, other):
         if not isinstance(other, Symbol):
             return False
-        return self.name == other.name
+        return self.canonical is other.canonical
+    def hash(self):
+        return compute_identity_hash(self.canonical)
+
+def intern(name):
+    sym = symbol_table.get(name, None)
+    if sym is None:
+        sym = Symbol(name)
+    return sym
+
+T = intern('t')
 
 class String(LispType):
     _immutable_fields_ = ['data']
@@ -119,16 +304,100 @@ class String(LispType):
         if not isinstance(other, String):
             return False
         return self.data == other.data
+    def hash(self):
+        return compute_hash(self.data)
 
 class Procedure(LispType):
+    # set by every kind of procedure to what it takes
+    _immutable_fields_ = ['arity']
+    arity = None
     def __init__(self, name="f"):
         self.name = name
     def unparse(self):
         return "#<procedure #%s>" % (self.name,)
+    def profile_name(self):
+        # what the profiler reports calls to this as
+        return self.name
     def call(self, scope, args):
         raise NotImplementedError('call')
+    def call_tail(self, scope, args):
+        # may return an eval.TailCall instead of a value
+        return self.call(scope, args)
+    def accepts(self, num):
+        # whether a call with num arguments would get past the arity check
+        if self.arity is None:
+            return True
+        return self.arity.accepts(num)
+    def is_strict(self):
+        # true if call just evaluates each argument once, in order, so
+        # apply can be handed the values directly
+        return False
+    def apply(self, scope, values):
+        args = None
+        i = len(values) - 1
+        while i >= 0:
+            args = Cell(Cell(intern('quote'), Cell(values[i])), args)
+            i -= 1
+        return self.call(scope, args)
+    def apply2(self, scope, val1, val2):
+        # apply, for exactly two values
+        return self.apply(scope, [val1, val2])
     @purefunction
     def eq(self, other):
         if not isinstance(other, Procedure):
             return False
         return (self is other)
+    def hash(self):
+        return compute_identity_hash(self)
+
+class NilKey(LispType):
+    # stands in for nil as a key, since a dict can't hold None keys
+    def eq(self, other):
+        return self is other
+    def hash(self):
+        return 0
+
+nil_key = NilKey()
+
+def _key_eq(a, b):
+    return a.eq(b)
+
+def _key_hash(a):
+    return a.hash()
+
+class HashTable(LispType):
+    # keys are compared with eq, so lists and strings are looked up by
+    # contents; vectors, procedures and boxed values by identity
+    def __init__(self):
+        self.table = r_dict(_key_eq, _key_hash)
+    def unparse(self):
+        return "#<hash-table " + str(len(self.table)) + ">"
+    @purefunction
+    def eq(self, other):
+        return self is other
+    def hash(self):
+        return compute_identity_hash(self)
+    def _key(self, key):
+        if key is None:
+            return nil_key
+        return key
+    def get(self, key, default):
+        return self.table.get(self._key(key), default)
+    def set(self, key, value):
+        self.table[self._key(key)] = value
+    def remove(self, key):
+        # true if the key was there
+        key = self._key(key)
+        if key in self.table:
+            del self.table[key]
+            return True
+        return False
+    def count(self):
+        return len(self.table)
+    def keys(self):
+        ret = None
+        for key in self.table.keys():
+            if key is nil_key:
+                key = None
+            ret = Cell(key, ret)
+        return ret
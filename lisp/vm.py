@@ -0,0 +1,249 @@
+from .types import Cell, Symbol, Procedure, is_list
+from .scope import Frame, NameNotSet
+from .resolver import LexicalSymbol
+from .eval import EvalException, eval
+from .builtins.procedure import LambdaProcedure, name_procedure
+from .compiler import compiled_code, compile_form, opnames
+from .compiler import LOAD_CONST, LOAD_LOCAL, LOAD_GLOBAL, STORE, POP, JUMP
+from .compiler import JUMP_IF_NIL, JUMP_IF_NIL_KEEP, JUMP_IF_TRUE_KEEP, GUARD
+from .compiler import CALL_PREPARE, CALL_FORM, CALL, TAIL_CALL, RETURN
+from .compiler import PUSH_FRAME, POP_FRAME, MAKE_CLOSURE, DOLIST_START, DOLIST_NEXT
+
+from pypy.rlib.jit import JitDriver, unroll_safe, hint
+
+# runs the bytecode from lisp.compiler. calls between compiled lambdas
+# push a VMFrame instead of recursing, so the whole program is one loop
+# as far as the JIT is concerned.
+
+class VMFrame(object):
+    def __init__(self, code, scope, parent):
+        self.code = code
+        self.scope = scope
+        self.parent = parent
+        # the instruction being run, or for a caller, the call it's in
+        self.pc = 0
+        self.stack = [None] * code.stack_size
+        self.sp = 0
+
+    def push(self, value):
+        self.stack[self.sp] = value
+        self.sp += 1
+
+    def pop(self):
+        self.sp -= 1
+        value = self.stack[self.sp]
+        self.stack[self.sp] = None
+        return value
+
+    def top(self):
+        return self.stack[self.sp - 1]
+
+    def peek(self, depth):
+        return self.stack[self.sp - 1 - depth]
+
+    @unroll_safe
+    def pop_values(self, num):
+        values = [None] * num
+        i = num - 1
+        while i >= 0:
+            values[i] = self.pop()
+            i -= 1
+        return values
+
+def get_location(pc, code):
+    return code.name + ":" + str(pc) + " " + opnames[code.ops[pc]]
+jitdriver = JitDriver(greens=['pc', 'code'], reds=['frame'], get_printable_location=get_location)
+
+def _lookup(symbol, scope):
+    try:
+        if isinstance(symbol, LexicalSymbol):
+            return symbol.lookup(scope)
+        assert isinstance(symbol, Symbol)
+        return scope.get(symbol.name)
+    except NameNotSet:
+        raise EvalException("symbol is not set", symbol)
+
+def _store(symbol, scope, value):
+    if isinstance(symbol, LexicalSymbol):
+        symbol.store(scope, value)
+    else:
+        assert isinstance(symbol, Symbol)
+        scope.set(symbol.name, value)
+
+def _procedure(value):
+    if not isinstance(value, Procedure):
+        raise EvalException("value does not evaluate to a procedure", value)
+    return value
+
+def _call_form(function, form, scope):
+    # the fexpr path, for anything that won't take a list of values
+    if isinstance(function, LambdaProcedure) and function.eval_return:
+        expansion = function.cached_expansion(form.cdr)
+        if expansion is None:
+            sexp = run(compiled_code(function), function.bind(scope, form.cdr))
+            expansion = function.new_expansion(form.cdr, sexp)
+        if expansion.code is None:
+            expansion.code = compile_form(scope, expansion.sexp)
+        return run(expansion.code, scope)
+    return function.call(scope, form.cdr)
+
+def _form(code, pc):
+    form = code.forms[pc / 3][0]
+    assert isinstance(form, Cell)
+    return form
+
+@unroll_safe
+def _unwind(frame, e):
+    while frame is not None:
+        for form in frame.code.forms[frame.pc / 3]:
+            e = e.propogate(form)
+        frame = frame.parent
+    return e
+
+def run(code, scope):
+    frame = VMFrame(code, scope, None)
+    pc = 0
+    while True:
+        jitdriver.jit_merge_point(pc=pc, code=code, frame=frame)
+        frame.pc = pc
+        op = code.ops[pc]
+        a = code.ops[pc + 1]
+        b = code.ops[pc + 2]
+        pc += 3
+        try:
+            if op == LOAD_CONST:
+                frame.push(code.consts[a])
+            elif op == LOAD_LOCAL or op == LOAD_GLOBAL:
+                frame.push(_lookup(code.consts[a], frame.scope))
+            elif op == STORE:
+                symbol = code.consts[a]
+                assert isinstance(symbol, Symbol)
+                name_procedure(frame.top(), symbol.name)
+                _store(symbol, frame.scope, frame.top())
+            elif op == POP:
+                frame.pop()
+            elif op == JUMP:
+                if a < pc:
+                    pc = a
+                    jitdriver.can_enter_jit(pc=pc, code=code, frame=frame)
+                else:
+                    pc = a
+            elif op == JUMP_IF_NIL:
+                if frame.pop() is None:
+                    pc = a
+            elif op == JUMP_IF_NIL_KEEP:
+                if frame.top() is None:
+                    pc = a
+                else:
+                    frame.pop()
+            elif op == JUMP_IF_TRUE_KEEP:
+                if frame.top() is not None:
+                    pc = a
+                else:
+                    frame.pop()
+            elif op == GUARD:
+                guard = code.guards[a]
+                if _lookup(guard.symbol, frame.scope) is not guard.builtin:
+                    frame.push(eval(frame.scope, guard.form))
+                    pc = b
+            elif op == CALL_PREPARE:
+                function = hint(_procedure(frame.top()), promote=True)
+                if not function.is_strict():
+                    frame.pop()
+                    frame.push(_call_form(function, _form(code, frame.pc), frame.scope))
+                    pc = b
+            elif op == CALL_FORM:
+                function = _procedure(frame.pop())
+                frame.push(_call_form(function, _form(code, frame.pc), frame.scope))
+            elif (op == CALL or op == TAIL_CALL) and a == 2 and not isinstance(frame.peek(2), LambdaProcedure):
+                val2 = frame.pop()
+                val1 = frame.pop()
+                function = hint(frame.pop(), promote=True)
+                assert isinstance(function, Procedure)
+                try:
+                    value = function.apply2(frame.scope, val1, val2)
+                except EvalException, e:
+                    raise e.blame_argument([val1, val2], _form(code, frame.pc).cdr)
+                if op == CALL:
+                    frame.push(value)
+                    continue
+                if frame.parent is None:
+                    return value
+                frame = frame.parent
+                code = frame.code
+                pc = frame.pc + 3
+                frame.push(value)
+            elif op == CALL or op == TAIL_CALL:
+                values = frame.pop_values(a)
+                function = hint(frame.pop(), promote=True)
+                assert isinstance(function, Procedure)
+                if isinstance(function, LambdaProcedure):
+                    scope = function.bind_values(values)
+                    if op == TAIL_CALL:
+                        frame = VMFrame(compiled_code(function), scope, frame.parent)
+                    else:
+                        frame = VMFrame(compiled_code(function), scope, frame)
+                    code = frame.code
+                    pc = 0
+                    jitdriver.can_enter_jit(pc=pc, code=code, frame=frame)
+                    continue
+                try:
+                    value = function.apply(frame.scope, values)
+                except EvalException, e:
+                    raise e.blame_argument(values, _form(code, frame.pc).cdr)
+                if op == CALL:
+                    frame.push(value)
+                    continue
+                # a tail call to a builtin returns straight away
+                if frame.parent is None:
+                    return value
+                frame = frame.parent
+                code = frame.code
+                pc = frame.pc + 3
+                frame.push(value)
+            elif op == RETURN:
+                value = frame.pop()
+                if frame.parent is None:
+                    return value
+                frame = frame.parent
+                code = frame.code
+                pc = frame.pc + 3
+                frame.push(value)
+            elif op == PUSH_FRAME:
+                values = frame.pop_values(b)
+                frame.scope = Frame(frame.scope, code.layouts[a], values)
+            elif op == POP_FRAME:
+                scope = frame.scope
+                assert isinstance(scope, Frame)
+                frame.scope = scope.parent
+            elif op == MAKE_CLOSURE:
+                closure = code.closures[a]
+                proc = closure.builtin.call(frame.scope, closure.args)
+                assert isinstance(proc, LambdaProcedure)
+                proc.code = closure.code
+                frame.push(proc)
+            elif op == DOLIST_START:
+                if not is_list(frame.top()):
+                    raise EvalException("dolist target is not a list")
+            elif op == DOLIST_NEXT:
+                work = frame.pop()
+                if work is None:
+                    frame.push(None)
+                    pc = a
+                else:
+                    assert isinstance(work, Cell)
+                    frame.push(work.cdr)
+                    frame.push(work.car)
+            else:
+                raise EvalException("invalid bytecode")
+        except EvalException, e:
+            raise _unwind(frame, e)
+
+def execute(scope, sexp):
+    return run(compile_form(scope, sexp), scope)
+
+def execute_list(scope, sexps):
+    ret = None
+    for sexp in sexps:
+        ret = execute(scope, sexp)
+    return ret
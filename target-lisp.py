@@ -1,43 +1,156 @@
 import sys
 import os
 
-from lisp.parser import parse
+from lisp.parser import FileReader, ParseError
 from lisp.scope import Scope
 from lisp.builtins import register as register_builtins
-from lisp.eval import eval_list, EvalException
+from lisp.eval import eval, EvalException
+from lisp.image import save_image, load_image, ImageError
+from lisp.cache import FormCache, HashingFileReader, default_directory
+from lisp import nodes, vm, profiler, ports
 
-def evaluate_file(scope, fname):
+from pypy.rlib.jit import set_user_param
+
+engines = ['eval', 'closure', 'vm']
+
+def evaluate(scope, sexp, engine):
+    if engine == 'closure':
+        return nodes.execute(scope, sexp)
+    if engine == 'vm':
+        return vm.execute(scope, sexp)
+    return eval(scope, sexp)
+
+def evaluate_cached(scope, fd, engine, cache):
+    key = cache.key_fd(fd)
+    sexps = cache.load(key)
+    ret = None
+    if sexps is not None:
+        for sexp in sexps:
+            ret = evaluate(scope, sexp, engine)
+        return ret
+    # still run as read; the forms are only kept to be stored
+    reader = HashingFileReader(fd, cache)
+    sexps = []
+    while not reader.at_end():
+        sexp = reader.read()
+        sexps.append(sexp)
+        ret = evaluate(scope, sexp, engine)
+    if reader.key() == key:
+        cache.store(key, sexps)
+    return ret
+
+def evaluate_file(scope, fname, engine, cache):
+    # each top-level form is run as soon as it has been read
     fd = os.open(fname, os.O_RDONLY, 0777)
-    data = ""
-    while True:
-        data_append = os.read(fd, 4096)
-        if len(data_append) == 0:
-            break
-        data += data_append
-    os.close(fd)
-    
-    parsed = parse(data)
-    sexps = parsed.to_list()
-    return eval_list(scope, sexps)
+    try:
+        if cache is not None and cache.wants(fd):
+            return evaluate_cached(scope, fd, engine, cache)
+        reader = FileReader(fd)
+        ret = None
+        while not reader.at_end():
+            ret = evaluate(scope, reader.read(), engine)
+        return ret
+    finally:
+        os.close(fd)
 
 def entry_point(argv):
-    try:
-        filenames = argv[1:]
-    except IndexError:
+    engine = 'eval'
+    image = None
+    save_to = None
+    use_cache = True
+    purge_cache = False
+    profile = False
+    filenames = []
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--engine':
+            i += 1
+            if i >= len(argv) or argv[i] not in engines:
+                print "--engine must be one of: " + ", ".join(engines)
+                return 1
+            engine = argv[i]
+        elif arg == '--profile':
+            profile = True
+        elif arg == '--jit':
+            # e.g. --jit threshold=200,trace_eagerness=50
+            i += 1
+            if i >= len(argv):
+                print "--jit needs a parameter string"
+                return 1
+            set_user_param(None, argv[i])
+        elif arg == '--no-cache':
+            use_cache = False
+        elif arg == '--purge-cache':
+            purge_cache = True
+        elif arg == '--image' or arg == '--save-image':
+            i += 1
+            if i >= len(argv):
+                print arg + " needs a filename"
+                return 1
+            if arg == '--image':
+                image = argv[i]
+            else:
+                save_to = argv[i]
+        else:
+            filenames.append(arg)
+        i += 1
+    
+    if profile and engine != 'eval':
+        # the other engines make their calls without going through eval,
+        # so they'd report nothing; (profile expr) runs expr with eval,
+        # and works under any engine
+        print "--profile only works with the eval engine"
+        return 1
+    
+    cache = None
+    directory = default_directory()
+    if directory is not None:
+        cache = FormCache(directory)
+        if purge_cache:
+            print "removed " + str(cache.purge()) + " cached files"
+    if not use_cache:
+        cache = None
+    
+    if len(filenames) == 0 and save_to is None:
+        if purge_cache:
+            return 0
         print "You must supply a filename."
         return 1
     
     scope = Scope()
     register_builtins(scope)
+    ports.setup()
+    if profile:
+        profiler.start()
     
+    status = 0
     try:
+        if image is not None:
+            load_image(scope, image)
         for i in range(len(filenames)):
-            evaluate_file(scope, filenames[i])
+            evaluate_file(scope, filenames[i], engine, cache)
+        if save_to is not None:
+            save_image(scope, save_to)
     except EvalException, e:
+        ports.flush_all()
         e.pretty_print()
-        return 1
+        status = 1
+    except ParseError, e:
+        ports.flush_all()
+        print e.nice_error_message()
+        status = 1
+    except ImageError, e:
+        ports.flush_all()
+        print e.nice_error_message()
+        status = 1
     
-    return 0
+    ports.flush_all()
+    profiling = profiler.state.profiler
+    if profiling is not None:
+        # on stderr, so it stays out of the program's own output
+        os.write(2, profiling.report())
+    return status
 
 def jitpolicy(driver):
     from pypy.jit.codewriter.policy import JitPolicy
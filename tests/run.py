@@ -0,0 +1,128 @@
+import sys
+import os
+import shutil
+import subprocess
+import tempfile
+import difflib
+import optparse
+
+# runs each NAME.l here that has a NAME.out next to it, on every engine,
+# and compares what it prints with NAME.out. if there's a NAME.in, it's
+# fed to the program on stdin. if there's a NAME.image.l, it's run first
+# and saved with --save-image, and NAME.l is run starting from that
+# image; what both print is compared. tests with neither are also run
+# once more read from a pipe, as /dev/stdin. the first engine to run a
+# file fills a fresh form cache, and the others read from it. tests run
+# in the same temporary directory, so they can write files. run from
+# anywhere, with PYPY set as for the Makefile:
+#   PYPY=/path/to/pypy python tests/run.py
+#   PYPY=/path/to/pypy python tests/run.py --engine vm hashtable
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+engines = ['eval', 'closure', 'vm']
+
+stdlib = [
+    os.path.join(root, 'stdlisp', '00-core.l'),
+    os.path.join(root, 'stdlisp', '01-io.l'),
+]
+
+def find_tests():
+    ret = []
+    for name in sorted(os.listdir(here)):
+        if not name.endswith('.l'):
+            continue
+        name = name[:-2]
+        if os.path.exists(os.path.join(here, name + '.out')):
+            ret.append(name)
+    return ret
+
+def interpreter(which):
+    if which == 'translated':
+        binary = os.path.join(root, 'target-lisp-c')
+        if not os.path.exists(binary):
+            raise RuntimeError('target-lisp-c has not been built')
+        return [binary], dict(os.environ)
+    env = dict(os.environ)
+    pypy = os.environ.get('PYPY')
+    if pypy:
+        env['PYTHONPATH'] = pypy + os.pathsep + env.get('PYTHONPATH', '')
+    return [sys.executable, os.path.join(root, 'target-lisp.py')], env
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def run(command, env, stdin, cwd):
+    process = subprocess.Popen(command, env=env, cwd=cwd, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate(stdin)
+    return out
+
+def check(label, expected, got):
+    if got == expected:
+        sys.stderr.write('ok    %s\n' % label)
+        return True
+    sys.stderr.write('FAIL  %s\n' % label)
+    for line in difflib.unified_diff(expected.splitlines(True), got.splitlines(True),
+                                     'expected', 'got'):
+        sys.stderr.write('      ' + line)
+    return False
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [test ...]')
+    parser.add_option('--engine', action='append', default=[],
+                      help='engine to run (eval, closure, vm); may be repeated')
+    parser.add_option('--interpreter', default='untranslated',
+                      choices=['untranslated', 'translated'])
+    options, names = parser.parse_args(argv[1:])
+    chosen = options.engine or engines
+
+    tests = find_tests()
+    unknown = set(names) - set(tests)
+    if unknown:
+        parser.error('unknown tests: ' + ', '.join(sorted(unknown)))
+    if names:
+        tests = [t for t in tests if t in names]
+
+    command, env = interpreter(options.interpreter)
+    cache = tempfile.mkdtemp(prefix='lisplisp-tests-')
+    env['LISPLISP_CACHE'] = cache
+    image = os.path.join(cache, 'test.image')
+
+    failures = 0
+    try:
+        for name in tests:
+            path = os.path.join(here, name + '.l')
+            expected = read(os.path.join(here, name + '.out'))
+            stdin = ''
+            if os.path.exists(os.path.join(here, name + '.in')):
+                stdin = read(os.path.join(here, name + '.in'))
+            setup = os.path.join(here, name + '.image.l')
+            for engine in chosen:
+                if os.path.exists(setup):
+                    got = run(command + ['--engine', engine] + stdlib +
+                              [setup, '--save-image', image], env, '', cache)
+                    got += run(command + ['--engine', engine, '--image', image, path],
+                               env, stdin, cache)
+                else:
+                    got = run(command + ['--engine', engine] + stdlib + [path],
+                              env, stdin, cache)
+                if not check('%s (%s)' % (name, engine), expected, got):
+                    failures += 1
+            if not os.path.exists(setup) and not os.path.exists(os.path.join(here, name + '.in')):
+                got = run(command + ['--engine', chosen[0]] + stdlib + ['/dev/stdin'],
+                          env, read(path), cache)
+                if not check('%s (%s, from a pipe)' % (name, chosen[0]), expected, got):
+                    failures += 1
+    finally:
+        shutil.rmtree(cache)
+
+    if failures:
+        sys.stderr.write('%d failed\n' % failures)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))